@@ -0,0 +1,321 @@
+"""
+Admission control for the detection routes
+Two checks, both shared by every worker on the host:
+
+- Token buckets per client IP and per signed-in user: RATE_LIMIT_*_BURST
+  images at once, refilled at RATE_LIMIT_*_PER_MINUTE. @admit() takes one
+  token from every bucket or none (a request turned away by its user's
+  bucket keeps its IP's token); a request over either budget gets 429 with
+  Retry-After set to when its next token arrives. A batch upload pays for
+  its other images once its body has been parsed and the count is known
+  (charge_images()); that may leave the buckets in debt, which later
+  requests wait out. The buckets live in a small SQLite file of their own
+  (RATE_LIMIT_DATABASE, in METRICS_DIR by default), so a check never waits
+  on the application database's write lock.
+- At most DETECT_MAX_IN_FLIGHT inferences at a time. inference_slot() holds
+  an flock on one of that many slot files around the model call only, so
+  slow uploads never hold one; when none frees up within
+  DETECT_QUEUE_TIMEOUT_MS it raises Overloaded, which the routes turn into
+  503 with Retry-After instead of queueing behind busy workers. The kernel
+  drops the locks of a worker that dies, so a crash cannot leak a slot.
+
+Behind a proxy (Render), set RATE_LIMIT_PROXY_HOPS to the number of
+proxies that append to X-Forwarded-For; otherwise every client shares the
+proxy's address.
+"""
+
+import os
+import time
+import fcntl
+import random
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+import db
+import metrics
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', '1').lower() in ('1', 'true', 'yes')
+RATE_LIMIT_IP_PER_MINUTE = float(os.getenv('RATE_LIMIT_IP_PER_MINUTE', 60))
+RATE_LIMIT_IP_BURST = int(os.getenv('RATE_LIMIT_IP_BURST', 20))
+RATE_LIMIT_USER_PER_MINUTE = float(os.getenv('RATE_LIMIT_USER_PER_MINUTE', 30))
+RATE_LIMIT_USER_BURST = int(os.getenv('RATE_LIMIT_USER_BURST', 10))
+RATE_LIMIT_DATABASE = os.getenv('RATE_LIMIT_DATABASE', '')
+RATE_LIMIT_PROXY_HOPS = int(os.getenv('RATE_LIMIT_PROXY_HOPS', 0))
+# Concurrent inferences across all workers (0 disables the cap)
+DETECT_MAX_IN_FLIGHT = int(os.getenv('DETECT_MAX_IN_FLIGHT', 2 * (os.cpu_count() or 1)))
+DETECT_QUEUE_TIMEOUT_MS = float(os.getenv('DETECT_QUEUE_TIMEOUT_MS', 200))
+DETECT_RETRY_AFTER_SECONDS = int(os.getenv('DETECT_RETRY_AFTER_SECONDS', 1))
+
+# Checks per process between sweeps of buckets that have refilled completely
+PRUNE_EVERY = 1000
+SLOT_POLL_SECONDS = 0.005
+
+RATE_LIMIT_BUCKETS_DDL = '''
+    CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+        key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated REAL NOT NULL
+    ) WITHOUT ROWID
+'''
+
+# Refill by the time since the last request, then take :cost tokens (which
+# may leave the bucket negative). SET expressions see the row as it was.
+TAKE_TOKENS = '''
+    INSERT INTO rate_limit_buckets (key, tokens, updated) VALUES (:key, :burst - :cost, :now)
+    ON CONFLICT (key) DO UPDATE SET
+        tokens = min(:burst, tokens + max(0, :now - updated) * :rate) - :cost,
+        updated = max(updated, :now)
+'''
+
+REJECTIONS = metrics.Counter('crop_portal_admission_rejections',
+                             'Requests turned away by admission control, by route and reason',
+                             ('route', 'reason'))
+
+
+class Overloaded(Exception):
+    """Every inference slot stayed busy for the queue timeout"""
+
+    def __init__(self, retry_after=DETECT_RETRY_AFTER_SECONDS):
+        super().__init__(f"all {DETECT_MAX_IN_FLIGHT} inference slots busy")
+        self.retry_after = retry_after
+
+# ============================================================================
+# RATE LIMITS
+# ============================================================================
+
+class RateLimiter:
+    """Token buckets in a SQLite file shared by every process that opens it"""
+
+    def __init__(self, database, limits):
+        # limits: {kind: (per minute, burst)}, e.g. {'ip': (60, 20)}
+        self.database = database
+        self.limits = {kind: (per_minute / 60.0, max(1, burst)) for kind, (per_minute, burst) in limits.items()}
+        self._checks = 0
+        self._ready_pid = None
+
+    def _ensure_table(self):
+        if self._ready_pid != os.getpid():
+            with db.transaction(self.database) as conn:
+                conn.execute(RATE_LIMIT_BUCKETS_DDL)
+            self._ready_pid = os.getpid()
+
+    def _params(self, kind, key, cost, now):
+        rate, burst = self.limits[kind]
+        return {'key': f'{kind}:{key}', 'burst': burst, 'rate': rate, 'cost': cost, 'now': now}
+
+    def check(self, keys, cost=1, now=None):
+        """
+        Take cost tokens from every (kind, key) bucket, or from none of them
+        Returns 0 when all had enough, otherwise the seconds until the
+        emptiest one does. Keys that are None are skipped.
+        """
+        self._ensure_table()
+        now = time.time() if now is None else now
+        keys = [(kind, key) for kind, key in keys if key is not None]
+        retry_after = 0.0
+        # The write lock up front, so no other process spends the tokens between the read and the write
+        with db.transaction(self.database, immediate=True) as conn:
+            for kind, key in keys:
+                rate, burst = self.limits[kind]
+                row = conn.execute('SELECT tokens, updated FROM rate_limit_buckets WHERE key = ?',
+                                   (f'{kind}:{key}',)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+                if tokens < cost:
+                    retry_after = max(retry_after, (cost - tokens) / rate if rate > 0 else 60.0)
+            if not retry_after:
+                conn.executemany(TAKE_TOKENS, [self._params(kind, key, cost, now) for kind, key in keys])
+        self._checks += 1
+        if self._checks % PRUNE_EVERY == 0:
+            self.prune(now)
+        return retry_after
+
+    def charge(self, keys, cost, now=None):
+        """Take cost tokens from every bucket whatever they hold, leaving them in debt if need be"""
+        self._ensure_table()
+        now = time.time() if now is None else now
+        with db.transaction(self.database) as conn:
+            conn.executemany(TAKE_TOKENS, [self._params(kind, key, cost, now)
+                                           for kind, key in keys if key is not None])
+
+    def prune(self, now=None):
+        """Drop buckets that have refilled completely; a missing bucket is a full one"""
+        now = time.time() if now is None else now
+        # Conservative across kinds: the largest burst at the slowest refill rate
+        burst = max(burst for _, burst in self.limits.values())
+        rate = min(rate for rate, _ in self.limits.values())
+        if rate <= 0:
+            return 0
+        with db.transaction(self.database) as conn:
+            return conn.execute('DELETE FROM rate_limit_buckets WHERE updated + (? - tokens) / ? < ?',
+                                (burst, rate, now)).rowcount
+
+# ============================================================================
+# IN-FLIGHT CAP
+# ============================================================================
+
+class SlotPool:
+    """
+    N lock files; holding an flock on one is holding a slot
+    flock is per open file, so threads of one process share a descriptor
+    per slot and a process-local set keeps two of them off the same slot.
+    """
+
+    def __init__(self, directory, slots):
+        self.directory = directory
+        self.slots = slots
+        self._fds = None
+        self._pid = None
+        self._held = set()
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # Descriptors (and their locks) must not be shared with a forked child
+        if self._pid != os.getpid():
+            os.makedirs(self.directory, exist_ok=True)
+            self._fds = [os.open(os.path.join(self.directory, f'slot-{i}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+                         for i in range(self.slots)]
+            self._held = set()
+            self._pid = os.getpid()
+        return self._fds
+
+    def try_acquire(self):
+        with self._lock:
+            fds = self._open()
+            start = random.randrange(self.slots)
+            for i in range(self.slots):
+                slot = (start + i) % self.slots
+                if slot in self._held:
+                    continue
+                try:
+                    fcntl.flock(fds[slot], fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                self._held.add(slot)
+                return slot
+        return None
+
+    def acquire(self, timeout=None):
+        """A slot number, or None if every slot stayed busy for timeout seconds (None: wait for one)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            slot = self.try_acquire()
+            if slot is not None or (deadline is not None and time.monotonic() >= deadline):
+                return slot
+            time.sleep(SLOT_POLL_SECONDS)
+
+    def release(self, slot):
+        with self._lock:
+            fcntl.flock(self._fds[slot], fcntl.LOCK_UN)
+            self._held.discard(slot)
+
+# ============================================================================
+# FLASK
+# ============================================================================
+
+_limiter = None
+_slots = None
+_setup_lock = threading.Lock()
+
+def _shared():
+    global _limiter, _slots
+    if _limiter is None:
+        with _setup_lock:
+            if _limiter is None:
+                shared = metrics.directory()
+                _slots = SlotPool(os.path.join(shared, 'detect-slots'), DETECT_MAX_IN_FLIGHT)
+                _limiter = RateLimiter(RATE_LIMIT_DATABASE or os.path.join(shared, 'ratelimit.db'), {
+                    'ip': (RATE_LIMIT_IP_PER_MINUTE, RATE_LIMIT_IP_BURST),
+                    'user': (RATE_LIMIT_USER_PER_MINUTE, RATE_LIMIT_USER_BURST),
+                })
+    return _limiter, _slots
+
+
+def client_ip(request):
+    if RATE_LIMIT_PROXY_HOPS:
+        forwarded = [part.strip() for part in request.headers.get('X-Forwarded-For', '').split(',') if part.strip()]
+        if len(forwarded) >= RATE_LIMIT_PROXY_HOPS:
+            return forwarded[-RATE_LIMIT_PROXY_HOPS]
+    return request.remote_addr or 'unknown'
+
+
+def _route():
+    from flask import request
+    return request.url_rule.rule if request.url_rule is not None else request.path
+
+
+def _reject(status, message, retry_after):
+    from flask import jsonify
+
+    seconds = max(1, int(-(-retry_after // 1)))
+    response = jsonify({"error": message, "retry_after": seconds})
+    response.status_code = status
+    response.headers['Retry-After'] = str(seconds)
+    return response
+
+
+@contextmanager
+def inference_slot(timeout=DETECT_QUEUE_TIMEOUT_MS / 1000.0):
+    """Hold one of the host's DETECT_MAX_IN_FLIGHT inference slots; raises Overloaded after timeout seconds"""
+    _, slots = _shared()
+    with stage('admission'):
+        slot = slots.acquire(timeout) if slots.slots else None
+    if slots.slots and slot is None:
+        raise Overloaded()
+    try:
+        yield
+    finally:
+        if slot is not None:
+            slots.release(slot)
+
+
+def overloaded(error):
+    """The 503 for an Overloaded raised inside a route"""
+    REJECTIONS.inc(route=_route(), reason='overloaded')
+    logger.warning("All %d inference slots busy; rejecting %s", DETECT_MAX_IN_FLIGHT, _route())
+    return _reject(503, "Server busy. Please try again.", error.retry_after)
+
+
+def charge_images(count):
+    """Charge the buckets @admit() checked for count more images (a batch upload's others)"""
+    from flask import g
+
+    keys = g.get('rate_limit_keys')
+    if keys and count > 0:
+        limiter, _ = _shared()
+        with stage('admission'):
+            limiter.charge(keys, count)
+
+
+def admit(user=None):
+    """
+    Rate limits for a route: one token per request from the client's IP bucket and user bucket
+    user() returns the signed-in user's email (None when there is none), so
+    under @require_auth this goes after it.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated(*args, **kwargs):
+            from flask import g, request
+
+            if RATE_LIMIT_ENABLED:
+                limiter, _ = _shared()
+                keys = (('ip', client_ip(request)), ('user', user() if user else None))
+                with stage('admission'):
+                    retry_after = limiter.check(keys)
+                if retry_after:
+                    REJECTIONS.inc(route=_route(), reason='rate_limited')
+                    return _reject(429, "Too many requests. Please try again later.", retry_after)
+                g.rate_limit_keys = keys
+            return f(*args, **kwargs)
+
+        return decorated
+    return decorator
@@ -1,19 +1,33 @@
 import os
-import time
-import random
-import json
 import logging
-import sqlite3
 from datetime import datetime
+from urllib.parse import urlencode
 from werkzeug.utils import secure_filename
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 
+import db
+from imaging import InvalidImage, inspect_image
+from upload_store import UploadStore
+from batch_upload import BatchTooLarge, MalformedBatch, parse_batch, max_body_length
+from pagination import InvalidCursor, fetch_history_page, history_version
+from crop_catalog import CropCatalog, FACETS
+from detection import DetectionPipeline
+import migrations
+import rollups
+import metrics
+from metrics import stage
+import http_cache
+from http_cache import conditional
+from admission import Overloaded, admit, charge_images, overloaded
+
 # ==========================================
 # APP & CONFIG
 # ==========================================
 app = Flask(__name__)
 CORS(app)  # during testing: allow all origins. Lock down later.
+metrics.init_app(app)  # /api/metrics, per-stage timings and Server-Timing headers
+http_cache.init_app(app)  # gzip JSON/text responses over COMPRESS_MIN_BYTES
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5MB file limit
 
 # Use absolute paths so the host can write to them reliably
@@ -23,6 +37,7 @@ DATABASE = os.path.join(ROOT_DIR, 'crop_portal.db')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+upload_store = UploadStore(UPLOAD_FOLDER)
 
 # ==========================================
 # LOGGING
@@ -45,49 +60,28 @@ logger = logging.getLogger(__name__)
 # DATABASE INITIALIZATION
 # ==========================================
 def init_db():
-    """Initialize SQLite database with required tables"""
+    """Bring the schema up to date; once it is, this only reads PRAGMA user_version (see migrations.py)"""
     try:
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email TEXT UNIQUE NOT NULL,
-                name TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS analysis_results (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_email TEXT,
-                disease TEXT NOT NULL,
-                confidence REAL NOT NULL,
-                description TEXT,
-                treatment TEXT,
-                filename TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_email) REFERENCES users(email)
-            )
-        ''')
-        conn.commit()
-        conn.close()
-        logger.info("[+] Database initialized successfully at %s", DATABASE)
+        version = migrations.ensure(DATABASE)
+        logger.info("[+] Database at schema version %d: %s", version, DATABASE)
+    except migrations.SchemaOutdated:
+        raise
     except Exception as e:
         logger.exception("Database initialization error: %s", e)
 
-# Run init_db on import so Gunicorn workers inherit an initialized DB (safe)
+# Gunicorn migrates in the master before forking (gunicorn_config.on_starting),
+# so workers importing the app only check the schema version
 init_db()
 
 # ==========================================
-# MOCK DISEASE DB (replace with model later)
+# DETECTION PIPELINE (shared with app_v2_jwt.py; see detection.py)
 # ==========================================
-DISEASE_DB = [
-    {"disease": "Potato Early Blight", "confidence": 0.94, "description": "Fungal infection characterized by concentric rings on dark spots.", "treatment": ["Apply copper-based fungicides", "Improve air circulation", "Remove infected leaves"], "severity": "High"},
-    {"disease": "Corn Common Rust",    "confidence": 0.88, "description": "Reddish-brown pustules appearing on both leaf surfaces.", "treatment": ["Plant resistant varieties", "Apply fungicides early", "Crop rotation"], "severity": "Medium"},
-    {"disease": "Tomato Mosaic Virus","confidence": 0.91, "description": "Mottling and yellowing of leaves with stunted growth.", "treatment": ["Remove infected plants", "Control aphids", "Disinfect tools"], "severity": "High"},
-    {"disease": "Healthy",            "confidence": 0.98, "description": "No signs of disease detected. Plant looks vigorous.", "treatment": ["Continue regular watering", "Monitor weekly", "Maintain soil nutrition"], "severity": "None"}
-]
+pipeline = DetectionPipeline(DATABASE, upload_store)
+pipeline.init_app(app)  # job workers, /api/inference/stats, /api/trends, /api/metrics
+disease_catalog = pipeline.disease_catalog
+job_queue = pipeline.job_queue
+# Advisory catalog index for /api/crops; rebuilt when crops.json changes
+catalog = CropCatalog()
 
 # ==========================================
 # UTILITIES
@@ -95,27 +89,15 @@ DISEASE_DB = [
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def save_analysis_result(user_email, result, filename):
-    try:
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO analysis_results 
-            (user_email, disease, confidence, description, treatment, filename)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            user_email,
-            result.get('disease'),
-            result.get('confidence'),
-            result.get('description'),
-            json.dumps(result.get('treatment', [])),
-            filename
-        ))
-        conn.commit()
-        conn.close()
-        logger.info("Analysis result saved for %s", user_email)
-    except Exception as e:
-        logger.exception("Error saving analysis result: %s", e)
+def wants_async():
+    return request.args.get('async', '').lower() in ('1', 'true', 'yes')
+
+def get_user_job(job_id):
+    # Only the submitter's jobs, identified by ?email= as for /api/history
+    job = job_queue.get(job_id)
+    if job is None or job['user_email'] != request.args.get('email', 'anonymous'):
+        return None
+    return job
 
 # ==========================================
 # ROUTES
@@ -130,13 +112,17 @@ def home():
     })
 
 @app.route('/api/detect', methods=['POST'])
+@admit()
 def detect_disease():
     try:
-        if 'imageFile' not in request.files:
+        # The first access to request.files reads the whole body off the socket
+        with stage('receive'):
+            files = request.files
+        if 'imageFile' not in files:
             logger.warning("No file uploaded")
             return jsonify({"error": "No file uploaded"}), 400
 
-        file = request.files['imageFile']
+        file = files['imageFile']
         if file.filename == '':
             logger.warning("Empty filename submitted")
             return jsonify({"error": "No file selected"}), 400
@@ -145,28 +131,127 @@ def detect_disease():
             logger.warning("Invalid file type: %s", file.filename)
             return jsonify({"error": f"Invalid file type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"}), 400
 
+        # Reject non-images from the header alone, before anything is written
+        try:
+            with stage('validate'):
+                image_format, (width, height) = inspect_image(file.stream)
+        except InvalidImage as e:
+            logger.warning("Rejected upload %s: %s", file.filename, e)
+            return jsonify({"error": "File is not a valid image"}), 400
+
         user_email = request.form.get('userEmail', 'anonymous')
         filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filepath = os.path.join(UPLOAD_FOLDER, f"{timestamp}_{filename}")
+        ext = file.filename.rsplit('.', 1)[1].lower()
+
+        with stage('save'):
+            stored = upload_store.save(file.stream, ext)
+        filepath = stored.path
+        logger.info("Stored %s %dx%d upload for %s -> %s (%d bytes, new=%s)",
+                    image_format, width, height, user_email, filepath, stored.size, stored.created)
 
-        logger.info("Saving file for %s -> %s", user_email, filepath)
-        file.save(filepath)
+        if wants_async():
+            job_id = job_queue.submit(user_email, filename, filepath)
+            logger.info("Queued detection job %s for %s", job_id, user_email)
+            owner = urlencode({"email": user_email})
+            return jsonify({
+                "job_id": job_id,
+                "status": "queued",
+                "status_url": f"/api/jobs/{job_id}?{owner}",
+                "stream_url": f"/api/jobs/{job_id}/stream?{owner}"
+            }), 202, {"Location": f"/api/jobs/{job_id}?{owner}"}
 
-        # Simulate model inference (replace with real model inference)
-        time.sleep(2)
-        result = random.choice(DISEASE_DB)
+        try:
+            result = pipeline.run_diagnosis(stored.digest, filepath, user_email)
+        except InvalidImage:
+            logger.warning("Unreadable image: %s", filename)
+            return jsonify({"error": "File is not a valid image"}), 400
 
-        save_analysis_result(user_email, result, filename)
+        with stage('save_result'):
+            pipeline.save_analysis_result(user_email, result, filename)
 
         response = {**result, "timestamp": datetime.now().isoformat(), "filename": filename}
         logger.info("Detection result: %s (%.2f)", result['disease'], result['confidence'])
         return jsonify(response), 200
 
+    except Overloaded as e:
+        return overloaded(e)
     except Exception as e:
         logger.exception("Error in detect_disease: %s", e)
         return jsonify({"error": "Server error. Please try again."}), 500
 
+@app.route('/api/detect/batch', methods=['POST'])
+@admit()
+def detect_disease_batch():
+    """Diagnose every imageFile part of one multipart request"""
+    # Batches may be far larger than the single-upload MAX_CONTENT_LENGTH
+    request.max_content_length = max_body_length()
+    try:
+        try:
+            # Streams every part to the upload store as it arrives
+            with stage('receive'):
+                fields, items = parse_batch(request, upload_store, ALLOWED_EXTENSIONS)
+        except BatchTooLarge as e:
+            logger.warning("Rejected batch upload: %s", e)
+            return jsonify({"error": str(e)}), 413
+        except MalformedBatch as e:
+            logger.warning("Malformed batch upload: %s", e)
+            return jsonify({"error": "Malformed multipart body"}), 400
+
+        if not items:
+            logger.warning("Batch submitted without files")
+            return jsonify({"error": "No file uploaded"}), 400
+        # @admit() took one token for the request; the other images are charged now the count is known
+        charge_images(len(items) - 1)
+
+        user_email = fields.get('userEmail', 'anonymous')
+        stored = [item for item in items if item.stored is not None]
+        with stage('inference'):
+            outcomes = dict(zip((item.index for item in stored),
+                                pipeline.run_batch_diagnosis([item.stored for item in stored], user_email)))
+
+        timestamp = datetime.now().isoformat()
+        results, rows = [], []
+        for item in items:
+            filename = secure_filename(item.filename or '')
+            outcome = item.error or outcomes[item.index]
+            if isinstance(outcome, InvalidImage):
+                outcome = "File is not a valid image"
+            if isinstance(outcome, str):
+                results.append({"index": item.index, "filename": filename, "error": outcome})
+                continue
+            results.append({**outcome, "index": item.index, "filename": filename, "timestamp": timestamp})
+            rows.append(pipeline.analysis_row(user_email, outcome, filename))
+
+        with stage('save_result'):
+            pipeline.save_analysis_results(user_email, rows)
+        logger.info("Batch detection for %s: %d of %d images diagnosed", user_email, len(rows), len(items))
+        return jsonify({
+            "count": len(items),
+            "succeeded": len(rows),
+            "failed": len(items) - len(rows),
+            "results": results
+        }), 200
+
+    except Overloaded as e:
+        return overloaded(e)
+    except Exception as e:
+        logger.exception("Error in detect_disease_batch: %s", e)
+        return jsonify({"error": "Server error. Please try again."}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = get_user_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
+
+@app.route('/api/jobs/<job_id>/stream', methods=['GET'])
+def stream_job(job_id):
+    if get_user_job(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+    return Response(stream_with_context(job_queue.stream(job_id)), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     return jsonify({
@@ -175,27 +260,54 @@ def health_check():
         "timestamp": datetime.now().isoformat()
     }), 200
 
+@app.route('/api/crops', methods=['GET'])
+@conditional(lambda: catalog.version, shared=True)
+def search_crops():
+    # Prefix/infix search over the advisory catalog; risk and type are facets
+    with stage('search'):
+        results = catalog.search(
+            request.args.get('q', ''),
+            {facet: request.args.get(facet) for facet in FACETS},
+            request.args.get('page', 1, type=int),
+            request.args.get('per_page', type=int)
+        )
+    return jsonify(results), 200
+
 @app.route('/api/history', methods=['GET'])
+@conditional(lambda: history_version(db.get_connection(DATABASE), request.args.get('email', 'anonymous')))
 def get_analysis_history():
     try:
         user_email = request.args.get('email', 'anonymous')
-        conn = sqlite3.connect(DATABASE)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, disease, confidence, description, created_at 
-            FROM analysis_results 
-            WHERE user_email = ? 
-            ORDER BY created_at DESC 
-            LIMIT 50
-        ''', (user_email,))
-        results = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return jsonify({"user": user_email, "results": results, "count": len(results)}), 200
+        limit = request.args.get('limit', type=int)
+        before = request.args.get('before')
+        results, next_cursor = fetch_history_page(db.get_connection(DATABASE), user_email, disease_catalog, limit, before)
+        return jsonify({
+            "user": user_email,
+            "results": results,
+            "count": len(results),
+            "next_cursor": next_cursor
+        }), 200
+    except InvalidCursor:
+        return jsonify({"error": "Invalid cursor"}), 400
     except Exception as e:
         logger.exception("Error fetching history: %s", e)
         return jsonify({"error": "Failed to fetch history"}), 500
 
+@app.route('/api/stats', methods=['GET'])
+@conditional(lambda: rollups.stats_version(db.get_connection(DATABASE), request.args.get('period', 'day')))
+def get_stats():
+    """Detection counts per day (?period=day&span=30) or hour (?period=hour&span=48), with ?email= for a user's own"""
+    try:
+        with stage('stats'):
+            payload = rollups.stats(db.get_connection(DATABASE), request.args.get('email'), disease_catalog,
+                                    request.args.get('period', 'day'), request.args.get('span', type=int))
+        return jsonify(payload), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.exception("Error fetching stats: %s", e)
+        return jsonify({"error": "Failed to fetch stats"}), 500
+
 @app.errorhandler(413)
 def too_large(e):
     logger.warning("File upload exceeded limit")
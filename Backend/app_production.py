@@ -10,7 +10,9 @@ import os
 import random
 import logging
 from datetime import datetime
-import sqlite3
+
+import db
+import migrations
 
 # ============================================================================
 # APP CONFIGURATION
@@ -53,47 +55,16 @@ logger = logging.getLogger(__name__)
 # DATABASE SETUP
 # ============================================================================
 
+DATABASE = os.path.join(os.path.dirname(__file__), 'crop_portal.db')
+
 def get_db_connection():
-    """Create a database connection"""
-    db_path = os.path.join(os.path.dirname(__file__), 'crop_portal.db')
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Return this thread's pooled database connection (do not close it)"""
+    return db.get_connection(DATABASE)
 
 def init_db():
-    """Initialize database tables"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            name TEXT NOT NULL,
-            password_hash TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Analysis results table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS analysis_results (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_email TEXT,
-            disease TEXT NOT NULL,
-            confidence REAL NOT NULL,
-            description TEXT,
-            treatment TEXT,
-            filename TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_email) REFERENCES users (email)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
-    logger.info('[+] Database initialized successfully')
+    """Bring the shared schema up to date (see migrations.py); app.py and app_v2_jwt.py use the same file"""
+    version = migrations.ensure(DATABASE)
+    logger.info(f'[+] Database at schema version {version}: {DATABASE}')
 
 # ============================================================================
 # DISEASE DATABASE (Mock AI Model)
@@ -1,22 +1,37 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from datetime import datetime, timedelta
-import time
-import random
 import os
 import logging
-import sqlite3
-import json
 import jwt
 import functools
 
+import db
+from imaging import InvalidImage, inspect_image
+from upload_store import UploadStore
+from batch_upload import BatchTooLarge, MalformedBatch, parse_batch, max_body_length
+from pagination import InvalidCursor, fetch_history_page, history_version
+from crop_catalog import CropCatalog, FACETS
+from detection import DetectionPipeline
+import migrations
+import rollups
+from token_cache import VerifiedTokenCache
+from passwords import PasswordHasher, PasswordHasherBusy
+import metrics
+from metrics import stage
+import http_cache
+from http_cache import conditional
+from admission import Overloaded, admit, charge_images, overloaded
+
 app = Flask(__name__)
 
 # ==========================================
 # CONFIGURATION
 # ==========================================
 CORS(app)
+metrics.init_app(app)  # /api/metrics, per-stage timings and Server-Timing headers
+http_cache.init_app(app)  # gzip JSON/text responses over COMPRESS_MIN_BYTES
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5MB file limit
 app.config['JWT_SECRET'] = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 app.config['JWT_ALGORITHM'] = 'HS256'
@@ -28,6 +43,7 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
 
 # Create upload folder if doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+upload_store = UploadStore(UPLOAD_FOLDER)
 
 # Setup logging
 logging.basicConfig(
@@ -44,43 +60,19 @@ logger = logging.getLogger(__name__)
 # DATABASE INITIALIZATION
 # ==========================================
 def init_db():
-    """Initialize SQLite database with required tables"""
+    """Bring the schema up to date; once it is, this only reads PRAGMA user_version (see migrations.py)"""
     try:
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        # Users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email TEXT UNIQUE NOT NULL,
-                name TEXT NOT NULL,
-                password_hash TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Analysis results table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS analysis_results (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_email TEXT,
-                disease TEXT NOT NULL,
-                confidence REAL NOT NULL,
-                description TEXT,
-                treatment TEXT,
-                filename TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_email) REFERENCES users(email)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
-        logger.info("[+] Database initialized successfully")
+        version = migrations.ensure(DATABASE)
+        logger.info(f"[+] Database at schema version {version}")
+    except migrations.SchemaOutdated:
+        raise
     except Exception as e:
         logger.error(f"Database initialization error: {str(e)}")
 
+# On import, not only under __main__: gunicorn workers need the schema too.
+# Gunicorn migrates in the master before forking, so this is a version check
+init_db()
+
 # ==========================================
 # JWT AUTHENTICATION
 # ==========================================
@@ -99,15 +91,25 @@ def generate_token(email, name):
         logger.error(f"Token generation error: {str(e)}")
         return None
 
+# PBKDF2/scrypt work runs on a bounded pool; see passwords.py
+password_hasher = PasswordHasher()
+
+# Verified tokens are reused for up to TOKEN_CACHE_TTL seconds; see token_cache.py
+token_cache = VerifiedTokenCache()
+
 def verify_token(token):
     """Verify JWT token and return payload"""
+    payload = token_cache.get(token)
+    if payload is not None:
+        return dict(payload)
     try:
         payload = jwt.decode(token, app.config['JWT_SECRET'], algorithms=[app.config['JWT_ALGORITHM']])
-        return payload
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
+    token_cache.put(token, payload)
+    return dict(payload)
 
 def require_auth(f):
     """Decorator to require JWT authentication"""
@@ -126,7 +128,8 @@ def require_auth(f):
         if not token:
             return jsonify({"error": "Missing authentication token"}), 401
         
-        payload = verify_token(token)
+        with stage('auth'):
+            payload = verify_token(token)
         if not payload:
             return jsonify({"error": "Invalid or expired token"}), 401
         
@@ -137,38 +140,15 @@ def require_auth(f):
     return decorated
 
 # ==========================================
-# DISEASE DATABASE
+# DETECTION PIPELINE
 # ==========================================
-DISEASE_DB = [
-    {
-        "disease": "Potato Early Blight",
-        "confidence": 0.94,
-        "description": "Fungal infection characterized by concentric rings on dark spots.",
-        "treatment": ["Apply copper-based fungicides", "Improve air circulation", "Remove infected leaves"],
-        "severity": "High"
-    },
-    {
-        "disease": "Corn Common Rust",
-        "confidence": 0.88,
-        "description": "Reddish-brown pustules appearing on both leaf surfaces.",
-        "treatment": ["Plant resistant varieties", "Apply fungicides early", "Crop rotation"],
-        "severity": "Medium"
-    },
-    {
-        "disease": "Tomato Mosaic Virus",
-        "confidence": 0.91,
-        "description": "Mottling and yellowing of leaves with stunted growth.",
-        "treatment": ["Remove infected plants", "Control aphids", "Disinfect tools"],
-        "severity": "High"
-    },
-    {
-        "disease": "Healthy",
-        "confidence": 0.98,
-        "description": "No signs of disease detected. Plant looks vigorous.",
-        "treatment": ["Continue regular watering", "Monitor weekly", "Maintain soil nutrition"],
-        "severity": "None"
-    }
-]
+# Cache, inference, result writes and async jobs, shared with app.py; see detection.py
+pipeline = DetectionPipeline(DATABASE, upload_store)
+pipeline.init_app(app)  # job workers, /api/inference/stats, /api/trends, /api/metrics
+disease_catalog = pipeline.disease_catalog
+job_queue = pipeline.job_queue
+# Advisory catalog index for /api/crops; rebuilt when crops.json changes
+catalog = CropCatalog()
 
 # ==========================================
 # UTILITY FUNCTIONS
@@ -177,30 +157,12 @@ def allowed_file(filename):
     """Check if file has allowed extension"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def save_analysis_result(user_email, result, filename):
-    """Save analysis result to database"""
-    try:
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO analysis_results 
-            (user_email, disease, confidence, description, treatment, filename)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            user_email,
-            result.get('disease'),
-            result.get('confidence'),
-            result.get('description'),
-            json.dumps(result.get('treatment', [])),
-            filename
-        ))
-        
-        conn.commit()
-        conn.close()
-        logger.info(f"Analysis result saved for {user_email}")
-    except Exception as e:
-        logger.error(f"Error saving analysis result: {str(e)}")
+def get_user_job(job_id):
+    """Return a job only if it belongs to the authenticated user"""
+    job = job_queue.get(job_id)
+    if job is None or job['user_email'] != request.user['email']:
+        return None
+    return job
 
 # ==========================================
 # API ROUTES - PUBLIC
@@ -223,9 +185,28 @@ def health_check():
         "timestamp": datetime.now().isoformat()
     }), 200
 
+@app.route('/api/crops', methods=['GET'])
+@conditional(lambda: catalog.version, shared=True)
+def search_crops():
+    """Search the advisory catalog by name, crop, type and description; filter on risk and type"""
+    with stage('search'):
+        results = catalog.search(
+            request.args.get('q', ''),
+            {facet: request.args.get(facet) for facet in FACETS},
+            request.args.get('page', 1, type=int),
+            request.args.get('per_page', type=int)
+        )
+    return jsonify(results), 200
+
 # ==========================================
 # API ROUTES - AUTHENTICATION
 # ==========================================
+def update_password_hash(email, password_hash):
+    """Store a re-hashed password (called from the hashing pool)"""
+    with db.transaction(DATABASE) as conn:
+        conn.execute('UPDATE users SET password_hash = ? WHERE email = ?', (password_hash, email))
+    logger.info(f"Password hash upgraded for {email}")
+
 @app.route('/api/auth/register', methods=['POST'])
 def register():
     """Register a new user"""
@@ -239,25 +220,25 @@ def register():
         name = data['name']
         password = data['password']
         
-        # Check if user already exists
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
-        
-        if cursor.fetchone():
-            conn.close()
+        # Cheap duplicate check before spending CPU on the hash
+        conn = db.get_connection(DATABASE)
+        existing = conn.execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone()
+        
+        if not existing:
+            password_hash = password_hasher.hash(password)
+            # Re-check and insert in one write transaction so concurrent registrations cannot race
+            with db.transaction(DATABASE, immediate=True) as conn:
+                existing = conn.execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone()
+                if not existing:
+                    conn.execute('''
+                        INSERT INTO users (email, name, password_hash)
+                        VALUES (?, ?, ?)
+                    ''', (email, name, password_hash))
+        
+        if existing:
             logger.warning(f"Registration attempt with existing email: {email}")
             return jsonify({"error": "User already exists"}), 409
         
-        # Insert new user (in production, hash the password!)
-        cursor.execute('''
-            INSERT INTO users (email, name, password_hash)
-            VALUES (?, ?, ?)
-        ''', (email, name, password))  # TODO: Use werkzeug.security.generate_password_hash
-        
-        conn.commit()
-        conn.close()
-        
         logger.info(f"New user registered: {email}")
         
         # Generate token
@@ -269,6 +250,9 @@ def register():
             "user": {"email": email, "name": name}
         }), 201
         
+    except PasswordHasherBusy:
+        logger.warning("Password hashing pool saturated during registration")
+        return jsonify({"error": "Server busy. Please try again."}), 503, {"Retry-After": "1"}
     except Exception as e:
         logger.error(f"Registration error: {str(e)}")
         return jsonify({"error": "Registration failed"}), 500
@@ -286,17 +270,18 @@ def login():
         password = data['password']
         
         # Verify credentials
-        conn = sqlite3.connect(DATABASE)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
-        user = cursor.fetchone()
-        conn.close()
-        
-        if not user or user['password_hash'] != password:  # TODO: Use werkzeug.security.check_password_hash
+        conn = db.get_connection(DATABASE)
+        user = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
+        
+        valid, needs_rehash = password_hasher.verify(user['password_hash'], password) if user else (False, False)
+        if not valid:
             logger.warning(f"Failed login attempt for {email}")
             return jsonify({"error": "Invalid credentials"}), 401
         
+        # Upgrade plaintext rows and old work factors without delaying this login
+        if needs_rehash:
+            password_hasher.rehash_later(password, lambda new_hash: update_password_hash(email, new_hash))
+        
         logger.info(f"User logged in: {email}")
         
         # Generate token
@@ -308,10 +293,19 @@ def login():
             "user": {"email": email, "name": user['name']}
         }), 200
         
+    except PasswordHasherBusy:
+        logger.warning("Password hashing pool saturated during login")
+        return jsonify({"error": "Server busy. Please try again."}), 503, {"Retry-After": "1"}
     except Exception as e:
         logger.error(f"Login error: {str(e)}")
         return jsonify({"error": "Login failed"}), 500
 
+@app.route('/api/auth/stats', methods=['GET'])
+@require_auth
+def auth_stats():
+    """Verified-token cache hit rates"""
+    return jsonify({"token_cache": token_cache.stats()}), 200
+
 @app.route('/api/auth/verify', methods=['GET'])
 @require_auth
 def verify_auth():
@@ -326,21 +320,24 @@ def verify_auth():
 # ==========================================
 @app.route('/api/detect', methods=['POST'])
 @require_auth
+@admit(user=lambda: request.user['email'])
 def detect_disease():
     """
     Detect crop disease from uploaded image
     - Requires authentication
     - Validates file type and size
-    - Simulates AI processing
+    - Runs model inference
     - Saves result to database
     """
     try:
-        # 1. VALIDATION: Check if image was sent
-        if 'imageFile' not in request.files:
+        # 1. VALIDATION: Check if image was sent (the first access to request.files reads the body)
+        with stage('receive'):
+            files = request.files
+        if 'imageFile' not in files:
             logger.warning("Disease detection attempted without file")
             return jsonify({"error": "No file uploaded"}), 400
         
-        file = request.files['imageFile']
+        file = files['imageFile']
         
         # 2. VALIDATION: Check filename is not empty
         if file.filename == '':
@@ -354,25 +351,47 @@ def detect_disease():
                 "error": f"Invalid file type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"
             }), 400
         
+        # 4. VALIDATION: Check the header really is an image, before anything is written
+        try:
+            with stage('validate'):
+                image_format, (width, height) = inspect_image(file.stream)
+        except InvalidImage as e:
+            logger.warning(f"Rejected upload {file.filename}: {e}")
+            return jsonify({"error": "File is not a valid image"}), 400
+        
         user_email = request.user['email']
         filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filepath = os.path.join(UPLOAD_FOLDER, f"{timestamp}_{filename}")
-        
-        logger.info(f"Processing image: {file.filename} for user: {user_email}")
+        ext = file.filename.rsplit('.', 1)[1].lower()
         
-        # 5. SAVE FILE
-        file.save(filepath)
-        logger.info(f"File saved to: {filepath}")
+        logger.info(f"Processing {image_format} {width}x{height} image: {file.filename} for user: {user_email}")
         
-        # 6. SIMULATE AI PROCESSING TIME
-        time.sleep(2)
+        # 5. SAVE FILE (content-addressed: identical photos are stored once)
+        with stage('save'):
+            stored = upload_store.save(file.stream, ext)
+        filepath = stored.path
+        logger.info(f"File stored at: {filepath} ({stored.size} bytes, new={stored.created})")
         
-        # 7. GET DIAGNOSIS (Mock - replace with real AI model)
-        result = random.choice(DISEASE_DB)
+        # 6. ASYNC MODE: queue the job and return immediately
+        if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+            job_id = job_queue.submit(user_email, filename, filepath)
+            logger.info(f"Queued detection job {job_id} for {user_email}")
+            return jsonify({
+                "job_id": job_id,
+                "status": "queued",
+                "status_url": f"/api/jobs/{job_id}",
+                "stream_url": f"/api/jobs/{job_id}/stream"
+            }), 202, {"Location": f"/api/jobs/{job_id}"}
+        
+        # 7. RUN INFERENCE (skipped when this exact image was diagnosed before)
+        try:
+            result = pipeline.run_diagnosis(stored.digest, filepath, user_email)
+        except InvalidImage:
+            logger.warning(f"Unreadable image: {filename}")
+            return jsonify({"error": "File is not a valid image"}), 400
         
         # 8. SAVE TO DATABASE
-        save_analysis_result(user_email, result, filename)
+        with stage('save_result'):
+            pipeline.save_analysis_result(user_email, result, filename)
         
         # 9. RETURN RESPONSE
         response = {
@@ -384,42 +403,157 @@ def detect_disease():
         logger.info(f"Detection result: {result['disease']} ({result['confidence']*100}% confidence)")
         return jsonify(response), 200
         
+    except Overloaded as e:
+        return overloaded(e)
     except Exception as e:
         logger.error(f"Error in detect_disease: {str(e)}", exc_info=True)
         return jsonify({"error": "Server error. Please try again."}), 500
 
-@app.route('/api/history', methods=['GET'])
+@app.route('/api/detect/batch', methods=['POST'])
 @require_auth
-def get_analysis_history():
-    """Get analysis history for authenticated user"""
+@admit(user=lambda: request.user['email'])
+def detect_disease_batch():
+    """
+    Detect crop disease for many images in one request
+    - Requires authentication (checked once for the whole batch)
+    - Streams imageFile parts straight into the upload store
+    - Runs inference in vectorized batches
+    - Saves all results in one transaction
+    - Reports success or an error for each image
+    """
+    # Batches may be far larger than the single-upload MAX_CONTENT_LENGTH
+    request.max_content_length = max_body_length()
     try:
         user_email = request.user['email']
-        limit = request.args.get('limit', 50, type=int)
         
-        conn = sqlite3.connect(DATABASE)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        # 1. PARSE & STORE: limits are enforced while the body is read
+        try:
+            with stage('receive'):
+                fields, items = parse_batch(request, upload_store, ALLOWED_EXTENSIONS)
+        except BatchTooLarge as e:
+            logger.warning(f"Rejected batch upload from {user_email}: {e}")
+            return jsonify({"error": str(e)}), 413
+        except MalformedBatch as e:
+            logger.warning(f"Malformed batch upload from {user_email}: {e}")
+            return jsonify({"error": "Malformed multipart body"}), 400
+        
+        if not items:
+            logger.warning("Batch detection attempted without files")
+            return jsonify({"error": "No file uploaded"}), 400
         
-        cursor.execute('''
-            SELECT id, disease, confidence, description, created_at 
-            FROM analysis_results 
-            WHERE user_email = ? 
-            ORDER BY created_at DESC 
-            LIMIT ?
-        ''', (user_email, limit))
+        # 2. RATE LIMIT: @admit() took one token for the request; charge the other images
+        charge_images(len(items) - 1)
+        
+        # 3. RUN INFERENCE on every image that was stored
+        stored = [item for item in items if item.stored is not None]
+        with stage('inference'):
+            outcomes = dict(zip(
+                (item.index for item in stored),
+                pipeline.run_batch_diagnosis([item.stored for item in stored], user_email)
+            ))
+        
+        # 4. BUILD PER-IMAGE RESULTS
+        timestamp = datetime.now().isoformat()
+        results, rows = [], []
+        for item in items:
+            filename = secure_filename(item.filename or '')
+            outcome = item.error or outcomes[item.index]
+            if isinstance(outcome, InvalidImage):
+                outcome = "File is not a valid image"
+            if isinstance(outcome, str):
+                results.append({"index": item.index, "filename": filename, "error": outcome})
+                continue
+            results.append({**outcome, "index": item.index, "filename": filename, "timestamp": timestamp})
+            rows.append(pipeline.analysis_row(user_email, outcome, filename))
+        
+        # 5. SAVE TO DATABASE
+        with stage('save_result'):
+            pipeline.save_analysis_results(user_email, rows)
+        
+        logger.info(f"Batch detection for {user_email}: {len(rows)} of {len(items)} images diagnosed")
+        return jsonify({
+            "count": len(items),
+            "succeeded": len(rows),
+            "failed": len(items) - len(rows),
+            "results": results
+        }), 200
         
-        results = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+    except Overloaded as e:
+        return overloaded(e)
+    except Exception as e:
+        logger.error(f"Error in detect_disease_batch: {str(e)}", exc_info=True)
+        return jsonify({"error": "Server error. Please try again."}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@require_auth
+def get_job(job_id):
+    """Poll an async detection job"""
+    job = get_user_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
+
+@app.route('/api/jobs/<job_id>/stream', methods=['GET'])
+@require_auth
+def stream_job(job_id):
+    """Server-Sent Events stream of job progress and the final result"""
+    if get_user_job(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+    return Response(
+        stream_with_context(job_queue.stream(job_id)),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route('/api/history', methods=['GET'])
+@require_auth
+@conditional(lambda: (request.user['email'], history_version(db.get_connection(DATABASE), request.user['email'])))
+def get_analysis_history():
+    """
+    Get analysis history for authenticated user, newest first
+    - ?limit=<n> page size (default 50, max 200)
+    - ?before=<cursor> continue from the next_cursor of the previous page
+    """
+    try:
+        user_email = request.user['email']
+        limit = request.args.get('limit', type=int)
+        before = request.args.get('before')
+        
+        results, next_cursor = fetch_history_page(db.get_connection(DATABASE), user_email, disease_catalog, limit, before)
         
         return jsonify({
             "user": user_email,
             "results": results,
-            "count": len(results)
+            "count": len(results),
+            "next_cursor": next_cursor
         }), 200
+    except InvalidCursor:
+        return jsonify({"error": "Invalid cursor"}), 400
     except Exception as e:
         logger.error(f"Error fetching history: {str(e)}")
         return jsonify({"error": "Failed to fetch history"}), 500
 
+@app.route('/api/stats', methods=['GET'])
+@require_auth
+@conditional(lambda: (request.user['email'],
+                      rollups.stats_version(db.get_connection(DATABASE), request.args.get('period', 'day'))))
+def get_stats():
+    """
+    Detection counts for the authenticated user and for everyone, read from the rollups
+    - ?period=day|hour bucket size (default day)
+    - ?span=<n> buckets ending with the current one (default 30 days / 48 hours)
+    """
+    try:
+        with stage('stats'):
+            payload = rollups.stats(db.get_connection(DATABASE), request.user['email'], disease_catalog,
+                                    request.args.get('period', 'day'), request.args.get('span', type=int))
+        return jsonify(payload), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error fetching stats: {str(e)}")
+        return jsonify({"error": "Failed to fetch stats"}), 500
+
 # ==========================================
 # ERROR HANDLERS
 # ==========================================
@@ -444,7 +578,6 @@ def internal_error(e):
 # INITIALIZATION
 # ==========================================
 if __name__ == '__main__':
-    init_db()
     logger.info("[*] Starting Crop Portal Backend v2.0...")
     logger.info("[+] File Upload Validation: Enabled")
     logger.info("[+] JWT Authentication: Enabled")
@@ -452,5 +585,6 @@ if __name__ == '__main__':
     logger.info("[+] Max File Size: 5MB")
     logger.info("[+] Allowed formats: PNG, JPG, JPEG, GIF, BMP")
     logger.info("[+] Database: SQLite initialized")
-    logger.info("[!] WARNING: Using demo password hash. Use werkzeug.security in production!")
+    logger.info(f"[+] Password hashing: {password_hasher.method} ({password_hasher.workers} threads, "
+                f"{password_hasher.concurrency} at once per host)")
     app.run(debug=True, port=5000)
@@ -0,0 +1,245 @@
+"""
+ASGI entry point for the Flask API
+With gunicorn's sync workers a client uploading 5 MB over a slow mobile
+link holds a whole worker for the length of the upload, and /api/history
+or /api/health queue behind it. Served from here, the event loop reads
+request bodies (spooling large ones to a temporary file) and only hands a
+request to the WSGI app once its body is complete. Routes then run on a
+bounded thread pool, so DB queries, hashing and inference never block the
+loop and a slow client costs a coroutine instead of a worker. Responses are
+pulled from the app one chunk at a time on the pool and written back
+from the loop, so slow downloads do not hold a thread either.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 4
+    GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn -c gunicorn_config.py asgi:app
+
+ASGI_WSGI_APP picks the Flask app to serve (app:app or app_v2_jwt:app).
+uvicorn is only needed to serve this module; nothing else imports it.
+"""
+
+import os
+import sys
+import json
+import asyncio
+import logging
+import tempfile
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.utils import import_string
+
+from batch_upload import max_body_length
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+ASGI_WSGI_APP = os.getenv('ASGI_WSGI_APP', 'app:app')
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', 16))
+# Bodies up to this size stay in memory; larger ones spool to a temporary file
+ASGI_SPOOL_BYTES = int(os.getenv('ASGI_SPOOL_BYTES', 64 * 1024))
+# A client that sends nothing for this long is dropped with 408
+ASGI_RECEIVE_TIMEOUT = float(os.getenv('ASGI_RECEIVE_TIMEOUT', 60))
+
+
+class _RequestTimeout(Exception):
+    pass
+
+
+class WsgiToAsgi:
+    """Serve a WSGI app over ASGI: bodies are read on the loop, the app runs on a bounded pool"""
+
+    def __init__(self, wsgi_app, threads=ASGI_THREADS, max_body=None, spool_bytes=ASGI_SPOOL_BYTES,
+                 receive_timeout=ASGI_RECEIVE_TIMEOUT):
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        # Largest body any route accepts; routes still apply their own limits
+        self.max_body = max_body if max_body is not None else max_body_length()
+        self.spool_bytes = spool_bytes
+        self.receive_timeout = receive_timeout
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        # Executor threads do not survive fork; each worker process builds its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='asgi')
+                    self._pid = os.getpid()
+        return self._executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        else:
+            raise ValueError(f"Unsupported ASGI scope type '{scope['type']}'")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._executor is not None and self._pid == os.getpid():
+                    self._executor.shutdown(wait=True)
+                    self._executor = self._pid = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # ------------------------------------------------------------------ request
+
+    async def _http(self, scope, receive, send):
+        declared = _content_length(scope)
+        if declared is not None and declared > self.max_body:
+            await _send_error(send, 413, "Request body too large")
+            return
+
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        try:
+            try:
+                size = await self._read_body(receive, body)
+            except _RequestTimeout:
+                await _send_error(send, 408, "Request body timed out")
+                return
+            if size is None:
+                return  # client went away before the body was complete
+            if size > self.max_body:
+                await _send_error(send, 413, "Request body too large")
+                return
+            body.seek(0)
+            await self._run_app(_environ(scope, body, size), send)
+        finally:
+            body.close()
+
+    async def _read_body(self, receive, body):
+        """Copy the request body into `body`; None if the client disconnected"""
+        size = 0
+        while True:
+            try:
+                message = await asyncio.wait_for(receive(), self.receive_timeout)
+            except asyncio.TimeoutError:
+                raise _RequestTimeout()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            if chunk:
+                size += len(chunk)
+                if size > self.max_body:
+                    return size
+                body.write(chunk)
+            if not message.get('more_body', False):
+                return size
+
+    # ----------------------------------------------------------------- response
+
+    async def _run_app(self, environ, send):
+        loop = asyncio.get_running_loop()
+        pool = self._pool()
+        # Flask keeps the request context in context variables, and streamed
+        # responses resume on whichever pool thread is free: run every step of
+        # one request in the same Context
+        context = contextvars.copy_context()
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            started['status'], started['headers'] = status, headers
+            return _no_write
+
+        def call_app():
+            iterable = self.wsgi_app(environ, start_response)
+            iterator = iter(iterable)
+            return iterable, iterator, next(iterator, None)
+
+        def step(fn, *args):
+            return loop.run_in_executor(pool, context.run, fn, *args)
+
+        iterable, iterator, chunk = await step(call_app)
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': int(started['status'].split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in started['headers']],
+            })
+            started['sent'] = True
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await step(next, iterator, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        except OSError as e:
+            logger.info("Client disconnected mid-response: %s", e)
+        finally:
+            if hasattr(iterable, 'close'):
+                await step(iterable.close)
+
+
+def _no_write(data):
+    raise NotImplementedError("the WSGI write() callable is not supported; return an iterable")
+
+
+def _content_length(scope):
+    for name, value in scope['headers']:
+        if name == b'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+def _environ(scope, body, size):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    # PEP 3333: paths are native strings holding the raw bytes as latin-1
+    path = scope['path'].encode('utf-8').decode('latin-1')
+    root = scope.get('root_path', '').encode('utf-8').decode('latin-1')
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root,
+        'PATH_INFO': path[len(root):] if root and path.startswith(root) else path,
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(size),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue  # replaced by the number of bytes actually received
+        key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def _send_error(send, status, message):
+    body = json.dumps({"error": message}).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode()),
+                            (b'connection', b'close')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+app = WsgiToAsgi(import_string(ASGI_WSGI_APP))
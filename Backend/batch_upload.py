@@ -0,0 +1,142 @@
+"""
+Streaming multipart parsing for batch detection
+A batch body can carry dozens of photos. Parts are decoded from the request
+stream as they arrive and written straight into the upload store, so the
+body is never held in memory, and the image-count and byte limits are
+enforced while reading instead of after the whole body has been spooled.
+"""
+
+import os
+from collections import namedtuple
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Epilogue, Field, File, Data
+
+from imaging import InvalidImage, inspect_image
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+BATCH_MAX_IMAGES = int(os.getenv('BATCH_MAX_IMAGES', 50))
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', 64 * 1024 * 1024))
+
+FIELD_MAX_BYTES = 64 * 1024     # non-file form fields such as userEmail
+READ_CHUNK = 64 * 1024
+# Bound on the decoder's internal buffer (one read plus a partial boundary)
+DECODER_BUFFER_BYTES = 4 * READ_CHUNK
+# Part headers and boundaries on top of the file bytes themselves
+BODY_OVERHEAD_BYTES = 1024 * 1024
+
+# One per file part, in upload order; exactly one of stored / error is set
+BatchItem = namedtuple('BatchItem', ['index', 'filename', 'stored', 'error'])
+
+
+class BatchTooLarge(Exception):
+    """The batch exceeds BATCH_MAX_IMAGES or BATCH_MAX_BYTES"""
+
+
+class MalformedBatch(ValueError):
+    """The body is not a complete multipart/form-data message"""
+
+
+def max_body_length(max_bytes=BATCH_MAX_BYTES):
+    """Value for request.max_content_length on batch routes"""
+    return max_bytes + BODY_OVERHEAD_BYTES
+
+
+def parse_batch(request, store, allowed_extensions, field_name='imageFile',
+                max_images=BATCH_MAX_IMAGES, max_bytes=BATCH_MAX_BYTES):
+    """
+    Read a request's multipart body into the upload store
+    Returns (fields, items): the small form fields as a dict and one BatchItem
+    per `field_name` file part. A part that is empty, has a disallowed
+    extension or is not an image gets an error; the rest of the batch still
+    goes through. Exceeding a limit aborts the whole batch with BatchTooLarge.
+    """
+    mimetype, options = parse_options_header(request.content_type or '')
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        raise MalformedBatch("Expected a multipart/form-data body")
+
+    decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size=DECODER_BUFFER_BYTES)
+    fields, items = {}, []
+    part = field_chunks = writer = None
+    error = None
+    total = 0
+    try:
+        # Raises RequestEntityTooLarge up front when Content-Length is over the limit
+        stream = request.stream
+        while True:
+            chunk = stream.read(READ_CHUNK)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, Field):
+                    part, field_chunks = event, []
+                elif isinstance(event, File):
+                    part, field_chunks, error = event, None, None
+                    if event.name == field_name:
+                        if len(items) >= max_images:
+                            raise BatchTooLarge(f"At most {max_images} images per batch")
+                        error = _check_filename(event.filename, allowed_extensions)
+                        if error is None:
+                            writer = store.writer()
+                elif isinstance(event, Data):
+                    if field_chunks is not None:
+                        field_chunks.append(event.data)
+                        if sum(map(len, field_chunks)) > FIELD_MAX_BYTES:
+                            raise BatchTooLarge(f"Form field '{part.name}' is too large")
+                    else:
+                        total += len(event.data)
+                        if total > max_bytes:
+                            raise BatchTooLarge(f"Batch exceeds {max_bytes} bytes of images")
+                        if writer is not None:
+                            writer.write(event.data)
+                    if not event.more_data:
+                        if field_chunks is not None:
+                            fields[part.name] = b''.join(field_chunks).decode('utf-8', 'replace')
+                        elif part.name == field_name:
+                            items.append(_finish_file(len(items), part.filename, writer, error))
+                            writer = None
+                event = decoder.next_event()
+            if isinstance(event, Epilogue):
+                break
+            if not chunk:
+                raise MalformedBatch("Body ended before the closing boundary")
+    except RequestEntityTooLarge:
+        raise BatchTooLarge("Batch body is too large")
+    except ValueError as e:
+        # MultipartDecoder reports truncated or garbled bodies as ValueError
+        if isinstance(e, MalformedBatch):
+            raise
+        raise MalformedBatch(str(e))
+    finally:
+        if writer is not None:
+            writer.discard()
+    return fields, items
+
+
+def _check_filename(filename, allowed_extensions):
+    if not filename:
+        return "No file selected"
+    if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
+        return f"Invalid file type. Allowed: {', '.join(sorted(allowed_extensions))}"
+    return None
+
+
+def _finish_file(index, filename, writer, error):
+    if error is not None:
+        return BatchItem(index, filename, None, error)
+    if writer.size == 0:
+        writer.discard()
+        return BatchItem(index, filename, None, "Empty file")
+    writer.close()
+    try:
+        with open(writer.tmp_path, 'rb') as f:
+            inspect_image(f)
+    except InvalidImage:
+        writer.discard()
+        return BatchItem(index, filename, None, "File is not a valid image")
+    return BatchItem(index, filename, writer.commit(filename.rsplit('.', 1)[1]), None)
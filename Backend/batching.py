@@ -0,0 +1,222 @@
+"""
+Dynamic micro-batching in front of the inference engine
+Concurrent detect calls in one process are gathered into a single vectorized forward pass
+"""
+
+import os
+import bisect
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', 8))
+BATCH_MAX_WAIT_MS = float(os.getenv('BATCH_MAX_WAIT_MS', 10))
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+QUEUE_WAIT_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 250)
+
+# ============================================================================
+# HISTOGRAM
+# ============================================================================
+
+class Histogram:
+    """Cumulative-bucket histogram (Prometheus style 'le' buckets)"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+        cumulative, running = {}, 0
+        for bound, n in zip(self.buckets + ('+Inf',), counts):
+            running += n
+            cumulative[str(bound)] = running
+        return {
+            'buckets': cumulative,
+            'count': count,
+            'sum': round(total, 4),
+            'mean': round(total / count, 4) if count else 0.0,
+        }
+
+# ============================================================================
+# BATCHER
+# ============================================================================
+
+class _Pending:
+    __slots__ = ('image', 'enqueued', 'done', 'result', 'error')
+
+    def __init__(self, image):
+        self.image = image
+        self.enqueued = time.monotonic()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Gathers single-image requests into batches of up to max_batch_size
+    A batch is closed when it is full, when the oldest request has waited
+    max_wait_ms, or when no other request is on its way. Callers that go
+    through predict() announce themselves before preprocessing, so a lone
+    request in a sync worker is never held back waiting for company.
+    """
+
+    def __init__(self, engine, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS):
+        self.engine = engine
+        self.max_batch_size = max(1, min(max_batch_size, engine.max_batch_size))
+        self.max_wait = max_wait_ms / 1000.0
+
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.queue_wait_ms = Histogram(QUEUE_WAIT_BUCKETS_MS)
+
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._expected = 0
+        self._thread = None
+        self._pid = None
+
+    # ---------------------------------------------------------------- callers
+
+    def announce(self, count=1):
+        """Tell the batcher images are on their way, so a batch may wait for them"""
+        self._ensure_worker()
+        with self._cond:
+            self._expected += count
+
+    def withdraw(self, count=1):
+        """Cancel an announce() whose images will never be submitted"""
+        with self._cond:
+            self._expected = max(0, self._expected - count)
+            self._cond.notify()
+
+    def predict(self, source, timings=None):
+        """Preprocess an image and classify it as part of the next batch (timings: see preprocess())"""
+        self.announce()
+        try:
+            image = self.engine.preprocess(source, timings)
+        except BaseException:
+            self.withdraw()
+            raise
+        return self._wait(self._enqueue(image))
+
+    def submit(self, image, announced=False):
+        """Classify an already preprocessed image as part of the next batch"""
+        if not announced:
+            self.announce()
+        return self._wait(self._enqueue(image))
+
+    def submit_many(self, images, announced=False):
+        """Classify already preprocessed images; they join the next batches together"""
+        if not announced:
+            self.announce(len(images))
+        return [self._wait(item) for item in [self._enqueue(image) for image in images]]
+
+    def _enqueue(self, image):
+        item = _Pending(image)
+        with self._cond:
+            self._queue.append(item)
+            self._cond.notify()
+        return item
+
+    @staticmethod
+    def _wait(item):
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    # ----------------------------------------------------------------- worker
+
+    def _ensure_worker(self):
+        # Threads do not survive fork, so each worker process starts its own
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._cond:
+            if self._pid != os.getpid() or self._thread is None:
+                self._queue.clear()
+                self._expected = 0
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            deadline = self._queue[0].enqueued + self.max_wait
+            while len(self._queue) < self.max_batch_size and self._expected > len(self._queue):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            size = min(len(self._queue), self.max_batch_size)
+            batch = [self._queue.popleft() for _ in range(size)]
+            self._expected -= size
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            started = time.monotonic()
+            for item in batch:
+                self.queue_wait_ms.observe((started - item.enqueued) * 1000.0)
+            self.batch_sizes.observe(len(batch))
+            try:
+                results = self.engine.infer([item.image for item in batch])
+                for item, result in zip(batch, results):
+                    item.result = result
+            except Exception as e:
+                logger.exception("Batch inference failed: %s", e)
+                for item in batch:
+                    item.error = e
+            for item in batch:
+                item.done.set()
+
+    # ------------------------------------------------------------------ stats
+
+    def stats(self):
+        with self._cond:
+            depth = len(self._queue)
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000.0,
+            'queue_depth': depth,
+            'batch_size': self.batch_sizes.snapshot(),
+            'queue_wait_ms': self.queue_wait_ms.snapshot(),
+        }
+
+# ============================================================================
+# PER-PROCESS SINGLETON
+# ============================================================================
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+def get_batcher(engine):
+    """Return this process's batcher for the given engine"""
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = MicroBatcher(engine)
+    return _batcher
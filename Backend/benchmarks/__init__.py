@@ -0,0 +1,4 @@
+"""
+Backend benchmarks
+Run from the Backend directory, e.g. `python -m benchmarks.bench_db`
+"""
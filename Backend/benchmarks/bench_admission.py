@@ -0,0 +1,152 @@
+"""
+Admission control benchmark: what the checks cost, and whether the limits hold
+
+  check         RateLimiter.check() for an IP alone and for an IP plus a
+                user, over --clients distinct clients (µs per call)
+  slot          acquiring and releasing one in-flight slot (µs)
+  request       a trivial route through the Flask test client with and
+                without @admit, so the difference is the per-request cost
+  limits        --processes forked processes hammer one IP bucket for
+                --seconds; the requests let through must not exceed
+                burst + rate * elapsed. Then --processes * 2 requests hold a
+                slot each against a cap of --processes, and exactly the
+                excess must be turned away.
+
+It exits 1 if a limit is exceeded.
+
+    python -m benchmarks.bench_admission
+    python -m benchmarks.bench_admission --processes 8 --seconds 5 --json admission.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+
+def per_call_us(fn, calls):
+    started = time.perf_counter()
+    for i in range(calls):
+        fn(i)
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def _hammer(database, per_minute, burst, seconds, start_event, results):
+    import admission
+    limiter = admission.RateLimiter(database, {'ip': (per_minute, burst)})
+    start_event.wait()
+    allowed = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        if not limiter.check((('ip', '203.0.113.7'),)):
+            allowed += 1
+    results.put(allowed)
+
+
+def _hold(directory, slots, hold_seconds, start_event, results):
+    import admission
+    pool = admission.SlotPool(directory, slots)
+    start_event.wait()
+    slot = pool.acquire(0.05)
+    if slot is not None:
+        time.sleep(hold_seconds)
+        pool.release(slot)
+    results.put(slot is not None)
+
+
+def check_limits(workdir, args):
+    context = multiprocessing.get_context('fork')
+    database = os.path.join(workdir, 'limits.db')
+    start_event, results = context.Event(), context.Queue()
+    workers = [context.Process(target=_hammer, args=(database, args.per_minute, args.burst, args.seconds,
+                                                     start_event, results))
+               for _ in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    started = time.time()
+    start_event.set()
+    allowed = sum(results.get() for _ in workers)
+    elapsed = time.time() - started
+    for worker in workers:
+        worker.join()
+    ceiling = args.burst + args.per_minute / 60.0 * elapsed
+    print(f"{args.processes} processes on one bucket for {elapsed:.1f}s: {allowed} allowed "
+          f"(ceiling {ceiling:.1f} = burst {args.burst} + {args.per_minute:g}/min)")
+
+    directory = os.path.join(workdir, 'slots')
+    start_event, results = context.Event(), context.Queue()
+    holders = [context.Process(target=_hold, args=(directory, args.processes, 0.5, start_event, results))
+               for _ in range(args.processes * 2)]
+    for holder in holders:
+        holder.start()
+    start_event.set()
+    admitted = sum(results.get() for _ in holders)
+    for holder in holders:
+        holder.join()
+    print(f"{len(holders)} concurrent requests against {args.processes} slots: {admitted} admitted")
+    return allowed, ceiling, admitted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=20_000)
+    parser.add_argument('--clients', type=int, default=1000, help='distinct IPs and users in the timed checks')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--per-minute', type=float, default=60.0, help='refill rate of the hammered bucket')
+    parser.add_argument('--burst', type=int, default=20)
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.TemporaryDirectory(prefix='bench-admission-')
+    os.environ['METRICS_DIR'] = workdir.name
+    os.environ['RATE_LIMIT_IP_BURST'] = os.environ['RATE_LIMIT_USER_BURST'] = str(10 ** 9)
+    import admission
+    from flask import Flask
+
+    # Buckets that never run dry, so every timed call takes the allowed path
+    limits = {'ip': (60.0, 10 ** 9), 'user': (30.0, 10 ** 9)}
+    limiter = admission.RateLimiter(os.path.join(workdir.name, 'timing.db'), limits)
+    limiter.check((('ip', 'warmup'),))
+    ips = [f'198.51.100.{i % 250}:{i}' for i in range(args.clients)]
+    users = [f'user{i}@example.com' for i in range(args.clients)]
+    ip_us = per_call_us(lambda i: limiter.check((('ip', ips[i % args.clients]),)), args.calls)
+    both_us = per_call_us(lambda i: limiter.check((('ip', ips[i % args.clients]),
+                                                   ('user', users[i % args.clients]))), args.calls)
+    print(f"rate check: {ip_us:.1f} µs for an IP, {both_us:.1f} µs for an IP and a user "
+          f"({args.clients:,} clients)")
+
+    pool = admission.SlotPool(os.path.join(workdir.name, 'timing-slots'), 4)
+    slot_us = per_call_us(lambda i: pool.release(pool.acquire(0)), args.calls)
+    print(f"in-flight slot: {slot_us:.1f} µs to acquire and release")
+
+    app = Flask(__name__)
+    app.add_url_rule('/plain', 'plain', lambda: 'ok', methods=['POST'])
+    app.add_url_rule('/admitted', 'admitted', admission.admit(user=lambda: 'user@example.com')(lambda: 'ok'),
+                     methods=['POST'])
+    client = app.test_client()
+    requests = max(1000, args.calls // 10)
+    plain_us = per_call_us(lambda i: client.post('/plain'), requests)
+    admitted_us = per_call_us(lambda i: client.post('/admitted'), requests)
+    print(f"test client request: {plain_us:.0f} µs plain, {admitted_us:.0f} µs with @admit "
+          f"(+{admitted_us - plain_us:.0f} µs)")
+
+    allowed, ceiling, admitted = check_limits(workdir.name, args)
+    report = {'check_ip_us': round(ip_us, 2), 'check_ip_user_us': round(both_us, 2), 'slot_us': round(slot_us, 2),
+              'request_plain_us': round(plain_us, 1), 'request_admitted_us': round(admitted_us, 1),
+              'processes': args.processes, 'allowed': allowed, 'ceiling': round(ceiling, 1),
+              'slots_admitted': admitted}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    workdir.cleanup()
+    if allowed > ceiling or allowed < args.burst or admitted != args.processes:
+        print("admission limits not enforced")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Per-request authentication overhead, with and without the verified-token cache
+
+Times verify_token() directly and a full GET /api/auth/verify through the
+Flask test client. TOKEN_CACHE_SIZE=0 in the environment disables the cache,
+so both runs use the same code path.
+
+    python -m benchmarks.bench_auth --requests 20000
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+CHILD = '''
+import os, sys, json, time
+sys.path.insert(0, {backend!r})
+os.chdir({workdir!r})
+import logging
+logging.disable(logging.CRITICAL)
+import app_v2_jwt as api
+
+n = {requests}
+token = api.generate_token('bench@example.com', 'Bench')
+api.verify_token(token)
+
+started = time.perf_counter()
+for _ in range(n):
+    api.verify_token(token)
+verify_us = (time.perf_counter() - started) / n * 1e6
+
+client = api.app.test_client()
+headers = {{'Authorization': 'Bearer ' + token}}
+started = time.perf_counter()
+for _ in range(n // 10):
+    client.get('/api/auth/verify', headers=headers)
+request_us = (time.perf_counter() - started) / (n // 10) * 1e6
+
+print(json.dumps({{'verify_token_us': round(verify_us, 2), 'request_us': round(request_us, 2)}}))
+'''
+
+
+def run(cache_size, requests):
+    backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, TOKEN_CACHE_SIZE=str(cache_size))
+        code = CHILD.format(backend=backend, workdir=workdir, requests=requests)
+        out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+
+    uncached = run(0, args.requests)
+    cached = run(10000, args.requests)
+    print(f"{'':22} {'no cache':>10} {'cache':>10}")
+    print(f"{'verify_token (us)':22} {uncached['verify_token_us']:>10} {cached['verify_token_us']:>10}")
+    print(f"{'GET /api/auth/verify':22} {uncached['request_us']:>10} {cached['request_us']:>10}")
+
+
+if __name__ == '__main__':
+    main()
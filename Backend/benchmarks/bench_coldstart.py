@@ -0,0 +1,188 @@
+"""
+Cold start benchmark: time from launching gunicorn to every worker serving
+
+Starts gunicorn (gunicorn_config.py) --runs times for each combination of
+preload_app on/off and database state:
+
+  fresh     no crop_portal.db yet
+  current   a database already at the schema version (a restart)
+
+Each run uses a throwaway config that imports gunicorn_config.py and adds
+timestamps at post_fork and post_worker_init, while a client polls
+/api/health from the moment gunicorn is launched. Reported per combination
+(median over runs):
+
+  first ok      launch to the first 200 from /api/health
+  all workers   launch to the last worker finishing post_worker_init
+  worker boot   post_fork to post_worker_init, the slowest worker (with
+                preload off this is the app import, init_db included)
+  errors        non-200 answers to health checks before all workers were up
+
+--backend points at another checkout's Backend directory (a git worktree of
+an earlier commit, say) to compare against it on the same machine:
+
+    python -m benchmarks.bench_coldstart
+    python -m benchmarks.bench_coldstart --workers 8 --runs 5 --json coldstart.json
+    git worktree add /tmp/before HEAD~1
+    python -m benchmarks.bench_coldstart --backend /tmp/before/Backend --json before.json
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+
+from benchmarks.bench_workers import free_port
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = '''
+import os
+import time
+from gunicorn_config import *
+import gunicorn_config
+
+_EVENTS = os.environ['COLDSTART_EVENTS']
+
+def _record(event, pid):
+    with open(_EVENTS, 'a') as f:
+        f.write(f"{event} {pid} {time.time()}\\n")
+
+def post_fork(server, worker):
+    _record('fork', worker.pid)
+    gunicorn_config.post_fork(server, worker)
+
+def post_worker_init(worker):
+    _record('ready', worker.pid)
+'''
+
+
+def health(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        conn.request('GET', '/api/health')
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    except OSError:
+        return None
+    finally:
+        conn.close()
+
+
+def read_events(path):
+    events = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                event, pid, at = line.split()
+                events.setdefault(pid, {})[event] = float(at)
+    return events
+
+
+def cold_start(backend, app, workers, preload, migrated, timeout):
+    """One launch in a fresh working directory; seconds from launch for each milestone"""
+    with tempfile.TemporaryDirectory(prefix='coldstart-') as workdir:
+        env = dict(os.environ, PYTHONPATH=backend, GUNICORN_PRELOAD_APP='1' if preload else '0',
+                   COLDSTART_EVENTS=os.path.join(workdir, 'events'))
+        if migrated:
+            # Importing the app once leaves the database as a previous start would
+            subprocess.run([sys.executable, '-c', f"import {app.split(':')[0]}"], cwd=workdir, env=env,
+                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        config = os.path.join(workdir, 'coldstart_config.py')
+        with open(config, 'w') as f:
+            f.write(CONFIG)
+
+        port = free_port()
+        log = open(os.path.join(workdir, 'gunicorn.log'), 'w')
+        launched = time.time()
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', config, '--workers', str(workers),
+             '--bind', f'127.0.0.1:{port}', app],
+            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+        first_ok, errors, done = None, 0, threading.Event()
+
+        def poll():
+            nonlocal first_ok, errors
+            while not done.is_set():
+                status = health(port)
+                if status == 200:
+                    first_ok = first_ok or time.time()
+                elif status is not None:
+                    errors += 1
+                else:
+                    time.sleep(0.005)
+
+        poller = threading.Thread(target=poll, daemon=True)
+        poller.start()
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                events = read_events(env['COLDSTART_EVENTS'])
+                ready = [e for e in events.values() if 'ready' in e]
+                if len(ready) >= workers and first_ok:
+                    break
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"gunicorn did not start {workers} workers; see {log.name}")
+                time.sleep(0.01)
+        finally:
+            done.set()
+            poller.join()
+            proc.send_signal(signal.SIGTERM)
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+            log.close()
+
+    return {
+        'first_ok_s': first_ok - launched,
+        'all_workers_s': max(e['ready'] for e in ready) - launched,
+        'worker_boot_ms': max((e['ready'] - e['fork']) * 1000.0 for e in ready if 'fork' in e),
+        'errors': errors,
+    }
+
+
+def median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', default=BACKEND, help='Backend directory to start (default: this one)')
+    parser.add_argument('--app', default='app:app')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    backend = os.path.abspath(args.backend)
+    report = {'backend': backend, 'app': args.app, 'workers': args.workers, 'results': {}}
+    print(f"{args.app} from {backend}, {args.workers} workers, median of {args.runs} runs")
+    print(f"{'':<22}{'first ok s':>12}{'all workers s':>15}{'worker boot ms':>16}{'errors':>8}")
+    for preload in (False, True):
+        for migrated in (False, True):
+            runs = [cold_start(backend, args.app, args.workers, preload, migrated, args.timeout)
+                    for _ in range(args.runs)]
+            result = {key: round(median([run[key] for run in runs]), 3) for key in runs[0]}
+            label = f"preload={int(preload)} {'current' if migrated else 'fresh'}"
+            report['results'][label] = result
+            print(f"{label:<22}{result['first_ok_s']:>12.2f}{result['all_workers_s']:>15.2f}"
+                  f"{result['worker_boot_ms']:>16.1f}{result['errors']:>8}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Conditional GET and compression benchmark
+
+Loads app.py in a scratch directory, fills one user's history with --rows
+analysis results and serves the crop catalog (Frontend/crops.json, or a
+synthetic one with --catalog-entries). For a history page, the full
+catalog and a catalog search, it measures response bytes and server time
+(in-process, through the Flask test client) of:
+
+  full         200, identity encoding, nothing cached (every request before)
+  gzip         200 for a client sending Accept-Encoding: gzip
+  gzip cached  the same from the shared body cache (catalog routes only)
+  304          revalidation with the ETag of an earlier response
+
+and prints the bytes and time saved relative to full. It exits 1 unless
+every 304 has an empty body and takes less server time than full, and
+every gzipped body is smaller than full.
+
+    python -m benchmarks.bench_conditional
+    python -m benchmarks.bench_conditional --rows 5000 --catalog-entries 10000 --json conditional.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER = 'bench@example.com'
+
+
+def populate_history(app_module, rows):
+    import db
+    from detection import ANALYSIS_INSERT
+    from diseases import DISEASE_DB
+    result = {**DISEASE_DB[0], 'confidence': 0.91}
+    data = [app_module.pipeline.analysis_row(USER, result, f'leaf_{i}.jpg') for i in range(rows)]
+    with db.transaction(app_module.DATABASE) as tx:
+        tx.executemany(ANALYSIS_INSERT, data)
+
+
+def median(samples):
+    ordered = sorted(samples)
+    return ordered[len(ordered) // 2]
+
+
+def measure(client, url, headers, repeat, before=None):
+    samples, size, status = [], 0, None
+    for _ in range(repeat):
+        if before:
+            before()
+        started = time.perf_counter()
+        response = client.get(url, headers=headers)
+        samples.append((time.perf_counter() - started) * 1000.0)
+        size, status = len(response.data), response.status_code
+    return {'status': status, 'bytes': size, 'median_ms': round(median(samples), 4)}
+
+
+def check(report):
+    """What the caches failed to save, per target; empty when they all did their job"""
+    failures = []
+    for name, results in report['targets'].items():
+        full, not_modified = results['full'], results['304']
+        if not_modified['status'] != 304 or not_modified['bytes'] != 0:
+            failures.append(f"{name}: revalidation got {not_modified['status']} with {not_modified['bytes']} B")
+        elif not_modified['median_ms'] >= full['median_ms']:
+            failures.append(f"{name}: 304 took {not_modified['median_ms']} ms, full {full['median_ms']} ms")
+        if results['gzip']['bytes'] >= full['bytes']:
+            failures.append(f"{name}: gzip body {results['gzip']['bytes']} B, full {full['bytes']} B")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000, help='history rows of the measured user')
+    parser.add_argument('--limit', type=int, default=200, help='history page size')
+    parser.add_argument('--catalog-entries', type=int, default=0, help='synthetic catalog size (0: crops.json)')
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    scratch = tempfile.TemporaryDirectory(prefix='bench-conditional-')  # removed at exit
+    workdir = scratch.name
+    if args.catalog_entries:
+        # Before anything imports crop_catalog, which reads CROPS_FILE once
+        os.environ['CROPS_FILE'] = os.path.join(workdir, 'crops.json')
+        from benchmarks.bench_crops import synthetic_catalog
+        with open(os.environ['CROPS_FILE'], 'w') as f:
+            json.dump({'crops': synthetic_catalog(args.catalog_entries)[0]}, f)
+    # app.py keeps its database and uploads in the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND)
+    import app as app_module
+    import http_cache
+
+    populate_history(app_module, args.rows)
+    client = app_module.app.test_client()
+    gzip_header = {'Accept-Encoding': 'gzip'}
+    targets = [
+        ('history', f'/api/history?email={USER}&limit={args.limit}', False),
+        ('catalog', '/api/crops?per_page=100', True),
+        ('search', '/api/crops?q=leaf&per_page=100', True),
+    ]
+
+    report = {'rows': args.rows, 'catalog_entries': app_module.catalog.index().size, 'targets': {}}
+    for name, url, shared in targets:
+        clear = http_cache.body_cache.clear
+        etag = client.get(url, headers=gzip_header).headers['ETag']
+        results = {
+            'full': measure(client, url, {'Accept-Encoding': 'identity'}, args.repeat, clear),
+            'gzip': measure(client, url, gzip_header, args.repeat, clear),
+        }
+        if shared:
+            client.get(url, headers=gzip_header)
+            results['gzip cached'] = measure(client, url, gzip_header, args.repeat)
+        results['304'] = measure(client, url, {**gzip_header, 'If-None-Match': etag}, args.repeat)
+        report['targets'][name] = results
+
+        full = results['full']
+        print(f"{name} ({url})")
+        for label, result in results.items():
+            saved_bytes = 100.0 * (1 - result['bytes'] / full['bytes']) if full['bytes'] else 0.0
+            saved_time = 100.0 * (1 - result['median_ms'] / full['median_ms'])
+            print(f"  {label:<12} {result['status']}  {result['bytes']:>9,} B ({saved_bytes:5.1f}% saved)  "
+                  f"{result['median_ms']:>8.3f} ms ({saved_time:5.1f}% saved)")
+
+    failures = check(report)
+    report['passed'] = not failures
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if failures:
+        sys.exit("FAIL: " + "; ".join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Crop catalog search benchmark
+
+Generates a synthetic advisory catalog of --entries crop x disease x region
+entries with varied descriptions, indexes it with crop_catalog.CatalogIndex
+and replays keystroke-style queries: search terms drawn from a Zipf
+distribution and typed one letter at a time, some with a second word or a
+risk/type filter. Reports index build time and memory, then per-query
+latency percentiles for a first pass over a fresh index (cold) and for a
+second, independently drawn query log (steady state, with the caches the
+first pass left behind). The old browser-side substring filter is timed on
+a sample of the same queries for comparison.
+
+    python -m benchmarks.bench_crops
+    python -m benchmarks.bench_crops --entries 100000 --queries 20000 --json crops.json
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+
+from crop_catalog import CatalogIndex
+
+CROPS = ['Potato', 'Tomato', 'Rice', 'Wheat', 'Corn', 'Apple', 'Grapes', 'Banana', 'Mango', 'Orange',
+         'Onion', 'Carrot', 'Cucumber', 'Pepper', 'Spinach', 'Cotton', 'Sugarcane', 'Coffee', 'Tea',
+         'Soybean', 'Strawberry', 'Peach', 'Lemon', 'Watermelon', 'Almond', 'Cabbage', 'Cauliflower',
+         'Eggplant', 'Garlic', 'Pumpkin', 'Barley', 'Sorghum', 'Millet', 'Cassava', 'Yam', 'Cocoa',
+         'Lettuce', 'Pea', 'Chickpea', 'Lentil', 'Sunflower', 'Groundnut', 'Olive', 'Pear', 'Cherry']
+DISEASES = [('Early Blight', 'Fungal'), ('Late Blight', 'Fungal'), ('Mosaic Virus', 'Viral'),
+            ('Leaf Rust', 'Fungal'), ('Stem Rust', 'Fungal'), ('Powdery Mildew', 'Fungal'),
+            ('Downy Mildew', 'Fungal'), ('Bacterial Spot', 'Bacterial'), ('Bacterial Wilt', 'Bacterial'),
+            ('Fusarium Wilt', 'Fungal'), ('Anthracnose', 'Fungal'), ('Canker', 'Bacterial'),
+            ('Leaf Curl', 'Viral'), ('Root Rot', 'Fungal'), ('Black Rot', 'Bacterial'), ('Scab', 'Fungal'),
+            ('Smut', 'Fungal'), ('Blast', 'Fungal'), ('Yellow Dwarf', 'Viral'), ('Ring Spot', 'Viral'),
+            ('Leaf Spot', 'Fungal'), ('Soft Rot', 'Bacterial'), ('Gray Mold', 'Fungal'), ('Streak', 'Viral')]
+RISKS = ['Low', 'Medium', 'Moderate', 'High', 'Critical', 'Common', 'Seasonal']
+SYMPTOMS = ['lesions', 'yellowing', 'wilting', 'necrotic', 'spots', 'concentric', 'rings', 'pustules',
+            'mottling', 'stunted', 'growth', 'defoliation', 'chlorosis', 'margins', 'veins', 'powdery',
+            'coating', 'water', 'soaked', 'sunken', 'dark', 'brown', 'reddish', 'white', 'gray', 'fruit',
+            'stems', 'roots', 'leaves', 'humid', 'weather', 'spreads', 'rain', 'splash', 'insects',
+            'aphids', 'whiteflies', 'thrips', 'soil', 'borne', 'seed', 'infected', 'debris', 'rotation']
+SYLLABLES = ['ka', 'ri', 'mo', 'ta', 'su', 'ne', 'lo', 'pa', 'vi', 'do', 'ra', 'ke', 'ni', 'bo', 'za',
+             'mi', 'tu', 'ge', 'ha', 'yo']
+
+
+def synthetic_word(rng, syllables=3):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(syllables))
+
+
+def synthetic_catalog(entries, seed=0):
+    rng = random.Random(seed)
+    regions = sorted({synthetic_word(rng).capitalize() for _ in range(400)})
+    cultivars = sorted({synthetic_word(rng, 4) for _ in range(20000)})
+    catalog = []
+    for i in range(entries):
+        crop = rng.choice(CROPS)
+        disease, kind = rng.choice(DISEASES)
+        region = rng.choice(regions)
+        cultivar = rng.choice(cultivars)
+        symptoms = ' '.join(rng.sample(SYMPTOMS, 8))
+        catalog.append({
+            "id": i + 1,
+            "name": f"{crop} {disease} ({region})",
+            "crop": crop,
+            "type": kind,
+            "risk": rng.choice(RISKS),
+            "image": f"https://example.com/crops/{i + 1}.jpg",
+            "description": f"{disease} of {crop.lower()} cultivar {cultivar} in {region}: {symptoms}.",
+        })
+    return catalog, regions, cultivars
+
+
+def query_log(count, regions, cultivars, seed):
+    """Keystroke queries: each search term is typed one letter at a time"""
+    rng = random.Random(seed)
+    terms = ([c.lower() for c in CROPS] + [w.lower() for d, _ in DISEASES for w in d.split()] + SYMPTOMS
+             + [r.lower() for r in regions] + list(cultivars[:2000]))
+    rng.shuffle(terms)
+    weights = [1.0 / (rank + 1) for rank in range(len(terms))]
+    queries = []
+    while len(queries) < count:
+        term = rng.choices(terms, weights)[0]
+        prefix = ''
+        if rng.random() < 0.2:
+            prefix = rng.choices(terms, weights)[0] + ' '
+        filters = {}
+        if rng.random() < 0.1:
+            filters = {'risk': rng.choice(RISKS)} if rng.random() < 0.5 else {'type': rng.choice(['Fungal', 'Viral', 'Bacterial'])}
+        for n in range(1, len(term) + 1):
+            queries.append((prefix + term[:n], filters))
+    return queries[:count]
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q / 100.0 * len(ordered)))], 4)
+    return {'p50_ms': pick(50), 'p95_ms': pick(95), 'p99_ms': pick(99), 'max_ms': round(ordered[-1], 4)}
+
+
+def replay(index, queries):
+    samples = []
+    for query, filters in queries:
+        started = time.perf_counter()
+        index.search(query, filters)
+        samples.append((time.perf_counter() - started) * 1000.0)
+    return percentiles(samples)
+
+
+def linear_scan(catalog, queries):
+    """The filter advisories.html ran in the browser on every keyup"""
+    samples = []
+    for query, _ in queries:
+        term = query.lower()
+        started = time.perf_counter()
+        [item for item in catalog
+         if term in item['name'].lower() or term in item['crop'].lower() or term in item['type'].lower()]
+        samples.append((time.perf_counter() - started) * 1000.0)
+    return percentiles(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=100_000)
+    parser.add_argument('--queries', type=int, default=20_000)
+    parser.add_argument('--scan-sample', type=int, default=200, help='queries timed with the linear scan')
+    parser.add_argument('--target-ms', type=float, default=1.0, help='steady-state p99 to report against')
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    catalog, regions, cultivars = synthetic_catalog(args.entries)
+    started = time.perf_counter()
+    index = CatalogIndex(catalog)
+    build_s = time.perf_counter() - started
+    # Memory from a second build: tracemalloc slows the first one down several times
+    tracemalloc.start()
+    measured = CatalogIndex(catalog)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del measured
+    print(f"indexed {index.size:,} entries, {len(index.vocab):,} words in {build_s:.2f}s; "
+          f"{current / 2**20:.1f} MB held ({index.nbytes / 2**20:.1f} MB arrays), peak {peak / 2**20:.1f} MB")
+
+    cold = replay(index, query_log(args.queries, regions, cultivars, seed=1))
+    steady = replay(index, query_log(args.queries, regions, cultivars, seed=2))
+    scan = linear_scan(catalog, query_log(args.scan_sample, regions, cultivars, seed=3))
+    stats = index.stats()
+    for label, result in (('cold', cold), ('steady', steady), ('linear scan', scan)):
+        print(f"{label:<12} p50 {result['p50_ms']:>8.3f} ms  p95 {result['p95_ms']:>8.3f} ms  "
+              f"p99 {result['p99_ms']:>8.3f} ms  max {result['max_ms']:>8.3f} ms")
+    print(f"caches: {stats['cached_tokens']:,} tokens, {stats['cached_queries']:,} queries, "
+          f"{stats['cache_bytes'] / 2**20:.1f} MB")
+    met = steady['p99_ms'] <= args.target_ms
+    print(f"steady p99 {'within' if met else 'ABOVE'} the {args.target_ms} ms target")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'entries': args.entries, 'queries': args.queries, 'build_s': round(build_s, 3),
+                       'memory_bytes': current, 'peak_memory_bytes': peak, 'cold': cold,
+                       'steady': steady, 'linear_scan': scan, 'index': stats}, f, indent=2)
+    if not met:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+SQLite access benchmark: connect-per-query vs pooled WAL connections
+
+Spawns concurrent writer processes that insert analysis results (like
+save_analysis_result) while reader processes fetch history pages, and
+reports latency percentiles plus 'database is locked' errors per mode.
+
+    python -m benchmarks.bench_db --writers 9 --readers 2 --ops 500
+"""
+
+import os
+import json
+import time
+import sqlite3
+import argparse
+import tempfile
+import multiprocessing
+
+import db
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS analysis_results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_email TEXT,
+        disease TEXT NOT NULL,
+        confidence REAL NOT NULL,
+        description TEXT,
+        treatment TEXT,
+        filename TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+INSERT = '''
+    INSERT INTO analysis_results (user_email, disease, confidence, description, treatment, filename)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+HISTORY = '''
+    SELECT id, disease, confidence, description, created_at
+    FROM analysis_results WHERE user_email = ? ORDER BY created_at DESC LIMIT 50
+'''
+ROW = ('Potato Early Blight', 0.93, 'Fungal infection characterized by concentric rings on dark spots.',
+       json.dumps(["Apply copper-based fungicides", "Improve air circulation", "Remove infected leaves"]), 'leaf.jpg')
+
+
+def legacy_insert(database, email):
+    conn = sqlite3.connect(database)
+    conn.execute(INSERT, (email,) + ROW)
+    conn.commit()
+    conn.close()
+
+def legacy_history(database, email):
+    conn = sqlite3.connect(database)
+    conn.execute(HISTORY, (email,)).fetchall()
+    conn.close()
+
+def pooled_insert(database, email):
+    with db.transaction(database) as conn:
+        conn.execute(INSERT, (email,) + ROW)
+
+def pooled_history(database, email):
+    db.get_connection(database).execute(HISTORY, (email,)).fetchall()
+
+MODES = {
+    'legacy': (legacy_insert, legacy_history),
+    'pooled': (pooled_insert, pooled_history),
+}
+
+
+def worker(args):
+    mode, role, database, index, ops = args
+    insert, history = MODES[mode]
+    op = insert if role == 'writer' else history
+    email = f"user{index % 50}@example.com"
+    latencies, errors = [], 0
+    for _ in range(ops):
+        started = time.perf_counter()
+        try:
+            op(database, email)
+        except sqlite3.OperationalError:
+            errors += 1
+            continue
+        latencies.append((time.perf_counter() - started) * 1000.0)
+    return role, latencies, errors
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def run_mode(mode, writers, readers, ops, workdir):
+    database = os.path.join(workdir, f'{mode}.db')
+    conn = sqlite3.connect(database)
+    conn.execute(SCHEMA)
+    conn.commit()
+    conn.close()
+
+    jobs = [(mode, 'writer', database, i, ops) for i in range(writers)]
+    jobs += [(mode, 'reader', database, i, ops) for i in range(readers)]
+    started = time.perf_counter()
+    with multiprocessing.Pool(len(jobs)) as pool:
+        results = pool.map(worker, jobs)
+    elapsed = time.perf_counter() - started
+
+    report = {'mode': mode, 'elapsed_s': round(elapsed, 3)}
+    for role in ('writer', 'reader'):
+        latencies = [v for r, lat, _ in results if r == role for v in lat]
+        errors = sum(e for r, _, e in results if r == role)
+        report[role] = {
+            'ops': len(latencies),
+            'errors': errors,
+            'ops_per_s': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--writers', type=int, default=multiprocessing.cpu_count() * 2 + 1)
+    parser.add_argument('--readers', type=int, default=2)
+    parser.add_argument('--ops', type=int, default=300, help='operations per process')
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        reports = [run_mode(mode, args.writers, args.readers, args.ops, workdir) for mode in MODES]
+
+    print(f"{'mode':8} {'role':7} {'ops/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'locked':>7}")
+    for report in reports:
+        for role in ('writer', 'reader'):
+            r = report[role]
+            print(f"{report['mode']:8} {role:7} {r['ops_per_s']:>9} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8} {r['errors']:>7}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
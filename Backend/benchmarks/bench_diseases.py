@@ -0,0 +1,170 @@
+"""
+Disease id migration report
+
+Builds a scratch database in the old layout (disease name, description and
+treatment text copied into every analysis_results row) with --rows
+results, measures it, runs diseases.migrate_analysis_results plus VACUUM,
+and measures again:
+
+  file size     database file after a WAL checkpoint
+  table scan    reading every analysis_results row (reports, exports)
+  history walk  paging through the busiest user's whole history, 50 rows
+                a page, as /api/history does (the new layout joins
+                against the in-memory disease catalog)
+
+    python -m benchmarks.bench_diseases
+    python -m benchmarks.bench_diseases --rows 2000000 --json diseases.json
+"""
+
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+import db
+from diseases import DISEASE_DB, DiseaseCatalog, migrate_analysis_results
+from pagination import HISTORY_INDEX_DDL, encode_cursor, fetch_history_page
+
+LEGACY_SCHEMA = '''
+    CREATE TABLE analysis_results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_email TEXT,
+        disease TEXT NOT NULL,
+        confidence REAL NOT NULL,
+        description TEXT,
+        treatment TEXT,
+        filename TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+HOT_USER = 'hot@example.com'
+PAGE = 50
+
+
+def populate(database, rows, users, hot_share, batch=50_000):
+    rng = random.Random(7)
+    start = datetime(2024, 1, 1)
+    conn = db.get_connection(database)
+    conn.execute(LEGACY_SCHEMA)
+    conn.execute(HISTORY_INDEX_DDL)
+    written = 0
+    while written < rows:
+        n = min(batch, rows - written)
+        data = []
+        for i in range(written, written + n):
+            entry = rng.choice(DISEASE_DB)
+            email = HOT_USER if rng.random() < hot_share else f"user{rng.randrange(users)}@example.com"
+            created = (start + timedelta(seconds=i // 3)).strftime('%Y-%m-%d %H:%M:%S')
+            data.append((email, entry['disease'], round(rng.random(), 4), entry['description'],
+                         json.dumps(entry['treatment']), f'{i}.jpg', created))
+        with db.transaction(database) as tx:
+            tx.executemany('''
+                INSERT INTO analysis_results
+                (user_email, disease, confidence, description, treatment, filename, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', data)
+        written += n
+
+
+def legacy_page(conn, user_email, before):
+    """The history query from before the migration"""
+    if before:
+        created_at, row_id = before
+        cursor = conn.execute('''
+            SELECT id, disease, confidence, description, created_at FROM analysis_results
+            WHERE user_email = ? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?
+        ''', (user_email, created_at, row_id, PAGE + 1))
+    else:
+        cursor = conn.execute('''
+            SELECT id, disease, confidence, description, created_at FROM analysis_results
+            WHERE user_email = ? ORDER BY created_at DESC, id DESC LIMIT ?
+        ''', (user_email, PAGE + 1))
+    rows = [dict(row) for row in cursor.fetchall()]
+    last = rows[PAGE - 1] if len(rows) > PAGE else None
+    return rows[:PAGE], (last['created_at'], last['id']) if last else None
+
+
+def walk_legacy(conn):
+    pages, before = 0, None
+    while True:
+        _, before = legacy_page(conn, HOT_USER, before)
+        pages += 1
+        if before is None:
+            return pages
+
+
+def walk_current(conn, catalog):
+    pages, cursor = 0, None
+    while True:
+        _, cursor = fetch_history_page(conn, HOT_USER, catalog, PAGE, cursor)
+        pages += 1
+        if cursor is None:
+            return pages
+
+
+def best_of(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = (time.perf_counter() - started) * 1000.0
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best, 2)
+
+
+def measure(database, conn, walk, repeat):
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return {
+        'file_bytes': os.path.getsize(database),
+        'table_scan_ms': best_of(lambda: conn.execute('SELECT * FROM analysis_results').fetchall(), repeat),
+        'history_walk_ms': best_of(walk, repeat),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=500_000)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--hot-share', type=float, default=0.01, help='fraction of rows owned by the walked user')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        database = os.path.join(workdir, 'diseases.db')
+        populate(database, args.rows, args.users, args.hot_share)
+        conn = db.get_connection(database)
+        before = measure(database, conn, lambda: walk_legacy(conn), args.repeat)
+
+        started = time.perf_counter()
+        with db.transaction(database, immediate=True) as tx:
+            migrated = migrate_analysis_results(tx, DISEASE_DB)
+        migrate_s = time.perf_counter() - started
+        started = time.perf_counter()
+        conn.execute('VACUUM')
+        vacuum_s = time.perf_counter() - started
+        catalog = DiseaseCatalog(database, DISEASE_DB)
+        after = measure(database, conn, lambda: walk_current(conn, catalog), args.repeat)
+        db.close_connections()
+
+    pages = -(-int(args.rows * args.hot_share) // PAGE)
+    print(f"{args.rows:,} results; migrated {migrated:,} in {migrate_s:.1f}s, VACUUM {vacuum_s:.1f}s; "
+          f"history walk ~{pages:,} pages of {PAGE}")
+    print(f"{'':<16}{'before':>12}{'after':>12}{'change':>10}")
+    for key, label in (('file_bytes', 'file size (MB)'), ('table_scan_ms', 'table scan ms'),
+                       ('history_walk_ms', 'history walk ms')):
+        scale = 1e6 if key == 'file_bytes' else 1
+        change = 100.0 * (after[key] / before[key] - 1)
+        print(f"{label:<16}{before[key] / scale:>12.1f}{after[key] / scale:>12.1f}{change:>9.1f}%")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'rows': args.rows, 'migrated': migrated, 'migrate_s': round(migrate_s, 2),
+                       'vacuum_s': round(vacuum_s, 2), 'before': before, 'after': after}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+History pagination benchmark
+
+Fills a scratch database with --rows analysis results spread over --users
+users, checks with EXPLAIN QUERY PLAN that every history query is served by
+idx_analysis_results_user_created (no table scan, no temp sort), then times
+page fetches at increasing cursor depths. Page time should stay flat as the
+table and the depth grow.
+
+    python -m benchmarks.bench_history --rows 10000000
+    python -m benchmarks.bench_history --rows 1000000 --compare-unindexed
+"""
+
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+import db
+import migrations
+from diseases import DISEASE_DB, DiseaseCatalog
+from pagination import encode_cursor, fetch_history_page
+
+LEGACY_QUERY = '''
+    SELECT id, disease_id, confidence, model_version, created_at
+    FROM analysis_results WHERE user_email = ? ORDER BY created_at DESC LIMIT ?
+'''
+HOT_USER = 'hot@example.com'
+
+
+def populate(database, rows, users, hot_share, batch=50_000):
+    rng = random.Random(42)
+    start = datetime(2024, 1, 1)
+    migrations.migrate(database)
+    catalog = DiseaseCatalog(database, DISEASE_DB)
+    written = 0
+    while written < rows:
+        n = min(batch, rows - written)
+        data = []
+        for i in range(written, written + n):
+            email = HOT_USER if rng.random() < hot_share else f"user{rng.randrange(users)}@example.com"
+            created = (start + timedelta(seconds=i // 3)).strftime('%Y-%m-%d %H:%M:%S')
+            data.append((email, rng.choice(catalog.ids), rng.random(), 'reference', 'leaf.jpg', created))
+        with db.transaction(database) as tx:
+            tx.executemany('''
+                INSERT INTO analysis_results
+                (user_email, disease_id, confidence, model_version, filename, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', data)
+        written += n
+    db.get_connection(database).execute('ANALYZE')
+    return catalog
+
+
+def query_plans(conn):
+    first = conn.execute('EXPLAIN QUERY PLAN ' + '''
+        SELECT id, disease_id, confidence, model_version, created_at FROM analysis_results
+        WHERE user_email = ? ORDER BY created_at DESC, id DESC LIMIT ?
+    ''', (HOT_USER, 51)).fetchall()
+    later = conn.execute('EXPLAIN QUERY PLAN ' + '''
+        SELECT id, disease_id, confidence, model_version, created_at FROM analysis_results
+        WHERE user_email = ? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?
+    ''', (HOT_USER, '2030-01-01 00:00:00', 1, 51)).fetchall()
+    return [' '.join(str(c) for c in row[3:]) for row in first], [' '.join(str(c) for c in row[3:]) for row in later]
+
+
+def assert_index_used(plan):
+    text = ' | '.join(plan)
+    assert 'idx_analysis_results_user_created' in text, f"history index not used: {text}"
+    assert 'TEMP B-TREE' not in text, f"history query sorts in a temp b-tree: {text}"
+    assert 'SCAN' not in text, f"history query scans the table: {text}"
+
+
+def time_call(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000.0)
+    samples.sort()
+    return round(samples[len(samples) // 2], 4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--hot-share', type=float, default=0.01, help='fraction of rows owned by the measured user')
+    parser.add_argument('--page', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--compare-unindexed', action='store_true', help='also time the old query without the index')
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        database = os.path.join(workdir, 'history.db')
+        started = time.perf_counter()
+        catalog = populate(database, args.rows, args.users, args.hot_share)
+        print(f"populated {args.rows:,} rows in {time.perf_counter() - started:.1f}s")
+
+        conn = db.get_connection(database)
+        first_plan, cursor_plan = query_plans(conn)
+        assert_index_used(first_plan)
+        assert_index_used(cursor_plan)
+        print(f"plan (first page):  {' | '.join(first_plan)}")
+        print(f"plan (cursor page): {' | '.join(cursor_plan)}")
+
+        hot_rows = conn.execute('SELECT COUNT(*) FROM analysis_results WHERE user_email = ?', (HOT_USER,)).fetchone()[0]
+        report = {'rows': args.rows, 'hot_user_rows': hot_rows, 'page': args.page, 'pages': []}
+        depth = 0
+        while depth < hot_rows:
+            if depth == 0:
+                before = None
+            else:
+                row = conn.execute('''
+                    SELECT created_at, id FROM analysis_results WHERE user_email = ?
+                    ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET ?
+                ''', (HOT_USER, depth - 1)).fetchone()
+                before = encode_cursor(row['created_at'], row['id'])
+            ms = time_call(lambda: fetch_history_page(conn, HOT_USER, catalog, args.page, before), args.repeat)
+            report['pages'].append({'depth': depth, 'p50_ms': ms})
+            print(f"depth {depth:>9,}: {ms:.4f} ms/page")
+            depth = depth * 10 if depth else args.page
+
+        if args.compare_unindexed:
+            conn.execute('DROP INDEX idx_analysis_results_user_created')
+            ms = time_call(lambda: conn.execute(LEGACY_QUERY, (HOT_USER, args.page)).fetchall(), max(3, args.repeat // 50))
+            report['unindexed_first_page_ms'] = ms
+            print(f"unindexed first page: {ms:.4f} ms")
+        db.close_connections()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Login throughput against password hash cost
+
+For each work factor, registers a user and fires a burst of concurrent
+logins while a probe thread keeps hitting /api/health, reporting logins/s,
+login latency and how much the burst slows the probe.
+
+    python -m benchmarks.bench_login --methods scrypt pbkdf2:sha256:600000 pbkdf2:sha256:1000000
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+CHILD = '''
+import os, sys, json, time, threading
+sys.path.insert(0, {backend!r})
+os.chdir({workdir!r})
+import logging
+logging.disable(logging.CRITICAL)
+import app_v2_jwt as api
+
+client = api.app.test_client()
+client.post('/api/auth/register', json={{'email': 'bench@example.com', 'name': 'Bench', 'password': 'pw'}})
+
+latencies, statuses, probe = [], [], []
+lock = threading.Lock()
+done = threading.Event()
+
+def login_loop(n):
+    c = api.app.test_client()
+    for _ in range(n):
+        started = time.perf_counter()
+        r = c.post('/api/auth/login', json={{'email': 'bench@example.com', 'password': 'pw'}})
+        with lock:
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses.append(r.status_code)
+
+def probe_loop():
+    c = api.app.test_client()
+    while not done.is_set():
+        started = time.perf_counter()
+        c.get('/api/health')
+        probe.append((time.perf_counter() - started) * 1000)
+        time.sleep(0.005)
+
+baseline = []
+for _ in range(50):
+    started = time.perf_counter()
+    client.get('/api/health')
+    baseline.append((time.perf_counter() - started) * 1000)
+
+prober = threading.Thread(target=probe_loop)
+prober.start()
+threads = [threading.Thread(target=login_loop, args=({per_thread},)) for _ in range({concurrency})]
+started = time.perf_counter()
+for t in threads: t.start()
+for t in threads: t.join()
+elapsed = time.perf_counter() - started
+done.set()
+prober.join()
+
+def pct(values, p):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(p / 100 * (len(values) - 1)))], 2)
+
+ok = statuses.count(200)
+print(json.dumps({{
+    'logins_per_s': round(ok / elapsed, 1),
+    'ok': ok, 'busy_503': statuses.count(503),
+    'login_p50_ms': pct(latencies, 50), 'login_p95_ms': pct(latencies, 95),
+    'health_p50_ms_idle': pct(baseline, 50), 'health_p95_ms_burst': pct(probe, 95),
+}}))
+'''
+
+
+def run(method, concurrency, per_thread):
+    backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, PASSWORD_HASH_METHOD=method)
+        code = CHILD.format(backend=backend, workdir=workdir, concurrency=concurrency, per_thread=per_thread)
+        out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--methods', nargs='+',
+                        default=['scrypt', 'pbkdf2:sha256:600000', 'pbkdf2'])
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--per-thread', type=int, default=5)
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    reports = {}
+    print(f"{'method':26} {'logins/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'503s':>5} {'health idle':>12} {'health burst p95':>17}")
+    for method in args.methods:
+        r = reports[method] = run(method, args.concurrency, args.per_thread)
+        print(f"{method:26} {r['logins_per_s']:>9} {r['login_p50_ms']:>8} {r['login_p95_ms']:>8} "
+              f"{r['busy_503']:>5} {r['health_p50_ms_idle']:>12} {r['health_p95_ms_burst']:>17}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
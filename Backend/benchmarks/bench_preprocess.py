@@ -0,0 +1,177 @@
+"""
+Preprocessing benchmark: reduced-resolution decode vs a full decode
+
+Writes sample uploads (a 12MP phone JPEG with an EXIF rotation, a large RGBA
+PNG) and preprocesses each one two ways:
+
+- full:     decode at full resolution, exif_transpose, convert, resize, normalize
+- pipeline: InferenceEngine.preprocess (draft-mode decode, resize, late transpose)
+
+Each mode runs in a fresh child process and its peak RSS is read from
+/proc/self/status (VmHWM); Pillow allocates pixel buffers outside the Python
+allocator, so tracemalloc would not see them, and getrusage's maxrss is
+inherited from the parent across exec. Reports p50 per-stage timings and how far
+the pipeline's output drifts from the full decode.
+
+    python -m benchmarks.bench_preprocess
+    python -m benchmarks.bench_preprocess --repeat 50 --json preprocess.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from inference import ReferenceModel, InferenceEngine, CHANNEL_MEAN, CHANNEL_STD
+from imaging import EXIF_ORIENTATION
+
+STAGES = ('open', 'decode', 'convert', 'transpose', 'resize', 'normalize')
+
+
+def make_samples(workdir):
+    """Write textured sample uploads; a flat image would compress and decode unrealistically fast"""
+    rng = np.random.default_rng(7)
+    samples = {}
+
+    height, width = 3024, 4032
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    pixels = np.clip(base + rng.normal(0, 18, base.shape), 0, 255).astype(np.uint8)
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION] = 6    # portrait photo stored sideways, as phones do
+    path = os.path.join(workdir, 'phone.jpg')
+    Image.fromarray(pixels).save(path, quality=90, exif=exif.tobytes())
+    samples['jpeg_12mp_rotated'] = path
+
+    pixels = np.concatenate([pixels[:1500, :2000], np.full((1500, 2000, 1), 200, np.uint8)], axis=-1)
+    path = os.path.join(workdir, 'cutout.png')
+    Image.fromarray(pixels, 'RGBA').save(path, compress_level=1)
+    samples['png_3mp_rgba'] = path
+    return samples
+
+
+def peak_rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return 0
+
+
+def reset_peak_rss():
+    # Linux 4.0+: writing 5 resets VmHWM to the current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def full_decode(path, size, scale, shift, timings):
+    """What preprocessing did before: materialize every pixel, then shrink"""
+    clock = time.perf_counter
+    t0 = clock()
+    img = Image.open(path)
+    t1 = clock()
+    img.load()
+    t2 = clock()
+    img = img.convert('RGB')
+    t3 = clock()
+    img = ImageOps.exif_transpose(img)
+    t4 = clock()
+    img = img.resize(size, Image.BILINEAR)
+    t5 = clock()
+    out = np.asarray(img, dtype=np.float32) * scale - shift
+    t6 = clock()
+    timings.update(open=(t1 - t0) * 1000, decode=(t2 - t1) * 1000, convert=(t3 - t2) * 1000,
+                   transpose=(t4 - t3) * 1000, resize=(t5 - t4) * 1000, normalize=(t6 - t5) * 1000)
+    return out
+
+
+def run_child(mode, path, repeat):
+    """Runs in a fresh interpreter; prints one JSON report"""
+    engine = InferenceEngine(ReferenceModel(4), ['a', 'b', 'c', 'd'])
+    size = (engine.input_size, engine.input_size)
+    scale = (1.0 / (255.0 * CHANNEL_STD)).astype(np.float32)
+    shift = (CHANNEL_MEAN / CHANNEL_STD).astype(np.float32)
+
+    def once(timings):
+        if mode == 'full':
+            return full_decode(path, size, scale, shift, timings)
+        return engine.preprocess(path, timings).copy()
+
+    # Warm up on a tiny image so imports and buffers are not billed to the decode
+    tiny = path + '.tiny.png'
+    Image.new('RGB', (8, 8)).save(tiny)
+    engine.preprocess(tiny)
+    full_decode(tiny, size, scale, shift, {})
+    reset_peak_rss()
+    baseline_kb = peak_rss_kb()
+
+    output = once({})
+    peak_kb = peak_rss_kb()
+
+    samples = {stage: [] for stage in STAGES}
+    totals = []
+    for _ in range(repeat):
+        timings = {}
+        started = time.perf_counter()
+        once(timings)
+        totals.append((time.perf_counter() - started) * 1000)
+        for stage in STAGES:
+            samples[stage].append(timings.get(stage, 0.0))
+
+    np.save(path + f'.{mode}.npy', output)
+    print(json.dumps({
+        'peak_rss_mb': round((peak_kb - baseline_kb) / 1024, 1),
+        'total_ms': round(float(np.median(totals)), 2),
+        'stages_ms': {stage: round(float(np.median(v)), 2) for stage, v in samples.items()},
+    }))
+
+
+def measure(mode, path, repeat):
+    backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, '-m', 'benchmarks.bench_preprocess', '--child', mode, path,
+                          '--repeat', str(repeat)], cwd=backend, check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child[0], args.child[1], args.repeat)
+        return
+
+    report = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, path in make_samples(workdir).items():
+            print(f"{name} ({os.path.getsize(path) / 1e6:.1f} MB on disk)")
+            entry = report[name] = {}
+            for mode in ('full', 'pipeline'):
+                result = entry[mode] = measure(mode, path, args.repeat)
+                stages = '  '.join(f"{k}={v:.2f}" for k, v in result['stages_ms'].items() if v)
+                print(f"  {mode:<9} {result['total_ms']:8.2f} ms  peak +{result['peak_rss_mb']:6.1f} MB  [{stages}]")
+            full = np.load(path + '.full.npy')
+            fast = np.load(path + '.pipeline.npy')
+            entry['mean_abs_diff'] = round(float(np.abs(full - fast).mean()), 4)
+            entry['speedup'] = round(entry['full']['total_ms'] / entry['pipeline']['total_ms'], 1)
+            print(f"  speedup x{entry['speedup']}, mean |diff| of normalized input {entry['mean_abs_diff']}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Stats rollup benchmark
+
+Fills a scratch database with --rows analysis results spread over --days
+days and --users users (one user owning --hot-share of them), then reports:
+
+  backfill      python -m rollups on the existing rows (rows/s)
+  stats query   one /api/stats series for the busiest user and the global
+                one, over 30 days and over 48 hours: read from the rollups
+                versus grouping analysis_results on every request
+  write cost    committing single results through the sync result writer
+                with and without the rollup update in its transaction
+
+    python -m benchmarks.bench_rollups
+    python -m benchmarks.bench_rollups --rows 2000000 --days 730 --json rollups.json
+"""
+
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+import db
+import rollups
+import migrations
+from diseases import DISEASE_DB, DiseaseCatalog
+from write_behind import WriteBehindWriter
+
+HOT_USER = 'hot@example.com'
+INSERT = '''
+    INSERT INTO analysis_results (user_email, disease_id, confidence, model_version, filename, created_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+WRITER_INSERT = '''
+    INSERT INTO analysis_results (user_email, disease_id, confidence, model_version, filename)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+
+def populate(database, rows, users, hot_share, days, end, batch=50_000):
+    rng = random.Random(11)
+    migrations.migrate(database)
+    catalog = DiseaseCatalog(database, DISEASE_DB)
+    start = end - timedelta(days=days)
+    step = days * 86400.0 / rows
+    written = 0
+    while written < rows:
+        n = min(batch, rows - written)
+        data = []
+        for i in range(written, written + n):
+            email = HOT_USER if rng.random() < hot_share else f"user{rng.randrange(users)}@example.com"
+            created = (start + timedelta(seconds=i * step)).strftime('%Y-%m-%d %H:%M:%S')
+            data.append((email, rng.choice(catalog.ids), rng.random(), 'reference', 'leaf.jpg', created))
+        with db.transaction(database) as tx:
+            tx.executemany(INSERT, data)
+        written += n
+    return catalog
+
+
+def scan_stats(conn, user_email, period, buckets):
+    """What /api/stats would cost without rollups: group the user's rows on every request"""
+    width = rollups.PERIODS[period]
+    since = buckets[0]
+    if user_email:
+        sql = f'''
+            SELECT substr(created_at, 1, {width}), disease_id, COUNT(*) FROM analysis_results
+            WHERE user_email = ? AND created_at >= ? GROUP BY 1, 2
+        '''
+        return conn.execute(sql, (user_email, since)).fetchall()
+    sql = f'''
+        SELECT substr(created_at, 1, {width}), disease_id, COUNT(*) FROM analysis_results
+        WHERE created_at >= ? GROUP BY 1, 2
+    '''
+    return conn.execute(sql, (since,)).fetchall()
+
+
+def median_ms(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000.0)
+    samples.sort()
+    return round(samples[len(samples) // 2], 4)
+
+
+def write_cost(database, catalog, writes, after_write):
+    writer = WriteBehindWriter(database, WRITER_INSERT, mode='sync', after_write=after_write)
+    row = (HOT_USER, catalog.ids[0], 0.9, 'reference', 'leaf.jpg')
+    # Rows written without the rollup update are counted by the next one that has it
+    with db.transaction(database, immediate=True) as conn:
+        rollups.apply(conn, 0)
+    return median_ms(lambda: writer.write(row), writes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--hot-share', type=float, default=0.01, help='fraction of rows owned by the measured user')
+    parser.add_argument('--days', type=int, default=365, help='the rows are spread evenly over this many days')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--writes', type=int, default=2000, help='single-result commits timed per writer')
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    with tempfile.TemporaryDirectory() as workdir:
+        database = os.path.join(workdir, 'rollups.db')
+        started = time.perf_counter()
+        catalog = populate(database, args.rows, args.users, args.hot_share, args.days, now)
+        print(f"populated {args.rows:,} rows over {args.days} days in {time.perf_counter() - started:.1f}s")
+
+        started = time.perf_counter()
+        counted = rollups.backfill(database)
+        backfill_s = time.perf_counter() - started
+        conn = db.get_connection(database)
+        rollup_rows = conn.execute('SELECT COUNT(*) FROM stats_rollups').fetchone()[0]
+        print(f"backfill: {counted:,} results in {backfill_s:.1f}s ({counted / backfill_s:,.0f} rows/s), "
+              f"{rollup_rows:,} rollup rows")
+
+        report = {'rows': args.rows, 'days': args.days, 'backfill_s': round(backfill_s, 2),
+                  'rollup_rows': rollup_rows, 'queries': {}}
+        print(f"{'stats query':<24}{'rollups ms':>12}{'scan ms':>12}{'speedup':>10}")
+        for label, user, period, span in (('hot user, 30 days', HOT_USER, 'day', 30),
+                                          ('hot user, 48 hours', HOT_USER, 'hour', 48),
+                                          ('global, 30 days', None, 'day', 30),
+                                          ('global, 48 hours', None, 'hour', 48)):
+            buckets = rollups.window(period, span, now)
+            fast = median_ms(lambda: rollups.series(conn, user or rollups.GLOBAL, period, buckets, catalog),
+                             args.repeat)
+            slow = median_ms(lambda: scan_stats(conn, user, period, buckets), max(3, args.repeat // 10))
+            report['queries'][label] = {'rollups_ms': fast, 'scan_ms': slow}
+            print(f"{label:<24}{fast:>12.3f}{slow:>12.3f}{slow / fast:>9.0f}x")
+
+        plain = write_cost(database, catalog, args.writes, None)
+        with_rollups = write_cost(database, catalog, args.writes, rollups.apply)
+        report['write_ms'] = {'plain': plain, 'with_rollups': with_rollups}
+        print(f"single result commit: {plain:.3f} ms plain, {with_rollups:.3f} ms with rollups "
+              f"(+{with_rollups - plain:.3f} ms)")
+        db.close_connections()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+Slow uploads versus sync workers and the ASGI entry point
+
+Starts gunicorn twice with the same number of workers: once as deployed
+today (sync workers, app:app) and once with uvicorn workers serving
+asgi:app. Against each, --clients connections upload a --upload-kb
+multipart image at --rate bytes per second each (a weak 3G link), while
+one fast client polls /api/health. Reports health latency percentiles,
+health probes that timed out, and how many slow uploads finished within
+--duration seconds.
+
+With sync workers every slow upload occupies a worker, so health checks
+wait behind them; with asgi:app the bodies are read on the event loop and
+health checks stay fast.
+
+    python -m benchmarks.bench_slow_clients
+    python -m benchmarks.bench_slow_clients --clients 1000 --workers 4 --duration 30 --json slow.json
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+from benchmarks.bench_workers import free_port, wait_ready
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = {
+    'sync': ('sync', 'app:app'),
+    'asgi': ('uvicorn.workers.UvicornWorker', 'asgi:app'),
+}
+
+
+def leaf_jpeg():
+    import io
+    import numpy as np
+    from PIL import Image
+    buf = io.BytesIO()
+    pixels = np.random.default_rng(0).integers(0, 255, (120, 160, 3), dtype=np.uint8)
+    Image.fromarray(pixels).save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+def upload_body(size):
+    """A multipart detect upload of roughly `size` bytes (a JPEG padded after its end marker)"""
+    boundary = 'bench-slow-boundary'
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="imageFile"; filename="leaf.jpg"\r\n'
+            f'Content-Type: image/jpeg\r\n\r\n').encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    image = leaf_jpeg()
+    image += b'\0' * max(0, size - len(head) - len(image) - len(tail))
+    return head + image + tail, f'multipart/form-data; boundary={boundary}'
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(q / 100.0 * len(ordered)))], 1)
+
+
+async def read_status(reader):
+    line = await reader.readline()
+    parts = line.split()
+    return int(parts[1]) if len(parts) > 1 else None
+
+
+async def slow_upload(port, body, content_type, rate, deadline, outcome):
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    except OSError:
+        outcome['connect_errors'] += 1
+        return
+    # A small send buffer keeps the kernel from absorbing the upload faster than --rate
+    writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16384)
+    try:
+        writer.write((f'POST /api/detect HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: {content_type}\r\n'
+                      f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n').encode())
+        chunk = max(1, rate // 4)
+        for start in range(0, len(body), chunk):
+            writer.write(body[start:start + chunk])
+            await writer.drain()
+            await asyncio.sleep(chunk / rate)
+            if time.monotonic() > deadline:
+                return
+        status = await asyncio.wait_for(read_status(reader), max(0.1, deadline - time.monotonic()))
+        outcome['completed' if status == 200 else 'failed'] += 1
+    except (OSError, asyncio.TimeoutError):
+        outcome['failed'] += 1
+    finally:
+        writer.close()
+
+
+async def probe_health(port, interval, timeout, deadline, latencies, outcome):
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+            writer.write(b'GET /api/health HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n')
+            status = await asyncio.wait_for(read_status(reader), timeout)
+            writer.close()
+            if status == 200:
+                latencies.append((time.perf_counter() - started) * 1000)
+            else:
+                outcome['probe_errors'] += 1
+        except asyncio.TimeoutError:
+            outcome['probe_timeouts'] += 1
+        except OSError:
+            outcome['probe_errors'] += 1
+        await asyncio.sleep(interval)
+
+
+async def drive(port, args, body, content_type):
+    deadline = time.monotonic() + args.duration
+    outcome = dict.fromkeys(('completed', 'failed', 'connect_errors', 'probe_timeouts', 'probe_errors'), 0)
+    latencies = []
+    uploads = []
+    for _ in range(args.clients):
+        uploads.append(asyncio.create_task(
+            slow_upload(port, body, content_type, args.rate, deadline, outcome)))
+        await asyncio.sleep(args.ramp / args.clients)
+    await probe_health(port, 0.1, args.probe_timeout, deadline, latencies, outcome)
+    for task in uploads:
+        task.cancel()
+    await asyncio.gather(*uploads, return_exceptions=True)
+    return outcome, latencies
+
+
+def run_mode(mode, args, body, content_type):
+    worker_class, app = MODES[mode]
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=BACKEND, GUNICORN_WORKER_CLASS=worker_class)
+    with tempfile.TemporaryDirectory() as workdir:
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', os.path.join(BACKEND, 'gunicorn_config.py'),
+             '--workers', str(args.workers), '--bind', f'127.0.0.1:{port}', '--timeout', '120', app],
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(port)
+            outcome, latencies = asyncio.run(drive(port, args, body, content_type))
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(timeout=60)
+    return {
+        'mode': mode,
+        'health_probes': len(latencies),
+        'health_p50_ms': percentile(latencies, 50),
+        'health_p99_ms': percentile(latencies, 99),
+        'health_max_ms': round(max(latencies), 1) if latencies else None,
+        **outcome,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--upload-kb', type=int, default=512)
+    parser.add_argument('--rate', type=int, default=32768, help='upload bytes per second per slow client')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds from the first slow client')
+    parser.add_argument('--ramp', type=float, default=2.0, help='seconds over which slow clients connect')
+    parser.add_argument('--probe-timeout', type=float, default=2.0)
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=['sync', 'asgi'])
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    try:
+        import uvicorn  # noqa: F401
+    except ImportError:
+        if 'asgi' in args.modes:
+            sys.exit("uvicorn is not installed; pip install uvicorn or pass --modes sync")
+
+    body, content_type = upload_body(args.upload_kb * 1024)
+    print(f"{args.clients} clients uploading {len(body) / 1024:.0f} KB at {args.rate / 1024:.0f} KB/s "
+          f"(~{len(body) / args.rate:.0f}s each), {args.workers} workers, {args.duration:.0f}s")
+    report = {'clients': args.clients, 'workers': args.workers, 'upload_bytes': len(body),
+              'rate': args.rate, 'duration': args.duration, 'runs': []}
+    for mode in args.modes:
+        run = run_mode(mode, args, body, content_type)
+        report['runs'].append(run)
+        print(f"{mode:<5} health: {run['health_probes']:>4} ok, p50 {run['health_p50_ms'] or '-':>7} ms, "
+              f"p99 {run['health_p99_ms'] or '-':>7} ms, {run['probe_timeouts']:>3} timed out | "
+              f"uploads: {run['completed']:>5} done, {run['failed']:>4} failed, "
+              f"{run['connect_errors']:>4} refused")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Trends aggregator benchmark: accuracy against memory, and ingest rate
+
+`accuracy` feeds a Zipf-distributed stream (--events over --keys distinct
+keys, exponent --skew) into one bucket for each sketch width and Space-
+Saving capacity, and compares with exact counts:
+
+  memory        bytes per bucket (sketch plus Space-Saving summary)
+  max / mean    overcount of the true top 100 keys, as a share of events
+  bound         the e / width guarantee, for comparison with the max
+  recall        share of the true top --k found in the reported top --k
+
+`ingest` measures events/s through trends.observe() (one call per
+detection, as the apps do) and observe_many(), in one process and in
+--processes forked processes writing their own files into one TRENDS_DIR,
+then checks that the merged snapshot matches the exact counts within its
+error bound. It exits 1 if single-process observe() is below --min-rate.
+
+    python -m benchmarks.bench_trends accuracy
+    python -m benchmarks.bench_trends ingest --events 1000000 --processes 4
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing
+from collections import Counter
+
+import numpy as np
+
+
+def zipf_stream(events, keys, skew, seed):
+    ranks = np.random.default_rng(seed).zipf(skew, events)
+    names = [f'disease-{i}' for i in range(keys)]
+    return [names[(r - 1) % keys] for r in ranks.tolist()]
+
+
+def single_bucket(stream, width, capacity, depth):
+    import trends
+    nbytes = trends.Ring.nbytes(1, depth, width, capacity)
+    aggregator = trends.Aggregator(bytearray(nbytes), 1, 60, depth, width, capacity)
+    for key in stream:
+        aggregator.observe(key, 0)
+    window = trends.Window(0, 60, 60, 60, depth, width)
+    window.add(aggregator.ring)
+    return window, nbytes
+
+
+def cmd_accuracy(args):
+    stream = zipf_stream(args.events, args.keys, args.skew, args.seed)
+    exact = Counter(stream)
+    heavy = [key for key, _ in exact.most_common(100)]
+    true_top = {key for key, _ in exact.most_common(args.k)}
+    report = []
+    print(f"{args.events:,} events over {len(exact):,} distinct keys (Zipf {args.skew}), depth {args.depth}")
+    print(f"{'width':>7}{'top-k cap':>11}{'memory KB':>11}{'max err %':>11}{'mean err %':>12}{'bound %':>9}"
+          f"{'recall':>8}")
+    for width in args.widths:
+        for capacity in args.capacities:
+            window, nbytes = single_bucket(stream, width, capacity, args.depth)
+            errors = [window.estimate(key) - exact[key] for key in heavy]
+            reported = {key for key, _ in window.top(args.k)}
+            row = {
+                'width': width, 'capacity': capacity, 'bytes': nbytes,
+                'max_error': max(errors) / args.events, 'mean_error': sum(errors) / len(errors) / args.events,
+                'bound': np.e / width, 'recall': len(reported & true_top) / len(true_top),
+            }
+            report.append(row)
+            print(f"{width:>7}{capacity:>11}{nbytes / 1024:>11.1f}{100 * row['max_error']:>11.3f}"
+                  f"{100 * row['mean_error']:>12.3f}{100 * row['bound']:>9.3f}{row['recall']:>8.2f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'events': args.events, 'keys': args.keys, 'skew': args.skew, 'results': report}, f, indent=2)
+
+
+def _ingest(stream, batch):
+    import trends
+    started = time.perf_counter()
+    if batch:
+        for start in range(0, len(stream), batch):
+            trends.observe_many(stream[start:start + batch])
+    else:
+        for key in stream:
+            trends.observe(key)
+    return len(stream) / (time.perf_counter() - started)
+
+
+def _worker(stream, start_event, results):
+    start_event.wait()
+    results.put(_ingest(stream, 0))
+
+
+def cmd_ingest(args):
+    workdir = tempfile.TemporaryDirectory(prefix='bench-trends-')
+    os.environ['TRENDS_DIR'] = workdir.name
+    import trends
+
+    stream = zipf_stream(args.events, args.keys, args.skew, args.seed)
+    trends.observe_many(stream[:1000])  # create this process's file before timing
+    single = _ingest(stream, 0)
+    batched = _ingest(stream, 100)
+    print(f"one process: {single:,.0f} events/s through observe(), {batched:,.0f} through observe_many(100)")
+
+    # Forked writers, each with its own file; the snapshot merges them with this process's
+    context = multiprocessing.get_context('fork')
+    shares = [stream[i::args.processes] for i in range(args.processes)]
+    start_event, results = context.Event(), context.Queue()
+    workers = [context.Process(target=_worker, args=(share, start_event, results)) for share in shares]
+    for worker in workers:
+        worker.start()
+    started = time.perf_counter()
+    start_event.set()
+    rates = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    print(f"{args.processes} processes: {len(stream) / elapsed:,.0f} events/s together "
+          f"({min(rates):,.0f}-{max(rates):,.0f} each; {os.cpu_count()} CPUs)")
+
+    started = time.perf_counter()
+    snapshot = trends.snapshot(args.k)
+    snapshot_ms = (time.perf_counter() - started) * 1000
+    exact = Counter(stream)
+    observed = 1000 + 3 * len(stream)
+    worst = max(entry['count'] - (3 * exact[entry['key']] + stream[:1000].count(entry['key']))
+                for entry in snapshot['top'])
+    print(f"snapshot of {snapshot['processes']} files in {snapshot_ms:.1f} ms: {snapshot['events']:,} events "
+          f"(expected {observed:,}), worst top-{args.k} overcount {worst} (bound {snapshot['error_bound']})")
+
+    report = {'events': args.events, 'observe_per_s': round(single), 'observe_many_per_s': round(batched),
+              'processes': args.processes, 'multi_process_per_s': round(len(stream) / elapsed),
+              'snapshot_ms': round(snapshot_ms, 2), 'merged_events': snapshot['events'],
+              'expected_events': observed, 'worst_overcount': worst, 'error_bound': snapshot['error_bound']}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    workdir.cleanup()
+    if snapshot['events'] != observed or worst > snapshot['error_bound'] or worst < 0:
+        print("merged snapshot does not match the exact counts")
+        sys.exit(1)
+    if single < args.min_rate:
+        print(f"observe() below {args.min_rate:,} events/s")
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name in ('accuracy', 'ingest'):
+        sub = commands.add_parser(name)
+        sub.add_argument('--events', type=int, default=1_000_000)
+        sub.add_argument('--keys', type=int, default=100_000, help='distinct keys in the stream')
+        sub.add_argument('--skew', type=float, default=1.1, help='Zipf exponent')
+        sub.add_argument('--k', type=int, default=10)
+        sub.add_argument('--seed', type=int, default=5)
+        sub.add_argument('--json', help='write the report to this file')
+    accuracy = commands.choices['accuracy']
+    accuracy.add_argument('--depth', type=int, default=4)
+    accuracy.add_argument('--widths', type=int, nargs='+', default=[128, 256, 512, 1024, 2048, 4096])
+    accuracy.add_argument('--capacities', type=int, nargs='+', default=[16, 32, 64])
+    ingest = commands.choices['ingest']
+    ingest.add_argument('--processes', type=int, default=4)
+    ingest.add_argument('--min-rate', type=int, default=100_000, help='required observe() events/s')
+    args = parser.parse_args()
+    {'accuracy': cmd_accuracy, 'ingest': cmd_ingest}[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Model load time and accuracy drift by weight storage format
+
+Loads the reference model (--hidden 2048 is ~96 MB of float32 weights) in a
+fresh process per format and reports the time to a usable model, the first
+forward pass (which faults mapped pages in) and a steady-state batch:
+
+- generate:  seeded generator, what every worker did without MODEL_PATH
+- npz:       numpy.load of an .npz archive, i.e. parse and copy into the heap
+- float32 / float16 / int8: model_format files opened with numpy.memmap
+
+Drift compares float16 and int8 logits with float32 on --samples random
+images: max |logit| error, max softmax confidence error and top-1 agreement.
+The page cache is warm for every mapped run, as it is for a restarted
+worker on a node that is already serving.
+
+    python -m benchmarks.bench_weights
+    python -m benchmarks.bench_weights --hidden 4096 --json weights.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+import model_format
+from inference import ReferenceModel, load_model, CHANNEL_MEAN, CHANNEL_STD
+from memory_report import process_memory
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ('generate', 'npz', 'float32', 'float16', 'int8')
+CLASSES = 4
+
+
+def sample_batch(n, size, seed=3):
+    pixels = np.random.default_rng(seed).integers(0, 256, (n, size, size, 3)).astype(np.float32)
+    return (pixels / 255.0 - CHANNEL_MEAN) / CHANNEL_STD
+
+
+def softmax(logits):
+    e = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def run_child(mode, path, hidden, repeat):
+    """Runs in a fresh interpreter; prints one JSON report"""
+    batch = sample_batch(8, 64)
+    started = time.perf_counter()
+    if mode == 'generate':
+        model = ReferenceModel(CLASSES, hidden=hidden)
+    elif mode == 'npz':
+        with np.load(path) as archive:
+            model = ReferenceModel(CLASSES, hidden=hidden, weights={k: archive[k] for k in archive.files})
+    else:
+        model = load_model(CLASSES, path=path)
+    loaded = time.perf_counter()
+    model.forward(batch[:1])
+    first = time.perf_counter()
+
+    samples = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        model.forward(batch)
+        samples.append((time.perf_counter() - t) * 1000)
+    mem = process_memory()
+    print(json.dumps({
+        'load_ms': round((loaded - started) * 1000, 2),
+        'first_forward_ms': round((first - loaded) * 1000, 2),
+        'batch8_ms': round(float(np.median(samples)), 3),
+        'rss_mb': round(mem['rss_kb'] / 1024, 1),
+    }))
+
+
+def measure(mode, path, hidden, repeat):
+    out = subprocess.run([sys.executable, '-m', 'benchmarks.bench_weights', '--child', mode, path or '-',
+                          '--hidden', str(hidden), '--repeat', str(repeat)],
+                         cwd=BACKEND, check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def drift(baseline, candidate, batch):
+    ref, got = baseline.forward(batch), candidate.forward(batch)
+    return {
+        'max_logit_error': round(float(np.abs(got - ref).max()), 6),
+        'max_confidence_error': round(float(np.abs(softmax(got) - softmax(ref)).max()), 6),
+        'top1_agreement': round(float((got.argmax(axis=1) == ref.argmax(axis=1)).mean()), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hidden', type=int, default=2048)
+    parser.add_argument('--samples', type=int, default=512)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child[0], args.child[1], args.hidden, args.repeat)
+        return
+
+    baseline = ReferenceModel(CLASSES, hidden=args.hidden)
+    batch = sample_batch(args.samples, baseline.input_size, seed=11)
+    report = {'hidden': args.hidden, 'formats': {}}
+    with tempfile.TemporaryDirectory() as workdir:
+        paths = {'generate': None, 'npz': os.path.join(workdir, 'model.npz')}
+        np.savez(paths['npz'], **baseline.tensors())
+        for storage in model_format.STORAGE_DTYPES:
+            paths[storage] = os.path.join(workdir, f'model-{storage}.cpw')
+            model_format.save(paths[storage], baseline.tensors(), baseline.metadata(), storage)
+
+        print(f"{'format':<9} {'file MB':>8} {'load ms':>9} {'1st fwd ms':>11} {'batch8 ms':>10} {'rss MB':>7}  drift vs float32")
+        for mode in MODES:
+            entry = report['formats'][mode] = measure(mode, paths[mode], args.hidden, args.repeat)
+            entry['file_mb'] = round(os.path.getsize(paths[mode]) / 1e6, 1) if paths[mode] else None
+            if mode in ('float16', 'int8'):
+                entry['drift'] = drift(baseline, load_model(CLASSES, path=paths[mode]), batch)
+            d = entry.get('drift')
+            print(f"{mode:<9} {entry['file_mb'] or '-':>8} {entry['load_ms']:>9.2f} {entry['first_forward_ms']:>11.2f} "
+                  f"{entry['batch8_ms']:>10.3f} {entry['rss_mb']:>7.1f}  "
+                  + (f"logit {d['max_logit_error']:.4f}, conf {d['max_confidence_error']:.4f}, "
+                     f"top-1 {d['top1_agreement']:.2%}" if d else ''))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Per-worker memory benchmark for gunicorn with preload_app
+
+Starts gunicorn (gunicorn_config.py, app:app) with 1, 2, 4, ... workers and a
+model large enough to see (--hidden 2048 is ~100 MB of weights), sends some
+detect traffic so every worker has run inference, then reads each worker's
+/proc/<pid>/smaps_rollup. With the model preloaded in the master and its
+weights read-only, each extra worker should only cost its private pages:
+the check fails (exit status 1) if mean private memory per worker grows by
+more than --tolerance as workers are added, or if it exceeds the size of
+the weights (meaning the model was copied instead of shared).
+
+    python -m benchmarks.bench_workers
+    python -m benchmarks.bench_workers --workers 1 2 4 8 16 --compare-no-preload
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from memory_report import process_memory
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def sample_jpeg():
+    import io
+    import numpy as np
+    from PIL import Image
+    buf = io.BytesIO()
+    pixels = np.random.default_rng(0).integers(0, 255, (480, 640, 3), dtype=np.uint8)
+    Image.fromarray(pixels).save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+def multipart(field, filename, data, content_type='image/jpeg'):
+    boundary = 'bench-workers-boundary'
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def wait_ready(port, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=2) as r:
+                if r.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"gunicorn did not answer on port {port} within {timeout}s")
+
+
+def worker_pids(master_pid):
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # Field 4 is the parent pid; the command name (field 2) may contain spaces
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == master_pid:
+            pids.append(int(entry))
+    return sorted(pids)
+
+
+def run_server(workers, preload, hidden, requests_per_worker, image):
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=BACKEND, MODEL_HIDDEN=str(hidden),
+               GUNICORN_PRELOAD_APP='1' if preload else '0')
+    with tempfile.TemporaryDirectory() as workdir:
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', os.path.join(BACKEND, 'gunicorn_config.py'),
+             '--workers', str(workers), '--bind', f'127.0.0.1:{port}', 'app:app'],
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(port)
+            body, content_type = multipart('imageFile', 'leaf.jpg', image)
+
+            def detect(_):
+                req = urllib.request.Request(f'http://127.0.0.1:{port}/api/detect', data=body,
+                                             headers={'Content-Type': content_type})
+                with urllib.request.urlopen(req, timeout=30) as r:
+                    return r.status
+
+            # Enough concurrent requests that every sync worker serves some
+            with ThreadPoolExecutor(workers * 2) as pool:
+                statuses = list(pool.map(detect, range(workers * requests_per_worker)))
+            if any(status != 200 for status in statuses):
+                raise RuntimeError(f"detect failed: {statuses}")
+
+            pids = worker_pids(proc.pid)
+            master = process_memory(proc.pid)
+            per_worker = [process_memory(pid) for pid in pids]
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(timeout=30)
+
+    mb = lambda kb: round(kb / 1024, 1)
+    return {
+        'workers': len(pids),
+        'preload': preload,
+        'master_rss_mb': mb(master['rss_kb']),
+        'worker_rss_mb': mb(sum(m['rss_kb'] for m in per_worker) / len(per_worker)),
+        'worker_shared_mb': mb(sum(m['shared_kb'] for m in per_worker) / len(per_worker)),
+        'worker_private_mb': mb(sum(m['private_kb'] for m in per_worker) / len(per_worker)),
+        'total_pss_mb': mb(master['pss_kb'] + sum(m['pss_kb'] for m in per_worker)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--hidden', type=int, default=2048, help='MODEL_HIDDEN for the reference model')
+    parser.add_argument('--requests-per-worker', type=int, default=8)
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed growth of mean private MB per worker, as a fraction')
+    parser.add_argument('--compare-no-preload', action='store_true', help='also measure without preload_app')
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    if process_memory()['private_kb'] is None:
+        sys.exit("smaps_rollup is not available; this benchmark needs Linux 4.14+")
+
+    from inference import ReferenceModel
+    weights_mb = round(ReferenceModel(4, hidden=args.hidden).nbytes / 2**20, 1)
+    print(f"reference model, hidden={args.hidden}: {weights_mb} MB of weights")
+
+    image = sample_jpeg()
+    modes = [True, False] if args.compare_no_preload else [True]
+    report = {'weights_mb': weights_mb, 'runs': []}
+    for preload in modes:
+        for workers in args.workers:
+            run = run_server(workers, preload, args.hidden, args.requests_per_worker, image)
+            report['runs'].append(run)
+            print(f"preload={'on ' if preload else 'off'} workers={run['workers']:>3}  "
+                  f"master rss {run['master_rss_mb']:7.1f} MB | per worker: rss {run['worker_rss_mb']:7.1f} "
+                  f"shared {run['worker_shared_mb']:7.1f} private {run['worker_private_mb']:7.1f} MB | "
+                  f"total pss {run['total_pss_mb']:8.1f} MB")
+
+    preloaded = [run['worker_private_mb'] for run in report['runs'] if run['preload']]
+    growth = max(preloaded) / min(preloaded) - 1.0
+    failures = []
+    if growth > args.tolerance:
+        failures.append(f"private memory per worker grew {growth:.0%} across worker counts")
+    if max(preloaded) >= weights_mb:
+        failures.append(f"workers hold {max(preloaded)} MB private, at least the {weights_mb} MB of weights")
+    report['private_growth'] = round(growth, 3)
+    report['passed'] = not failures
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if failures:
+        sys.exit("FAIL: " + "; ".join(failures))
+    print(f"OK: private memory per worker stays flat ({growth:+.0%}) and below the weights size")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,491 @@
+"""
+Load test: detections (and logins, history pages) per second a node sustains
+
+`run` starts gunicorn with gunicorn_config.py in a fresh working directory
+(app:app for unauthenticated detection, app_v2_jwt:app for the rest) and
+drives one or more scenarios against it:
+
+- detect       POST /api/detect, no auth (app.py)
+- detect_auth  POST /api/detect with a bearer token (app_v2_jwt.py)
+- history      GET /api/history?limit=50 for a user with --history-rows rows
+- login        POST /api/auth/login (one password hash per request)
+
+Detect scenarios upload synthetic leaf photos (seeded, so every run sends
+the same bytes) cycling through --pool images per --images variant; the
+report includes how many were answered from the diagnosis cache. With
+--cold every upload carries a unique comment (same pixels, new content
+hash) and the server runs with PHASH_ENABLED=0, so each request runs
+inference.
+
+Closed loop (--concurrency N): N clients, each sending its next request as
+soon as the previous one returns. Open loop (--rate R): Poisson arrivals at
+R requests/s whatever the server does, with latency measured from the
+scheduled send time so queueing is not hidden (no coordinated omission).
+
+`compare` checks a run against a baseline and exits 1 when throughput,
+p95/p99 latency or the error rate regress beyond the given tolerances, so
+it can gate a build:
+
+    python -m benchmarks.loadtest run --scenarios detect history --concurrency 8 --duration 20 --json base.json
+    python -m benchmarks.loadtest run --scenarios detect --rate 40 --duration 20 --json new.json
+    python -m benchmarks.loadtest run --env RESULT_WRITE_MODE=write_behind --json new.json
+    python -m benchmarks.loadtest compare base.json new.json --max-throughput-drop 0.10
+
+The load generator shares the machine with the server; compare runs made on
+the same host with the same options.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import signal
+import struct
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.bench_workers import free_port, wait_ready
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SIZES = {'small': (320, 240), 'medium': (1280, 960), 'large': (4000, 3000)}
+FORMATS = {'jpeg': ('JPEG', 'jpg', 'image/jpeg'), 'png': ('PNG', 'png', 'image/png')}
+DEFAULT_IMAGES = ['small:jpeg', 'medium:jpeg', 'medium:png', 'large:jpeg']
+
+BENCH_EMAIL = 'loadtest@example.com'
+BENCH_PASSWORD = 'loadtest-password'
+BOUNDARY = 'loadtest-boundary'
+
+# ============================================================================
+# SYNTHETIC IMAGES
+# ============================================================================
+
+def leaf_image(size, seed):
+    """A leaf on soil with a few lesions: smooth regions, edges and texture like a field photo"""
+    import numpy as np
+    from PIL import Image, ImageDraw, ImageFilter
+    rng = random.Random(seed)
+    width, height = size
+    noise = np.random.default_rng(seed).normal(0, 12, (height, width, 1))
+    soil = np.clip(np.array([96, 72, 48]) + noise, 0, 255).astype(np.uint8)
+    img = Image.fromarray(soil)
+
+    leaf = Image.new('RGBA', size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(leaf)
+    cx, cy = width / 2, height / 2
+    rx, ry = width * rng.uniform(0.28, 0.42), height * rng.uniform(0.18, 0.3)
+    green = (rng.randint(40, 90), rng.randint(110, 170), rng.randint(30, 70), 255)
+    draw.ellipse((cx - rx, cy - ry, cx + rx, cy + ry), fill=green)
+    draw.line((cx - rx, cy, cx + rx, cy), fill=(170, 200, 120, 255), width=max(1, width // 200))
+    for _ in range(rng.randint(3, 12)):
+        sx, sy = cx + rng.uniform(-0.7, 0.7) * rx, cy + rng.uniform(-0.6, 0.6) * ry
+        r = min(width, height) * rng.uniform(0.01, 0.04)
+        draw.ellipse((sx - r * 1.6, sy - r * 1.6, sx + r * 1.6, sy + r * 1.6), fill=(190, 180, 60, 200))
+        draw.ellipse((sx - r, sy - r, sx + r, sy + r), fill=(90, 55, 30, 255))
+    leaf = leaf.rotate(rng.uniform(-40, 40), resample=Image.BICUBIC, center=(cx, cy))
+    img.paste(leaf, (0, 0), leaf)
+    return img.filter(ImageFilter.GaussianBlur(radius=max(1, width // 800)))
+
+
+def image_pool(variants, per_variant, seed):
+    """[(filename, content type, bytes)] for every variant, per_variant distinct images each"""
+    pool = []
+    for v, variant in enumerate(variants):
+        size_name, format_name = variant.split(':')
+        pil_format, ext, content_type = FORMATS[format_name]
+        for i in range(per_variant):
+            buf = io.BytesIO()
+            leaf_image(SIZES[size_name], seed * 100003 + v * 1009 + i).save(buf, pil_format, quality=90)
+            pool.append((f'leaf-{size_name}-{i}.{ext}', content_type, buf.getvalue()))
+    return pool
+
+
+def uniquify(data, n):
+    """Same pixels, different bytes: a JPEG comment segment or PNG text chunk carrying n"""
+    tag = f'loadtest {n}'.encode()
+    if data[:2] == b'\xff\xd8':
+        return data[:2] + b'\xff\xfe' + struct.pack('>H', len(tag) + 2) + tag + data[2:]
+    chunk = b'tEXt' + b'Comment\0' + tag
+    # After the signature (8 bytes) and IHDR (25 bytes)
+    return data[:33] + struct.pack('>I', len(chunk) - 4) + chunk + struct.pack('>I', zlib.crc32(chunk)) + data[33:]
+
+
+def multipart(filename, content_type, data):
+    return (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="imageFile"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n').encode() + data + f'\r\n--{BOUNDARY}--\r\n'.encode()
+
+# ============================================================================
+# SERVERS
+# ============================================================================
+
+class Server:
+    """gunicorn with gunicorn_config.py serving one app from its own working directory"""
+
+    def __init__(self, app, workers, env):
+        self.app = app
+        self.port = free_port()
+        self.context = {}
+        self.workdir = tempfile.TemporaryDirectory(prefix='loadtest-')
+        server_env = dict(os.environ, PYTHONPATH=BACKEND, **env)
+        self.log = open(os.path.join(self.workdir.name, 'gunicorn.log'), 'w')
+        self.proc = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', os.path.join(BACKEND, 'gunicorn_config.py'),
+             '--workers', str(workers), '--bind', f'127.0.0.1:{self.port}', app],
+            cwd=self.workdir.name, env=server_env, stdout=self.log, stderr=subprocess.STDOUT)
+        try:
+            wait_ready(self.port)
+        except BaseException:
+            self.stop()
+            raise
+
+    @property
+    def database(self):
+        return os.path.join(self.workdir.name, 'crop_portal.db')
+
+    def stop(self):
+        self.proc.send_signal(signal.SIGTERM)
+        try:
+            self.proc.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.log.close()
+        self.workdir.cleanup()
+
+
+def request(port, method, path, body=None, headers=None, timeout=30.0):
+    """(status, parsed JSON or None)"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        data = response.read()
+    finally:
+        conn.close()
+    try:
+        payload = json.loads(data) if data else None
+    except ValueError:
+        payload = None
+    return response.status, payload
+
+
+def register(port):
+    body = json.dumps({'email': BENCH_EMAIL, 'name': 'Load Test', 'password': BENCH_PASSWORD})
+    status, payload = request(port, 'POST', '/api/auth/register', body, {'Content-Type': 'application/json'})
+    if status != 201:
+        raise RuntimeError(f"could not register the load test user: {status} {payload}")
+    return payload['token']
+
+
+def seed_history(database, rows):
+    with sqlite3.connect(database) as conn:
+        # The server has synced DISEASE_DB into the diseases table by now
+        disease_id = conn.execute('SELECT MIN(id) FROM diseases').fetchone()[0]
+        conn.executemany('''
+            INSERT INTO analysis_results (user_email, disease_id, confidence, model_version, filename)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(BENCH_EMAIL, disease_id, 0.9, 'seeded', f'seed-{i}.jpg') for i in range(rows)])
+
+# ============================================================================
+# SCENARIOS
+# ============================================================================
+
+SCENARIO_APPS = {
+    'detect': 'app:app',
+    'detect_auth': 'app_v2_jwt:app',
+    'history': 'app_v2_jwt:app',
+    'login': 'app_v2_jwt:app',
+}
+
+
+def build_scenario(name, server, images, context, cold=False):
+    """Return a function issuing one request; it returns (status, payload)"""
+    port = server.port
+    if name in ('detect', 'detect_auth'):
+        bodies = [multipart(*image) for image in images]
+        headers = {'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'}
+        if name == 'detect_auth':
+            headers['Authorization'] = f"Bearer {context['token']}"
+        counter = iter(range(sys.maxsize))
+        lock = threading.Lock()
+
+        def detect():
+            with lock:
+                n = next(counter)
+            if cold:
+                filename, content_type, data = images[n % len(images)]
+                body = multipart(filename, content_type, uniquify(data, f'{name} {n}'))
+            else:
+                body = bodies[n % len(bodies)]
+            return request(port, 'POST', '/api/detect', body, headers)
+        return detect
+    if name == 'history':
+        headers = {'Authorization': f"Bearer {context['token']}"}
+        return lambda: request(port, 'GET', '/api/history?limit=50', headers=headers)
+    if name == 'login':
+        body = json.dumps({'email': BENCH_EMAIL, 'password': BENCH_PASSWORD})
+        return lambda: request(port, 'POST', '/api/auth/login', body, {'Content-Type': 'application/json'})
+    raise ValueError(f"Unknown scenario '{name}'")
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.cached = 0
+        self.diagnosed = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency_ms, status, payload):
+        with self._lock:
+            self.latencies.append(latency_ms)
+            self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+            if not isinstance(status, int) or status >= 400:
+                self.errors += 1
+            elif isinstance(payload, dict) and 'cached' in payload:
+                self.diagnosed += 1
+                self.cached += bool(payload['cached'])
+
+
+def timed(fire, recorder, intended=None):
+    started = time.perf_counter() if intended is None else intended
+    try:
+        status, payload = fire()
+    except (OSError, http.client.HTTPException) as e:
+        status, payload = f'error:{type(e).__name__}', None
+    recorder.record((time.perf_counter() - started) * 1000, status, payload)
+
+
+def closed_loop(fire, concurrency, duration):
+    recorder = Recorder()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        while time.perf_counter() < deadline:
+            timed(fire, recorder)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return recorder, time.perf_counter() - started
+
+
+def open_loop(fire, rate, duration, max_outstanding, seed):
+    recorder = Recorder()
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    offset = 0.0
+    with ThreadPoolExecutor(max_outstanding) as pool:
+        while True:
+            offset += rng.expovariate(rate)
+            if offset >= duration:
+                break
+            scheduled = started + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            # Latency counts from the scheduled time, including any wait for a free client thread
+            pool.submit(timed, fire, recorder, scheduled)
+    return recorder, time.perf_counter() - started
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, int(q / 100.0 * (len(ordered) - 1) + 0.5))], 2)
+
+
+def summarize(recorder, elapsed):
+    ordered = sorted(recorder.latencies)
+    total = len(ordered)
+    ok = total - recorder.errors
+    return {
+        'requests': total,
+        'ok': ok,
+        'errors': recorder.errors,
+        'error_rate': round(recorder.errors / total, 4) if total else 0.0,
+        'throughput_rps': round(ok / elapsed, 2) if elapsed else 0.0,
+        'elapsed_s': round(elapsed, 2),
+        'latency_ms': {
+            'p50': percentile(ordered, 50),
+            'p95': percentile(ordered, 95),
+            'p99': percentile(ordered, 99),
+            'max': round(ordered[-1], 2) if ordered else None,
+            'mean': round(sum(ordered) / total, 2) if total else None,
+        },
+        'statuses': recorder.statuses,
+        'cache_hit_rate': round(recorder.cached / recorder.diagnosed, 4) if recorder.diagnosed else None,
+    }
+
+# ============================================================================
+# COMMANDS
+# ============================================================================
+
+def git_revision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND,
+                             capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def cmd_run(args):
+    env = dict(item.split('=', 1) for item in args.env)
+    if args.cold:
+        env.setdefault('PHASH_ENABLED', '0')
+    images = image_pool(args.images, args.pool, args.seed) if {'detect', 'detect_auth'} & set(args.scenarios) else []
+    if images:
+        sizes = sorted(len(data) for _, _, data in images)
+        print(f"{len(images)} synthetic images ({', '.join(args.images)}), "
+              f"{sizes[0] / 1024:.0f}-{sizes[-1] / 1024:.0f} KB")
+    mode = {'mode': 'open', 'rate': args.rate} if args.rate else {'mode': 'closed', 'concurrency': args.concurrency}
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'workers': args.workers,
+            'duration_s': args.duration,
+            'seed': args.seed,
+            'images': args.images,
+            'pool': args.pool,
+            'cold': args.cold,
+            'env': env,
+            **mode,
+        },
+        'scenarios': {},
+    }
+
+    servers = {}
+    try:
+        for name in args.scenarios:
+            app = SCENARIO_APPS[name]
+            if app not in servers:
+                server = servers[app] = Server(app, args.workers, env)
+                if app.startswith('app_v2_jwt'):
+                    server.context['token'] = register(server.port)
+                    seed_history(server.database, args.history_rows)
+            server = servers[app]
+            fire = build_scenario(name, server, images, server.context, args.cold)
+            if args.warmup:
+                closed_loop(fire, args.concurrency, args.warmup)
+            if args.rate:
+                recorder, elapsed = open_loop(fire, args.rate, args.duration, args.max_outstanding, args.seed)
+            else:
+                recorder, elapsed = closed_loop(fire, args.concurrency, args.duration)
+            result = report['scenarios'][name] = summarize(recorder, elapsed)
+            lat = result['latency_ms']
+            hits = f", cache hits {result['cache_hit_rate']:.0%}" if result['cache_hit_rate'] is not None else ''
+            print(f"{name:<12} {result['throughput_rps']:>8.1f} req/s  p50 {lat['p50']} ms  p95 {lat['p95']} ms  "
+                  f"p99 {lat['p99']} ms  errors {result['errors']}/{result['requests']}{hits}")
+    finally:
+        for server in servers.values():
+            server.stop()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"wrote {args.json}")
+
+
+def compare(baseline, candidate, max_throughput_drop, max_latency_increase, max_error_increase):
+    """Per-scenario rows (scenario, metric, baseline, candidate, change, failed)"""
+    rows = []
+    for name in sorted(set(baseline['scenarios']) & set(candidate['scenarios'])):
+        base, new = baseline['scenarios'][name], candidate['scenarios'][name]
+        checks = [('throughput_rps', base['throughput_rps'], new['throughput_rps'], -max_throughput_drop)]
+        for q in ('p95', 'p99'):
+            checks.append((f'{q}_ms', base['latency_ms'][q], new['latency_ms'][q], max_latency_increase))
+        for metric, old, value, limit in checks:
+            if not old or value is None:
+                rows.append((name, metric, old, value, None, False))
+                continue
+            change = value / old - 1.0
+            failed = change < limit if limit < 0 else change > limit
+            rows.append((name, metric, old, value, change, failed))
+        delta = new['error_rate'] - base['error_rate']
+        rows.append((name, 'error_rate', base['error_rate'], new['error_rate'], delta, delta > max_error_increase))
+    return rows
+
+
+def cmd_compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    for key in ('mode', 'workers', 'concurrency', 'rate', 'images', 'cold'):
+        if baseline['meta'].get(key) != candidate['meta'].get(key):
+            print(f"warning: runs differ in {key}: {baseline['meta'].get(key)} vs {candidate['meta'].get(key)}")
+
+    rows = compare(baseline, candidate, args.max_throughput_drop, args.max_latency_increase,
+                   args.max_error_increase)
+    if not rows:
+        sys.exit("no scenarios in common")
+    print(f"{'scenario':<12} {'metric':<15} {'baseline':>10} {'candidate':>10} {'change':>8}")
+    for name, metric, old, value, change, failed in rows:
+        shown = '-' if change is None else (f'{change:+.4f}' if metric == 'error_rate' else f'{change:+.1%}')
+        print(f"{name:<12} {metric:<15} {old if old is not None else '-':>10} "
+              f"{value if value is not None else '-':>10} {shown:>8}{'  REGRESSION' if failed else ''}")
+    failures = [row for row in rows if row[5]]
+    if failures:
+        sys.exit(f"FAIL: {len(failures)} regression(s) beyond tolerance")
+    print("OK: no regressions beyond tolerance")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='start gunicorn and drive scenarios against it')
+    run.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIO_APPS),
+                     default=['detect', 'detect_auth', 'history', 'login'])
+    run.add_argument('--workers', type=int, default=2)
+    run.add_argument('--duration', type=float, default=15.0, help='measured seconds per scenario')
+    run.add_argument('--warmup', type=float, default=2.0, help='unmeasured seconds before each scenario')
+    run.add_argument('--concurrency', type=int, default=8, help='closed-loop clients (also used for warmup)')
+    run.add_argument('--rate', type=float, help='open-loop arrivals per second (default: closed loop)')
+    run.add_argument('--max-outstanding', type=int, default=256, help='open-loop client threads')
+    run.add_argument('--images', nargs='+', default=DEFAULT_IMAGES, metavar='SIZE:FORMAT',
+                     help=f"sizes {', '.join(SIZES)}; formats {', '.join(FORMATS)}")
+    run.add_argument('--pool', type=int, default=16, help='distinct images per variant')
+    run.add_argument('--cold', action='store_true', help='defeat the diagnosis cache: every upload runs inference')
+    run.add_argument('--history-rows', type=int, default=500)
+    run.add_argument('--seed', type=int, default=1)
+    run.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='server environment')
+    run.add_argument('--json', help='write the report to this file')
+
+    cmp = commands.add_parser('compare', help='fail if a run regressed against a baseline')
+    cmp.add_argument('baseline')
+    cmp.add_argument('candidate')
+    cmp.add_argument('--max-throughput-drop', type=float, default=0.10)
+    cmp.add_argument('--max-latency-increase', type=float, default=0.20, help='for p95 and p99')
+    cmp.add_argument('--max-error-increase', type=float, default=0.01, help='absolute error rate')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        for variant in args.images:
+            size, _, fmt = variant.partition(':')
+            if size not in SIZES or fmt not in FORMATS:
+                parser.error(f"bad image variant '{variant}'")
+        cmd_run(args)
+    else:
+        cmd_compare(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+"""
+Crop advisory catalog with an in-memory search index
+/api/crops serves Frontend/crops.json (or CROPS_FILE) through an inverted
+index instead of shipping the whole catalog to the browser and filtering
+it on every keystroke. Words of name, crop, type and description map to
+posting lists of entry ids. A query token matches the words it is a prefix
+of and, from three characters on, words it occurs inside (found through a
+trigram index over the vocabulary). Entries must match every token; they
+rank by how and where each token matched (an exact word in the name beats
+a prefix in the description), then by catalog order. risk and type are
+facets: results can be filtered on them, and every response counts the
+matches per value.
+
+Postings are stored back to back in vocabulary order, so all words sharing
+a prefix form one contiguous slice. Results for one- and two-letter
+prefixes are built with the index; longer tokens and whole queries are
+cached as they are asked, so typing a word costs a dictionary lookup and a
+page copy per keystroke. The file is checked for changes every
+CROPS_RELOAD_SECONDS and re-indexed on a background thread; requests keep
+using the old index until the new one is ready.
+"""
+
+import os
+import re
+import json
+import time
+import bisect
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+CROPS_FILE = os.getenv('CROPS_FILE', os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Frontend', 'crops.json'))
+CROPS_RELOAD_SECONDS = float(os.getenv('CROPS_RELOAD_SECONDS', 2))
+CROPS_PAGE_SIZE = int(os.getenv('CROPS_PAGE_SIZE', 24))
+CROPS_MAX_PAGE_SIZE = int(os.getenv('CROPS_MAX_PAGE_SIZE', 100))
+# Memory for cached token and query results (each); a result holds one id per match
+CROPS_CACHE_MB = float(os.getenv('CROPS_CACHE_MB', 32))
+
+# Where a word occurs, most significant first
+SEARCH_FIELDS = (('name', 4), ('crop', 3), ('type', 2), ('description', 1))
+FACETS = ('risk', 'type')
+# How a query token matches a word; a token's score is field weight x match kind
+EXACT, PREFIX, INFIX = 3, 2, 1
+EAGER_PREFIX_LENGTH = 2
+MAX_QUERY_TOKENS = 8
+
+_WORD = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return _WORD.findall(str(text).lower())
+
+
+class _LRU:
+    """Least-recently-used cache bounded by the bytes of the arrays it holds"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.capacity and len(self._items) > 1:
+                self.nbytes -= self._items.popitem(last=False)[1][1]
+
+    def __len__(self):
+        return len(self._items)
+
+
+class _Result:
+    """Matching entry ids, best first, and facet counts for one query and filter set"""
+
+    __slots__ = ('ids', 'facets')
+
+    def __init__(self, ids, facets):
+        self.ids = ids
+        self.facets = facets
+
+# ============================================================================
+# INDEX
+# ============================================================================
+
+class CatalogIndex:
+    """Immutable search index over one version of the catalog"""
+
+    def __init__(self, entries, version=None, cache_bytes=int(CROPS_CACHE_MB * 1024 * 1024)):
+        self.entries = entries
+        # Identifies the data indexed (file mtime and size), the same in every worker
+        self.version = version
+        self.size = len(entries)
+
+        self.facet_values, self.facet_codes = {}, {}
+        for facet in FACETS:
+            raw = [str(entry.get(facet, '')) for entry in entries]
+            values = sorted(set(raw))
+            code = {value: i for i, value in enumerate(values)}
+            self.facet_values[facet] = values
+            self.facet_codes[facet] = np.fromiter((code[v] for v in raw), dtype=np.int32, count=self.size)
+
+        # word -> {entry id: best field weight}; ids arrive in increasing order
+        postings = {}
+        for i, entry in enumerate(entries):
+            for field, weight in SEARCH_FIELDS:
+                for word in tokenize(entry.get(field, '')):
+                    seen = postings.setdefault(word, {})
+                    if seen.get(i, 0) < weight:
+                        seen[i] = weight
+
+        self.vocab = sorted(postings)
+        self._offsets = np.zeros(len(self.vocab) + 1, dtype=np.int64)
+        np.cumsum([len(postings[word]) for word in self.vocab], out=self._offsets[1:])
+        self._ids = np.empty(int(self._offsets[-1]), dtype=np.int32)
+        self._weights = np.empty(int(self._offsets[-1]), dtype=np.int16)
+        trigrams = {}
+        for k, word in enumerate(self.vocab):
+            start, end = self._offsets[k], self._offsets[k + 1]
+            self._ids[start:end] = np.fromiter(postings[word].keys(), dtype=np.int32, count=end - start)
+            self._weights[start:end] = np.fromiter(postings[word].values(), dtype=np.int16, count=end - start)
+            for gram in {word[j:j + 3] for j in range(len(word) - 2)}:
+                trigrams.setdefault(gram, []).append(k)
+        self._trigrams = {gram: np.array(words, dtype=np.int32) for gram, words in trigrams.items()}
+
+        self._tokens = _LRU(cache_bytes)
+        self._queries = _LRU(cache_bytes)
+        # Short prefixes match the most words; build them up front so no query pays for them
+        self._eager = {}
+        for prefix in {word[:n] for word in self.vocab for n in range(1, EAGER_PREFIX_LENGTH + 1)}:
+            self._eager[prefix] = self._match_token(prefix)
+
+    @property
+    def nbytes(self):
+        eager = sum(ids.nbytes + scores.nbytes for ids, scores in self._eager.values())
+        return self._ids.nbytes + self._weights.nbytes + self._offsets.nbytes + eager
+
+    # --------------------------------------------------------------- matching
+
+    def _words(self, token):
+        """Vocabulary range of words starting with token, plus words containing it elsewhere"""
+        lo = bisect.bisect_left(self.vocab, token)
+        hi = bisect.bisect_left(self.vocab, token + '\U0010ffff', lo)
+        infix = []
+        if len(token) >= 3:
+            candidates = None
+            for gram in {token[j:j + 3] for j in range(len(token) - 2)}:
+                words = self._trigrams.get(gram)
+                if words is None:
+                    return lo, hi, []
+                candidates = words if candidates is None else np.intersect1d(candidates, words, assume_unique=True)
+            infix = [k for k in candidates.tolist() if not lo <= k < hi and token in self.vocab[k]]
+        return lo, hi, infix
+
+    def _match_token(self, token):
+        """(ids, scores) of entries matching one token, best first then catalog order"""
+        lo, hi, infix = self._words(token)
+        exact = lo < hi and self.vocab[lo] == token
+        if hi - lo == 1 and not infix:
+            # One word: its postings are already unique and in id order
+            start, end = self._offsets[lo], self._offsets[hi]
+            ids, scores = self._ids[start:end], self._weights[start:end] * (EXACT if exact else PREFIX)
+        elif lo == hi and not infix:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int16)
+        else:
+            best = np.zeros(self.size, dtype=np.int16)
+            start, end = self._offsets[lo], self._offsets[hi]
+            np.maximum.at(best, self._ids[start:end], self._weights[start:end] * PREFIX)
+            if exact:
+                start, end = self._offsets[lo], self._offsets[lo + 1]
+                np.maximum.at(best, self._ids[start:end], self._weights[start:end] * EXACT)
+            for k in infix:
+                start, end = self._offsets[k], self._offsets[k + 1]
+                np.maximum.at(best, self._ids[start:end], self._weights[start:end] * INFIX)
+            ids = np.flatnonzero(best).astype(np.int32)
+            scores = best[ids]
+        # Stable sort on small integers: score descending, id order kept within a score
+        order = np.argsort(-scores, kind='stable')
+        return ids[order], scores[order]
+
+    def _token(self, token):
+        match = self._eager.get(token) or self._tokens.get(token)
+        if match is None:
+            match = self._match_token(token)
+            self._tokens.put(token, match, match[0].nbytes + match[1].nbytes)
+        return match
+
+    def _match_query(self, tokens):
+        """Entries matching every token, ranked by summed token scores"""
+        matches = sorted((self._token(token) for token in tokens), key=lambda m: len(m[0]))
+        ids, scores = matches[0]
+        if len(matches) == 1:
+            return ids
+        ids, total = ids, scores.astype(np.int32)
+        for other_ids, other_scores in matches[1:]:
+            dense = np.zeros(self.size, dtype=np.int16)
+            dense[other_ids] = other_scores
+            found = dense[ids]
+            keep = found > 0
+            ids, total = ids[keep], total[keep] + found[keep]
+        by_id = np.argsort(ids, kind='stable')
+        ids, total = ids[by_id], total[by_id]
+        return ids[np.argsort(-total, kind='stable')]
+
+    def _evaluate(self, tokens, filters):
+        ids = self._match_query(tokens) if tokens else np.arange(self.size, dtype=np.int32)
+        masks = {}
+        for facet, value in filters:
+            values = self.facet_values[facet]
+            code = values.index(value) if value in values else -1
+            masks[facet] = self.facet_codes[facet][ids] == code
+
+        # Each facet is counted with the other facets' filters applied, so the
+        # counts show what choosing a value would return
+        facets = {}
+        for facet in FACETS:
+            others = [mask for name, mask in masks.items() if name != facet]
+            subset = ids[np.logical_and.reduce(others)] if others else ids
+            counts = np.bincount(self.facet_codes[facet][subset], minlength=len(self.facet_values[facet]))
+            facets[facet] = {value: int(n) for value, n in zip(self.facet_values[facet], counts) if n}
+        if masks:
+            ids = ids[np.logical_and.reduce(list(masks.values()))]
+        return _Result(ids, facets)
+
+    # ------------------------------------------------------------------ query
+
+    def search(self, query='', filters=None, page=1, per_page=None):
+        """One page of matches with facet counts; filters maps facet -> required value"""
+        tokens = tuple(dict.fromkeys(tokenize(query or '')))[:MAX_QUERY_TOKENS]
+        filters = tuple(sorted((facet, str(value)) for facet, value in (filters or {}).items()
+                               if facet in FACETS and value))
+        key = (tokens, filters)
+        result = self._queries.get(key)
+        if result is None:
+            result = self._evaluate(tokens, filters)
+            self._queries.put(key, result, result.ids.nbytes)
+
+        per_page = min(max(1, per_page or CROPS_PAGE_SIZE), CROPS_MAX_PAGE_SIZE)
+        page = max(1, page or 1)
+        start = (page - 1) * per_page
+        total = len(result.ids)
+        return {
+            "query": query or '',
+            "filters": dict(filters),
+            "total": total,
+            "page": page,
+            "per_page": per_page,
+            "pages": -(-total // per_page),
+            "results": [self.entries[i] for i in result.ids[start:start + per_page].tolist()],
+            "facets": result.facets,
+        }
+
+    def stats(self):
+        return {'entries': self.size, 'words': len(self.vocab), 'index_bytes': self.nbytes,
+                'cached_tokens': len(self._tokens), 'cached_queries': len(self._queries),
+                'cache_bytes': self._tokens.nbytes + self._queries.nbytes}
+
+# ============================================================================
+# HOT-RELOADING CATALOG
+# ============================================================================
+
+class CropCatalog:
+    """The catalog file's current index, rebuilt in the background when the file changes"""
+
+    def __init__(self, path=CROPS_FILE, reload_seconds=CROPS_RELOAD_SECONDS):
+        self.path = path
+        self.reload_seconds = reload_seconds
+        self.reloads = 0
+        self.last_error = None
+        self._index = CatalogIndex([])
+        self._signature = None
+        self._checked = time.monotonic()
+        self._reloading = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _load(self):
+        signature = self._stat()
+        started = time.perf_counter()
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            entries = data['crops'] if isinstance(data, dict) else data
+            if not isinstance(entries, list):
+                raise ValueError("expected a list of entries or {\"crops\": [...]}")
+            index = CatalogIndex(entries, signature)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            # Keep serving the previous version until the file is fixed
+            self.last_error = f"{type(e).__name__}: {e}"
+            logger.error("Could not load crop catalog %s: %s", self.path, self.last_error)
+            self._signature = signature
+            return
+        self._index, self._signature, self.last_error = index, signature, None
+        self.reloads += 1
+        logger.info("Indexed %d catalog entries (%d words) from %s in %.0f ms",
+                    index.size, len(index.vocab), self.path, (time.perf_counter() - started) * 1000)
+
+    def _reload(self):
+        try:
+            self._load()
+        finally:
+            with self._lock:
+                self._reloading = False
+
+    def index(self):
+        now = time.monotonic()
+        if now - self._checked >= self.reload_seconds:
+            self._checked = now
+            if self._stat() != self._signature:
+                with self._lock:
+                    start, self._reloading = not self._reloading, True
+                if start:
+                    threading.Thread(target=self._reload, name='crop-catalog-reload', daemon=True).start()
+        return self._index
+
+    @property
+    def version(self):
+        return self.index().version
+
+    def search(self, query='', filters=None, page=1, per_page=None):
+        return self.index().search(query, filters, page, per_page)
+
+    def stats(self):
+        return {'path': self.path, 'reloads': self.reloads, 'last_error': self.last_error,
+                **self._index.stats()}
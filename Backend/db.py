@@ -0,0 +1,119 @@
+"""
+Shared SQLite access layer
+Keeps one long-lived connection per thread (and per process, so nothing is
+shared across a gunicorn fork) instead of connecting on every query. Each
+connection runs in WAL mode so readers never block the writer, with a busy
+timeout instead of immediate 'database is locked' errors.
+"""
+
+import os
+import time
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_CACHED_STATEMENTS = int(os.getenv('SQLITE_CACHED_STATEMENTS', 256))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', 16 * 1024))
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+
+# ============================================================================
+# CONNECTIONS
+# ============================================================================
+
+class TimedConnection(sqlite3.Connection):
+    """Reports the time spent in each statement to metrics (rows fetched later are not included)"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.observe_query(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.observe_query(sql, time.perf_counter() - started)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            metrics.observe_query('COMMIT', time.perf_counter() - started)
+
+
+def connect(database):
+    """Open a new connection with the tuned pragmas applied"""
+    conn = sqlite3.connect(
+        database,
+        timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0,
+        cached_statements=SQLITE_CACHED_STATEMENTS,
+        check_same_thread=False,
+        factory=TimedConnection,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+    conn.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+    conn.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+
+_local = threading.local()
+
+def get_connection(database):
+    """Return this thread's connection to database, opening it on first use"""
+    pid = os.getpid()
+    if getattr(_local, 'pid', None) != pid:
+        # Connections inherited across fork must never be used by the child
+        _local.pid = pid
+        _local.connections = {}
+    conn = _local.connections.get(database)
+    if conn is None:
+        conn = _local.connections[database] = connect(database)
+    return conn
+
+
+@contextmanager
+def transaction(database, immediate=False):
+    """
+    Run a block in one transaction on the pooled connection
+    immediate=True takes the write lock up front, avoiding upgrade deadlocks
+    in read-then-write blocks.
+    """
+    conn = get_connection(database)
+    if immediate:
+        conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def close_connections():
+    """Close this thread's connections (e.g. at worker exit)"""
+    for conn in getattr(_local, 'connections', {}).values():
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    _local.connections = {}
@@ -0,0 +1,250 @@
+"""
+Detection pipeline shared by app.py and app_v2_jwt.py
+Everything between a stored upload and a saved analysis result: the
+diagnosis cache, the near-duplicate index, inference (through the daemon
+when one is running, else the in-process batcher), the result writer and
+the async job queue. Inference runs holding one of the host's
+admission.inference_slot()s, taken only once the upload is on disk, so a
+slow client never holds one. The apps differ only in how they
+authenticate and where the user's email comes from, so they build one
+DetectionPipeline each and keep just their routes.
+
+init_app() registers the read-only routes the apps serve identically:
+/api/inference/stats, /api/trends and /api/metrics.
+"""
+
+import time
+import logging
+from datetime import datetime
+
+from diseases import DISEASE_DB, DiseaseCatalog
+from inference import get_engine
+from imaging import InvalidImage
+from batching import get_batcher
+from inference_server import InferenceClient
+from jobs import JobQueue, PermanentJobError
+from diagnosis_cache import DiagnosisCache
+from phash import phash, NearDuplicateIndex, PHASH_ENABLED
+from write_behind import WriteBehindWriter
+from memory_report import process_memory
+import rollups
+import trends
+import admission
+import metrics
+from metrics import stage, record_stage
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_INSERT = '''
+    INSERT INTO analysis_results
+    (user_email, disease_id, confidence, model_version, filename)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+QUEUE_TIMEOUT = admission.DETECT_QUEUE_TIMEOUT_MS / 1000.0
+
+
+def diagnose(prediction):
+    """Map a model prediction onto its DISEASE_DB entry"""
+    entry = DISEASE_DB[prediction['index']]
+    return {**entry, "confidence": round(prediction['confidence'], 4), "scores": prediction['scores']}
+
+
+class DetectionPipeline:
+    def __init__(self, database, upload_store):
+        self.database = database
+        self.upload_store = upload_store
+        # DISEASE_DB entries are stored once per version; results reference them by id
+        self.disease_catalog = DiseaseCatalog(database, DISEASE_DB)
+        # Model classes map onto DISEASE_DB entries by index; loaded once per worker
+        self.engine = get_engine([entry["disease"] for entry in DISEASE_DB])
+        self.batcher = get_batcher(self.engine)
+        # Cross-worker batching through the inference daemon when INFERENCE_SOCKET is set
+        self.inference_client = InferenceClient(self.engine, self.batcher)
+        self.diagnosis_cache = DiagnosisCache(database, self.disease_catalog)
+        self.near_duplicates = NearDuplicateIndex()
+        # Commits each row, or batches them when RESULT_WRITE_MODE=write_behind;
+        # the stats rollups are updated in the same transaction
+        self.result_writer = WriteBehindWriter(database, ANALYSIS_INSERT, after_write=rollups.apply)
+        # Queue for /api/detect?async=1; survives worker restarts
+        self.job_queue = JobQueue(database, self.run_detection_job)
+
+    # ---------------------------------------------------------------- results
+
+    def analysis_row(self, user_email, result, filename):
+        """Column values for ANALYSIS_INSERT"""
+        return (
+            user_email,
+            self.disease_catalog.id_for(result.get('disease')),
+            result.get('confidence'),
+            self.engine.model_version,
+            filename
+        )
+
+    def save_analysis_result(self, user_email, result, filename):
+        trends.observe(result.get('disease'))
+        try:
+            self.result_writer.write(self.analysis_row(user_email, result, filename))
+            logger.info("Analysis result saved for %s", user_email)
+        except Exception as e:
+            logger.exception("Error saving analysis result: %s", e)
+
+    def save_analysis_results(self, user_email, rows):
+        """Save a whole batch; in sync mode all rows commit in one transaction"""
+        trends.observe_many(self.disease_catalog.get(row[1])['disease'] for row in rows)
+        try:
+            self.result_writer.write_many(rows)
+            logger.info("%d analysis results saved for %s", len(rows), user_email)
+        except Exception as e:
+            logger.exception("Error saving batch analysis results: %s", e)
+
+    # -------------------------------------------------------------- diagnosis
+
+    def run_diagnosis(self, digest, filepath, user_email, queue_timeout=QUEUE_TIMEOUT):
+        """
+        Diagnose a stored upload
+        Exact re-uploads come from the diagnosis cache and near-identical photos
+        reuse the closest recent diagnosis; only new images run inference.
+        Raises admission.Overloaded when no inference slot frees up within
+        queue_timeout seconds (None: wait for one).
+        """
+        model_version = self.engine.model_version
+        with stage('cache'):
+            result = self.diagnosis_cache.get(digest, model_version)
+        if result is not None:
+            return {**result, "cached": True, "near_duplicate": False}
+
+        with stage('phash'):
+            image_hash = phash(filepath) if PHASH_ENABLED else None
+            match = self.near_duplicates.lookup(user_email, image_hash) if image_hash is not None else None
+        if match is not None:
+            result, distance = match
+            return {**result, "cached": True, "near_duplicate": True, "hamming_distance": distance}
+
+        with admission.inference_slot(queue_timeout):
+            timings = {}
+            started = time.perf_counter()
+            result = diagnose(self.inference_client.predict(filepath, timings))
+        self.near_duplicates.record_inference(started)
+        # preprocess() reports open/decode/resize/normalize in ms; the rest is batching and the forward pass
+        decode_seconds = sum(timings.values()) / 1000.0
+        record_stage('decode', decode_seconds)
+        record_stage('inference', time.perf_counter() - started - decode_seconds)
+        self.diagnosis_cache.put(digest, model_version, result)
+        if image_hash is not None:
+            self.near_duplicates.add(user_email, image_hash, result)
+        return {**result, "cached": False, "near_duplicate": False}
+
+    def run_batch_diagnosis(self, uploads, user_email, queue_timeout=QUEUE_TIMEOUT):
+        """
+        Diagnose several stored uploads
+        Same cache and near-duplicate shortcuts as run_diagnosis; the remaining
+        images go through the inference client together, so they share forward
+        passes with each other and with other workers' traffic. Returns one
+        result, or the InvalidImage raised while decoding, per upload. The
+        whole batch holds one inference slot (see run_diagnosis).
+        """
+        model_version = self.engine.model_version
+        outcomes = [None] * len(uploads)
+        pending, hashes = [], {}
+        for i, stored in enumerate(uploads):
+            result = self.diagnosis_cache.get(stored.digest, model_version)
+            if result is not None:
+                outcomes[i] = {**result, "cached": True, "near_duplicate": False}
+                continue
+            try:
+                image_hash = phash(stored.path) if PHASH_ENABLED else None
+            except InvalidImage as e:
+                outcomes[i] = e
+                continue
+            if image_hash is not None:
+                match = self.near_duplicates.lookup(user_email, image_hash)
+                if match is not None:
+                    result, distance = match
+                    outcomes[i] = {**result, "cached": True, "near_duplicate": True, "hamming_distance": distance}
+                    continue
+            hashes[i] = image_hash
+            pending.append(i)
+
+        if not pending:
+            return outcomes
+        with admission.inference_slot(queue_timeout):
+            started = time.perf_counter()
+            predictions = self.inference_client.predict_many([uploads[i].path for i in pending])
+        self.near_duplicates.record_inference(started, len(pending))
+        for i, prediction in zip(pending, predictions):
+            if isinstance(prediction, InvalidImage):
+                outcomes[i] = prediction
+                continue
+            result = diagnose(prediction)
+            self.diagnosis_cache.put(uploads[i].digest, model_version, result)
+            if hashes[i] is not None:
+                self.near_duplicates.add(user_email, hashes[i], result)
+            outcomes[i] = {**result, "cached": False, "near_duplicate": False}
+        return outcomes
+
+    def run_detection_job(self, job, report_progress):
+        """Background job handler: same pipeline as the synchronous /api/detect"""
+        digest = self.upload_store.digest_from_path(job['filepath'])
+        while True:
+            # Jobs wait for an inference slot rather than fail, renewing their
+            # lease between tries so no other worker reclaims them meanwhile
+            report_progress(0.1)
+            try:
+                result = self.run_diagnosis(digest, job['filepath'], job['user_email'],
+                                            queue_timeout=self.job_queue.lease_seconds / 3)
+                break
+            except admission.Overloaded:
+                continue
+            except InvalidImage:
+                raise PermanentJobError("File is not a valid image")
+        # Raises LeaseLost, so nothing is saved, if another worker has taken the job over
+        report_progress(0.8)
+        self.save_analysis_result(job['user_email'], result, job['filename'])
+        return {**result, "timestamp": datetime.now().isoformat(), "filename": job['filename']}
+
+    def stats(self):
+        """The /api/inference/stats payload"""
+        return {
+            "model_version": self.engine.model_version,
+            "batching": self.batcher.stats(),
+            "inference_daemon": self.inference_client.stats(),
+            "diagnosis_cache": self.diagnosis_cache.stats(),
+            "near_duplicates": self.near_duplicates.stats(),
+            "result_writes": self.result_writer.stats(),
+            "memory": process_memory()
+        }
+
+    # ------------------------------------------------------------------ flask
+
+    def init_app(self, app):
+        """Job workers and the routes both apps serve the same way"""
+        from flask import request, jsonify, Response
+
+        @app.before_request
+        def start_job_workers():
+            # Resume queued jobs after a worker restart, not only on the next async submit
+            self.job_queue.ensure_workers()
+
+        @app.route('/api/inference/stats', methods=['GET'])
+        def inference_stats():
+            """Batch-size and queue-wait histograms for tuning the batcher"""
+            return jsonify(self.stats()), 200
+
+        @app.route('/api/trends', methods=['GET'])
+        def get_trends():
+            """
+            Most detected diseases across all users, merged from every worker's in-memory counters
+            - ?k=<n> how many (default 10)
+            - ?window=<seconds> default the whole TRENDS_WINDOW_SECONDS (one hour)
+            - ?recent=<seconds> compared with the rest of the window in "change" (default 300)
+            """
+            with stage('trends'):
+                payload = trends.snapshot(request.args.get('k', 10, type=int), request.args.get('window', type=int),
+                                          request.args.get('recent', type=int))
+            return jsonify(payload), 200
+
+        @app.route('/api/metrics', methods=['GET'])
+        def prometheus_metrics():
+            """Prometheus text format, merged across every worker process"""
+            return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
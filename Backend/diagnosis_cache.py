@@ -0,0 +1,184 @@
+"""
+Diagnosis cache keyed by image hash and model version
+An in-memory LRU sits in front of a SQLite table, so re-uploads of the same
+photo skip inference in every worker, and a model upgrade never serves
+stale diagnoses.
+
+Rows hold what the model said (the disease id, the confidence and the
+class scores), not the disease's description and treatment text: that is
+joined from the diseases catalog on the way out, so a hit always shows the
+current advice. Rows older than DIAGNOSIS_CACHE_TTL_DAYS, and the oldest
+beyond DIAGNOSIS_CACHE_MAX_ROWS, are deleted every DIAGNOSIS_CACHE_PRUNE_EVERY
+writes.
+"""
+
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+DIAGNOSIS_CACHE_SIZE = int(os.getenv('DIAGNOSIS_CACHE_SIZE', 1024))
+DIAGNOSIS_CACHE_TTL_DAYS = float(os.getenv('DIAGNOSIS_CACHE_TTL_DAYS', 30))
+DIAGNOSIS_CACHE_MAX_ROWS = int(os.getenv('DIAGNOSIS_CACHE_MAX_ROWS', 100_000))
+# Writes per process between prunes of the SQLite table
+DIAGNOSIS_CACHE_PRUNE_EVERY = int(os.getenv('DIAGNOSIS_CACHE_PRUNE_EVERY', 500))
+
+# Created by migrations.py
+DIAGNOSIS_CACHE_DDL = '''
+    CREATE TABLE IF NOT EXISTS diagnosis_cache (
+        image_hash TEXT NOT NULL,
+        model_version TEXT NOT NULL,
+        disease_id INTEGER NOT NULL REFERENCES diseases(id),
+        confidence REAL NOT NULL,
+        scores TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (image_hash, model_version)
+    ) WITHOUT ROWID
+'''
+
+DIAGNOSIS_CACHE_INDEX_DDL = '''
+    CREATE INDEX IF NOT EXISTS idx_diagnosis_cache_created ON diagnosis_cache (created_at)
+'''
+
+
+class DiagnosisCache:
+    def __init__(self, database, diseases, max_entries=DIAGNOSIS_CACHE_SIZE, ttl_days=DIAGNOSIS_CACHE_TTL_DAYS,
+                 max_rows=DIAGNOSIS_CACHE_MAX_ROWS, prune_every=DIAGNOSIS_CACHE_PRUNE_EVERY):
+        self.database = database
+        # A diseases.DiseaseCatalog; scores are stored in the order of its entries
+        self.diseases = diseases
+        self.labels = [entry['disease'] for entry in diseases.entries]
+        self.max_entries = max_entries
+        self.ttl = ttl_days * 86400
+        self.max_rows = max_rows
+        self.prune_every = prune_every
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.pruned = 0
+
+    def _remember(self, key, row):
+        with self._lock:
+            self._lru[key] = row
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+
+    def _result(self, row):
+        """The diagnosis dict for a (disease_id, confidence, scores, created_at) row; None if unusable"""
+        disease_id, confidence, scores, _ = row
+        entry = self.diseases.get(disease_id)
+        if entry is None or len(scores) != len(self.labels):
+            return None
+        try:
+            # The current advice for the disease, even if the row predates it
+            entry = self.diseases.get(self.diseases.id_for(entry['disease']))
+        except KeyError:
+            return None
+        return {**entry, "confidence": confidence, "scores": dict(zip(self.labels, scores))}
+
+    def _lookup(self, key, now):
+        with self._lock:
+            row = self._lru.get(key)
+            if row is not None and row[3] > now - self.ttl:
+                self._lru.move_to_end(key)
+                self.memory_hits += 1
+                return row
+        try:
+            conn = db.get_connection(self.database)
+            found = conn.execute('''
+                SELECT disease_id, confidence, scores, created_at FROM diagnosis_cache
+                WHERE image_hash = ? AND model_version = ? AND created_at > ?
+            ''', key + (now - self.ttl,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Diagnosis cache lookup failed: %s", e)
+            found = None
+        if found is None:
+            return None
+        row = (found[0], found[1], json.loads(found[2]), found[3])
+        self._remember(key, row)
+        with self._lock:
+            self.db_hits += 1
+        return row
+
+    def get(self, image_hash, model_version, now=None):
+        """Return the cached diagnosis dict, or None"""
+        row = self._lookup((image_hash, model_version), time.time() if now is None else now)
+        result = self._result(row) if row is not None else None
+        if result is None:
+            with self._lock:
+                self.misses += 1
+        return result
+
+    def put(self, image_hash, model_version, result, now=None):
+        now = time.time() if now is None else now
+        try:
+            disease_id = self.diseases.id_for(result['disease'])
+        except KeyError:
+            return
+        scores = [result['scores'].get(label) for label in self.labels]
+        row = (disease_id, result['confidence'], scores, now)
+        self._remember((image_hash, model_version), row)
+        try:
+            with db.transaction(self.database) as conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO diagnosis_cache
+                    (image_hash, model_version, disease_id, confidence, scores, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (image_hash, model_version, disease_id, row[1], json.dumps(scores, separators=(',', ':')), now))
+        except sqlite3.Error as e:
+            logger.warning("Diagnosis cache write failed: %s", e)
+            return
+        with self._lock:
+            self._writes += 1
+            due = self.prune_every > 0 and self._writes % self.prune_every == 0
+        if due:
+            self.prune(now)
+
+    def prune(self, now=None):
+        """Delete expired rows, then the oldest beyond max_rows; returns rows deleted"""
+        now = time.time() if now is None else now
+        try:
+            with db.transaction(self.database) as conn:
+                deleted = conn.execute('DELETE FROM diagnosis_cache WHERE created_at <= ?',
+                                       (now - self.ttl,)).rowcount
+                if self.max_rows > 0:
+                    # Everything older than the max_rows-th newest row; nothing while there are fewer
+                    deleted += conn.execute('''
+                        DELETE FROM diagnosis_cache WHERE created_at < (
+                            SELECT created_at FROM diagnosis_cache ORDER BY created_at DESC LIMIT 1 OFFSET ?
+                        )
+                    ''', (self.max_rows - 1,)).rowcount
+        except sqlite3.Error as e:
+            logger.warning("Diagnosis cache prune failed: %s", e)
+            return 0
+        with self._lock:
+            self.pruned += deleted
+        return deleted
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.db_hits
+            lookups = hits + self.misses
+            return {
+                "entries_in_memory": len(self._lru),
+                "memory_hits": self.memory_hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "pruned": self.pruned,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,214 @@
+"""
+Versioned disease catalog referenced by analysis results
+Results used to copy the disease name, description and treatment text into
+every analysis_results row. Now each distinct version of a DISEASE_DB entry
+is stored once in the diseases table; results hold its integer id, plus the
+confidence and the model version. When an entry's text changes (new
+treatment advice, say), a new version row is added and old results keep
+pointing at the advice that was actually shown.
+
+DISEASE_DB, the list the model's classes map onto, lives here for both
+apps. Every worker keeps the whole table in memory (a handful of rows per
+model class), so /api/history joins rows to their disease at serialization
+time without touching SQLite again.
+
+migrate_analysis_results() is the migrations.py step that rewrites databases
+created with the old layout.
+"""
+
+import json
+import logging
+import threading
+
+import db
+from pagination import HISTORY_INDEX_DDL
+
+logger = logging.getLogger(__name__)
+
+DISEASES_DDL = '''
+    CREATE TABLE IF NOT EXISTS diseases (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        description TEXT,
+        treatment TEXT,
+        severity TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (name, version)
+    )
+'''
+
+ANALYSIS_RESULTS_DDL = '''
+    CREATE TABLE IF NOT EXISTS analysis_results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_email TEXT,
+        disease_id INTEGER NOT NULL REFERENCES diseases(id),
+        confidence REAL NOT NULL,
+        model_version TEXT,
+        filename TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_email) REFERENCES users(email)
+    )
+'''
+
+# Model classes map onto these entries by index
+DISEASE_DB = [
+    {
+        "disease": "Potato Early Blight",
+        "description": "Fungal infection characterized by concentric rings on dark spots.",
+        "treatment": ["Apply copper-based fungicides", "Improve air circulation", "Remove infected leaves"],
+        "severity": "High"
+    },
+    {
+        "disease": "Corn Common Rust",
+        "description": "Reddish-brown pustules appearing on both leaf surfaces.",
+        "treatment": ["Plant resistant varieties", "Apply fungicides early", "Crop rotation"],
+        "severity": "Medium"
+    },
+    {
+        "disease": "Tomato Mosaic Virus",
+        "description": "Mottling and yellowing of leaves with stunted growth.",
+        "treatment": ["Remove infected plants", "Control aphids", "Disinfect tools"],
+        "severity": "High"
+    },
+    {
+        "disease": "Healthy",
+        "description": "No signs of disease detected. Plant looks vigorous.",
+        "treatment": ["Continue regular watering", "Monitor weekly", "Maintain soil nutrition"],
+        "severity": "None"
+    }
+]
+
+
+def _columns(entry):
+    """(name, description, treatment JSON, severity) as stored; treatment JSON matches the old rows"""
+    return (entry['disease'], entry.get('description'), json.dumps(entry.get('treatment', [])),
+            entry.get('severity'))
+
+
+def _latest(conn, name):
+    return conn.execute('''
+        SELECT id, version, description, treatment, severity FROM diseases
+        WHERE name = ? ORDER BY version DESC LIMIT 1
+    ''', (name,)).fetchone()
+
+
+def current_ids(conn, entries):
+    """Ids of the stored versions matching entries, or None if any entry is new or changed"""
+    ids = []
+    for entry in entries:
+        name, description, treatment, severity = _columns(entry)
+        row = _latest(conn, name)
+        if row is None or tuple(row)[2:] != (description, treatment, severity):
+            return None
+        ids.append(row[0])
+    return ids
+
+
+def sync_entries(conn, entries):
+    """
+    Ids of the current version of each entry, adding a version for new or changed text
+    Run inside a write transaction so concurrent workers agree on the ids.
+    """
+    ids = []
+    for entry in entries:
+        name, description, treatment, severity = _columns(entry)
+        row = _latest(conn, name)
+        if row is not None and tuple(row)[2:] == (description, treatment, severity):
+            ids.append(row[0])
+            continue
+        version = row[1] + 1 if row is not None else 1
+        cursor = conn.execute('''
+            INSERT INTO diseases (name, version, description, treatment, severity) VALUES (?, ?, ?, ?, ?)
+        ''', (name, version, description, treatment, severity))
+        ids.append(cursor.lastrowid)
+    return ids
+
+
+def migrate_analysis_results(conn, entries):
+    """
+    Rewrite an analysis_results table that still has the text columns; returns rows migrated
+    Each distinct (disease, description, treatment) of the old rows becomes a
+    diseases version (the current one when the text matches DISEASE_DB).
+    Must run inside a transaction started with BEGIN IMMEDIATE.
+    """
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(analysis_results)')}
+    if 'disease_id' in columns or not columns:
+        return 0
+
+    conn.execute(DISEASES_DDL)
+    sync_entries(conn, entries)
+    severities = {entry['disease']: entry.get('severity') for entry in entries}
+    conn.execute('CREATE TEMP TABLE legacy_diseases (disease TEXT, description TEXT, treatment TEXT, disease_id INTEGER)')
+    for disease, description, treatment in conn.execute(
+            'SELECT DISTINCT disease, description, treatment FROM analysis_results').fetchall():
+        row = conn.execute('''
+            SELECT id FROM diseases WHERE name = ? AND description IS ? AND treatment IS ?
+            ORDER BY version DESC LIMIT 1
+        ''', (disease, description, treatment)).fetchone()
+        if row is None:
+            version = conn.execute('SELECT COALESCE(MAX(version), 0) + 1 FROM diseases WHERE name = ?',
+                                   (disease,)).fetchone()[0]
+            row = (conn.execute('''
+                INSERT INTO diseases (name, version, description, treatment, severity) VALUES (?, ?, ?, ?, ?)
+            ''', (disease, version, description, treatment, severities.get(disease))).lastrowid,)
+        conn.execute('INSERT INTO legacy_diseases VALUES (?, ?, ?, ?)', (disease, description, treatment, row[0]))
+
+    conn.execute('DROP INDEX IF EXISTS idx_analysis_results_user_created')
+    conn.execute('ALTER TABLE analysis_results RENAME TO analysis_results_legacy')
+    conn.execute(ANALYSIS_RESULTS_DDL)
+    migrated = conn.execute('''
+        INSERT INTO analysis_results (id, user_email, disease_id, confidence, model_version, filename, created_at)
+        SELECT r.id, r.user_email, l.disease_id, r.confidence, NULL, r.filename, r.created_at
+        FROM analysis_results_legacy r
+        JOIN legacy_diseases l
+          ON l.disease = r.disease AND l.description IS r.description AND l.treatment IS r.treatment
+        ORDER BY r.id
+    ''').rowcount
+    conn.execute('DROP TABLE analysis_results_legacy')
+    conn.execute('DROP TABLE temp.legacy_diseases')
+    conn.execute(HISTORY_INDEX_DDL)
+    logger.info("Migrated %d analysis results to disease ids", migrated)
+    return migrated
+
+
+class DiseaseCatalog:
+    """In-memory copy of the diseases table: ids of the current entries, and any version by id"""
+
+    def __init__(self, database, entries):
+        self.database = database
+        self.entries = entries
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self.ids = current_ids(db.get_connection(database), entries)
+        if self.ids is None:
+            # DISEASE_DB changed since the last start: the first process records the new versions
+            with db.transaction(database, immediate=True) as conn:
+                self.ids = sync_entries(conn, entries)
+        self._ids_by_name = {entry['disease']: disease_id for entry, disease_id in zip(entries, self.ids)}
+        self.reload()
+
+    def reload(self):
+        rows = db.get_connection(self.database).execute(
+            'SELECT id, name, description, treatment, severity FROM diseases').fetchall()
+        by_id = {row['id']: {
+            "disease": row['name'],
+            "description": row['description'],
+            "treatment": json.loads(row['treatment']) if row['treatment'] else [],
+            "severity": row['severity'],
+        } for row in rows}
+        with self._lock:
+            self._by_id = by_id
+
+    def id_for(self, name):
+        """Id of the current version of the entry called name"""
+        return self._ids_by_name[name]
+
+    def get(self, disease_id):
+        """The entry for an id; versions added by another process since start-up are loaded on demand"""
+        entry = self._by_id.get(disease_id)
+        if entry is None and disease_id is not None:
+            self.reload()
+            entry = self._by_id.get(disease_id)
+        return entry
+
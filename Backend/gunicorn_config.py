@@ -1,19 +1,73 @@
 # Gunicorn configuration for production deployment
+import os
+import gc
 import multiprocessing
 
 # Server socket
-bind = "0.0.0.0:5000"
+bind = os.getenv('GUNICORN_BIND', "0.0.0.0:5000")
 backlog = 2048
 
 # Worker processes
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = 'sync'
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# 'sync' holds a worker for the whole of a slow upload; with
+# uvicorn.workers.UvicornWorker (and asgi:app) the event loop reads bodies
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
 worker_connections = 1000
-timeout = 30
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
 keepalive = 2
 
+# A sync worker only reports to the arbiter between requests, so an SSE
+# stream (/api/jobs/<id>/stream) longer than timeout gets the worker killed.
+# End streams well before that; clients reconnect on the 'timeout' event.
+# Under UvicornWorker the event loop keeps reporting and streams run longer.
+if worker_class == 'sync':
+    os.environ['JOB_STREAM_TIMEOUT'] = str(min(float(os.getenv('JOB_STREAM_TIMEOUT', timeout)), timeout * 0.8))
+
+# Import the app (and load the model) once in the master; workers share the
+# weight pages copy-on-write instead of each loading its own copy
+preload_app = os.getenv('GUNICORN_PRELOAD_APP', '1').lower() in ('1', 'true', 'yes')
+
 # Logging
 errorlog = '-'
 loglevel = 'info'
 accesslog = '-'
 access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"'
+
+# Server hooks
+def on_starting(server):
+    """Once per start, before any worker exists: schema migrations and METRICS_DIR"""
+    # Workers (and the preloaded app) then only read PRAGMA user_version
+    # instead of racing each other for the write lock to run DDL
+    import db
+    import migrations
+    if migrations.MIGRATE_ON_START:
+        migrations.migrate(migrations.DEFAULT_DATABASE)
+        db.close_connections()
+
+    import metrics
+    metrics.reset()
+
+def when_ready(server):
+    """Report the master's footprint once the preloaded app is in memory"""
+    from memory_report import log_memory
+    log_memory("master (preload_app=%s)" % preload_app, log=server.log)
+
+def pre_fork(server, worker):
+    """Leave nothing behind in the master that a forked worker could trip over"""
+    if preload_app:
+        # SQLite connections must not cross a fork
+        import db
+        db.close_connections()
+        # Move everything the master allocated out of the collector's reach, so
+        # gc passes in the workers do not write to (and un-share) those pages
+        gc.freeze()
+
+def post_fork(server, worker):
+    """Per-worker startup report: what this worker shares with the master"""
+    from memory_report import log_memory
+    log_memory("worker %s" % worker.pid, log=server.log)
+
+def worker_exit(server, worker):
+    """Flush queued write-behind result rows before the worker goes away"""
+    from write_behind import drain_all
+    drain_all()
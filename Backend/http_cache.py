@@ -0,0 +1,177 @@
+"""
+Conditional GET and gzip for API responses
+Routes decorated with @conditional(version) get a strong ETag derived from
+the path, the query string and a cheap version of the data behind them
+(the id of the user's newest history row, the catalog file the index was
+built from). It is computed before the route runs, so a request whose
+If-None-Match still matches is answered 304 without querying or
+serializing anything.
+
+JSON and text responses above COMPRESS_MIN_BYTES are gzipped for clients
+that accept it; the ETag of a gzipped body gets a -gzip suffix, since it
+is a different byte sequence. Routes whose payload is the same for every
+client (shared=True, the crop catalog) also keep the finished body and its
+gzip in a per-process cache keyed by ETag, so a repeated request copies
+bytes instead of searching, serializing and compressing again.
+"""
+
+import os
+import gzip
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+
+from metrics import stage
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+COMPRESS_ENABLED = os.getenv('COMPRESS_ENABLED', '1').lower() in ('1', 'true', 'yes')
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))
+# Finished bodies of shared=True routes, plain and gzipped, per process
+RESPONSE_CACHE_MB = float(os.getenv('RESPONSE_CACHE_MB', 16))
+
+COMPRESS_MIMETYPES = ('application/json', 'text/plain')
+GZIP_SUFFIX = '-gzip'
+
+
+class _BodyCache:
+    """LRU of (body, gzipped body, mimetype) by ETag, bounded by bytes held"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, etag):
+        with self._lock:
+            item = self._items.get(etag)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(etag)
+            self.hits += 1
+            return item
+
+    def put(self, etag, body, gzipped, mimetype):
+        size = len(body) + len(gzipped or b'')
+        if size > self.capacity:
+            return
+        with self._lock:
+            if etag in self._items:
+                return
+            self._items[etag] = (body, gzipped, mimetype)
+            self.nbytes += size
+            while self.nbytes > self.capacity:
+                old_body, old_gzipped, _ = self._items.popitem(last=False)[1]
+                self.nbytes -= len(old_body) + len(old_gzipped or b'')
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {'entries': len(self._items), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses}
+
+
+body_cache = _BodyCache(int(RESPONSE_CACHE_MB * 1024 * 1024))
+
+
+def compute_etag(*parts):
+    return hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()
+
+
+def compress(body):
+    with stage('compress'):
+        return gzip.compress(body, COMPRESS_LEVEL, mtime=0)
+
+
+def _accepts_gzip(request):
+    return COMPRESS_ENABLED and request.accept_encodings.quality('gzip') > 0
+
+
+def _compressible(response):
+    return (COMPRESS_ENABLED and response.status_code == 200 and not response.is_streamed
+            and not response.direct_passthrough and 'Content-Encoding' not in response.headers
+            and response.mimetype in COMPRESS_MIMETYPES)
+
+
+def _use_gzip(response, gzipped):
+    """Swap in a gzipped body; the ETag names the new bytes"""
+    response.set_data(gzipped)
+    response.headers['Content-Encoding'] = 'gzip'
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etag + GZIP_SUFFIX, weak)
+
+
+def conditional(version, shared=False):
+    """
+    ETag and If-None-Match handling for a GET route
+    version() returns whatever the body depends on besides the URL; it must
+    be much cheaper than building the response. shared=True marks payloads
+    that are identical for every client, which may be cached whole.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated(*args, **kwargs):
+            from flask import request, make_response
+
+            etag = compute_etag(request.path, request.query_string, version())
+            cache_control = 'public, no-cache' if shared else 'private, no-cache'
+            for candidate in (etag, etag + GZIP_SUFFIX):
+                if candidate in request.if_none_match:
+                    response = make_response('', 304)
+                    response.set_etag(candidate)
+                    response.headers['Cache-Control'] = cache_control
+                    response.vary.add('Accept-Encoding')
+                    return response
+
+            cached = body_cache.get(etag) if shared else None
+            if cached is not None:
+                body, gzipped, mimetype = cached
+                response = make_response(body, 200)
+                response.mimetype = mimetype
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if shared and _compressible(response):
+                    body = response.get_data()
+                    gzipped = compress(body) if len(body) >= COMPRESS_MIN_BYTES else None
+                    body_cache.put(etag, body, gzipped, response.mimetype)
+                else:
+                    gzipped = None
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = cache_control
+            response.vary.add('Accept-Encoding')
+            if gzipped is not None and _accepts_gzip(request):
+                _use_gzip(response, gzipped)
+            return response
+
+        return decorated
+    return decorator
+
+
+def init_app(app):
+    """Gzip every compressible response the routes did not compress themselves"""
+    from flask import request
+
+    @app.after_request
+    def compress_response(response):
+        if not _compressible(response) or response.content_length is None:
+            return response
+        if response.content_length < COMPRESS_MIN_BYTES:
+            return response
+        response.vary.add('Accept-Encoding')
+        if _accepts_gzip(request):
+            _use_gzip(response, compress(response.get_data()))
+        return response
@@ -0,0 +1,317 @@
+"""
+Inference engine for crop disease detection
+Loads the model once per worker and turns uploaded images into class scores
+"""
+
+import os
+import time
+import logging
+import threading
+
+import numpy as np
+
+import imaging
+import model_format
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+MODEL_NAME = os.getenv('MODEL_NAME', 'reference')
+MODEL_PATH = os.getenv('MODEL_PATH')      # model_format weight file; overrides MODEL_NAME
+MODEL_INPUT_SIZE = int(os.getenv('MODEL_INPUT_SIZE', 64))
+MODEL_SEED = int(os.getenv('MODEL_SEED', 0))
+MODEL_HIDDEN = int(os.getenv('MODEL_HIDDEN', 128))
+INFERENCE_MAX_BATCH = int(os.getenv('INFERENCE_MAX_BATCH', 8))
+
+# Rows of a float16/int8 weight matrix converted to float32 per step
+DEQUANT_BLOCK_ROWS = 1024
+
+# ImageNet channel statistics, folded into one multiply-add per pixel
+CHANNEL_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+CHANNEL_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+# ============================================================================
+# MODELS
+# ============================================================================
+
+def freeze(array):
+    """
+    Make a weight array read-only
+    Models are loaded in the gunicorn master (preload_app) and their pages are
+    shared copy-on-write with every worker; a stray in-place update would
+    silently give that worker a private copy, so writes raise instead.
+    """
+    array = np.ascontiguousarray(array)
+    array.flags.writeable = False
+    return array
+
+class Linear:
+    """
+    y = x @ weight + bias for float32, float16 or int8 weights
+    Low-precision weights are dequantized DEQUANT_BLOCK_ROWS rows at a time
+    into a per-thread scratch buffer, so the float32 matrix is never
+    materialized and the (mapped) stored weights remain the only full copy.
+    int8 weights carry one scale per output column, applied to the result.
+    """
+
+    def __init__(self, weight, bias, scale=None):
+        self.weight = freeze(weight)
+        self.bias = freeze(np.asarray(bias, dtype=np.float32))
+        self.scale = freeze(np.asarray(scale, dtype=np.float32)) if scale is not None else None
+        self._local = threading.local()
+
+    @property
+    def nbytes(self):
+        return self.weight.nbytes + self.bias.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def _scratch(self):
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None:
+            rows = min(DEQUANT_BLOCK_ROWS, self.weight.shape[0])
+            buf = self._local.buffer = np.empty((rows, self.weight.shape[1]), dtype=np.float32)
+        return buf
+
+    def __call__(self, x):
+        if self.weight.dtype == np.float32:
+            y = x @ self.weight
+        else:
+            y = np.zeros((len(x), self.weight.shape[1]), dtype=np.float32)
+            scratch = self._scratch()
+            for start in range(0, self.weight.shape[0], len(scratch)):
+                block = self.weight[start:start + len(scratch)]
+                w = scratch[:len(block)]
+                np.copyto(w, block, casting='unsafe')
+                y += x[:, start:start + len(block)] @ w
+            if self.scale is not None:
+                y *= self.scale
+        y += self.bias
+        return y
+
+    def dequantized(self):
+        """float32 copy of the weight matrix (for export, not inference)"""
+        weight = np.asarray(self.weight, dtype=np.float32)
+        return weight * self.scale if self.scale is not None else weight
+
+class ReferenceModel:
+    """
+    Deterministic CPU reference model
+    A two-layer perceptron over the normalized RGB image. Weights come from a
+    seeded generator, so every worker on every host produces the same scores
+    for the same image and latency numbers are comparable between machines.
+    from_weights() builds the same model from a mapped weight file instead.
+    """
+
+    name = 'reference'
+
+    def __init__(self, num_classes, input_size=MODEL_INPUT_SIZE, hidden=MODEL_HIDDEN, seed=MODEL_SEED,
+                 weights=None, storage='float32'):
+        self.num_classes = num_classes
+        self.input_size = input_size
+        self.hidden = hidden
+        self.seed = seed
+        self.storage = storage
+
+        if weights is None:
+            features = input_size * input_size * 3
+            rng = np.random.default_rng(seed)
+            w1 = rng.standard_normal((features, hidden), dtype=np.float32)
+            w1 *= np.float32(1.0 / np.sqrt(features))
+            w2 = rng.standard_normal((hidden, num_classes), dtype=np.float32)
+            w2 *= np.float32(1.0 / np.sqrt(hidden))
+            weights = {'w1': w1, 'b1': np.zeros(hidden, dtype=np.float32),
+                       'w2': w2, 'b2': np.zeros(num_classes, dtype=np.float32)}
+        self.fc1 = Linear(weights['w1'], weights['b1'], weights.get('w1.scale'))
+        self.fc2 = Linear(weights['w2'], weights['b2'], weights.get('w2.scale'))
+
+    @classmethod
+    def from_weights(cls, weights):
+        """Build from a model_format.WeightFile"""
+        config = weights.metadata['config']
+        return cls(config['num_classes'], config['input_size'], config['hidden'], config['seed'],
+                   weights=weights.tensors, storage=weights.storage)
+
+    def metadata(self):
+        return {'model': self.name, 'config': {'num_classes': self.num_classes, 'input_size': self.input_size,
+                                               'hidden': self.hidden, 'seed': self.seed}}
+
+    def tensors(self):
+        """float32 weights by name, for model_format.save()"""
+        return {'w1': self.fc1.dequantized(), 'b1': self.fc1.bias,
+                'w2': self.fc2.dequantized(), 'b2': self.fc2.bias}
+
+    @property
+    def nbytes(self):
+        return self.fc1.nbytes + self.fc2.nbytes
+
+    @property
+    def version(self):
+        version = f"{self.name}-{self.input_size}px-h{self.hidden}-s{self.seed}"
+        # Reduced precision changes scores, so it must not share cached diagnoses
+        return version if self.storage == 'float32' else f"{version}-{self.storage}"
+
+    def forward(self, batch):
+        """(N, H, W, 3) float32 -> (N, num_classes) logits"""
+        x = batch.reshape(len(batch), -1)
+        h = self.fc1(x)
+        np.maximum(h, 0, out=h)
+        return self.fc2(h)
+
+
+MODEL_REGISTRY = {
+    'reference': ReferenceModel,
+}
+
+def register_model(name, factory):
+    """Register a model factory: factory(num_classes) -> model with forward()"""
+    MODEL_REGISTRY[name] = factory
+
+def load_model(num_classes, name=MODEL_NAME, path=MODEL_PATH):
+    """Build the configured model, mapping its weights from path when one is given"""
+    if path:
+        weights = model_format.load(path)
+        name = weights.metadata.get('model')
+        factory = MODEL_REGISTRY.get(name)
+        if not hasattr(factory, 'from_weights'):
+            raise ValueError(f"{path}: model '{name}' cannot be loaded from a weight file")
+        model = factory.from_weights(weights)
+        if model.num_classes != num_classes:
+            raise ValueError(f"{path} has {model.num_classes} classes but the app expects {num_classes}")
+        return model
+    if name not in MODEL_REGISTRY:
+        raise ValueError(f"Unknown model '{name}'. Available: {', '.join(MODEL_REGISTRY)}")
+    return MODEL_REGISTRY[name](num_classes)
+
+# ============================================================================
+# ENGINE
+# ============================================================================
+
+class InferenceEngine:
+    """
+    Wraps a model with preprocessing and score decoding
+    - preprocess() writes into a per-thread buffer, so no arrays are allocated per request
+    - infer() copies images into a preallocated batch buffer and runs one forward pass per chunk
+    """
+
+    def __init__(self, model, labels, max_batch_size=INFERENCE_MAX_BATCH):
+        if len(labels) != model.num_classes:
+            raise ValueError(f"Model has {model.num_classes} classes but {len(labels)} labels were given")
+        self.model = model
+        self.labels = list(labels)
+        self.max_batch_size = max_batch_size
+        self.input_size = model.input_size
+
+        shape = (self.input_size, self.input_size, 3)
+        self._batch = np.empty((max_batch_size,) + shape, dtype=np.float32)
+        self._batch_lock = threading.Lock()
+        self._local = threading.local()
+        self._shape = shape
+        self._scale = freeze((1.0 / (255.0 * CHANNEL_STD)).astype(np.float32))
+        self._shift = freeze((CHANNEL_MEAN / CHANNEL_STD).astype(np.float32))
+
+    @property
+    def model_version(self):
+        return self.model.version
+
+    def _thread_buffer(self):
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None:
+            buf = self._local.buffer = np.empty(self._shape, dtype=np.float32)
+        return buf
+
+    def preprocess(self, source, timings=None):
+        """
+        Decode an image (path or file object) into normalized model input
+        Returns a view of this thread's scratch buffer; it is overwritten by the
+        next preprocess() call on the same thread. Raises imaging.InvalidImage.
+        """
+        img = imaging.decode(source, (self.input_size, self.input_size), timings)
+        started = time.perf_counter()
+        buf = self._thread_buffer()
+        np.copyto(buf, np.asarray(img), casting='unsafe')
+        buf *= self._scale
+        buf -= self._shift
+        if timings is not None:
+            timings['normalize'] = (time.perf_counter() - started) * 1000.0
+        return buf
+
+    def logits(self, images):
+        """Run preprocessed images through the model, returning (N, num_classes) logits"""
+        chunks = []
+        for start in range(0, len(images), self.max_batch_size):
+            chunk = images[start:start + self.max_batch_size]
+            n = len(chunk)
+            with self._batch_lock:
+                batch = self._batch[:n]
+                for i, image in enumerate(chunk):
+                    batch[i] = image
+                chunks.append(self.model.forward(batch))
+        if not chunks:
+            return np.empty((0, self.model.num_classes), dtype=np.float32)
+        return np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+
+    def infer(self, images):
+        """Run preprocessed images through the model, returning one prediction per image"""
+        return self.decode(self.logits(images))
+
+    def predict_many(self, sources):
+        """
+        Classify many images in max_batch_size forward passes
+        Returns one entry per source: its prediction, or the InvalidImage
+        raised while decoding it.
+        """
+        outcomes = [None] * len(sources)
+        for start in range(0, len(sources), self.max_batch_size):
+            images, slots = [], []
+            for i in range(start, min(start + self.max_batch_size, len(sources))):
+                try:
+                    # preprocess() reuses one buffer per thread; keep a copy per image
+                    images.append(self.preprocess(sources[i]).copy())
+                    slots.append(i)
+                except imaging.InvalidImage as e:
+                    outcomes[i] = e
+            if images:
+                for i, prediction in zip(slots, self.infer(images)):
+                    outcomes[i] = prediction
+        return outcomes
+
+    def predict(self, source):
+        """Preprocess and classify a single image"""
+        return self.infer([self.preprocess(source)])[0]
+
+    def decode(self, logits):
+        """(N, num_classes) logits -> one prediction dict per row"""
+        logits = logits - logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        probs /= probs.sum(axis=1, keepdims=True)
+        best = probs.argmax(axis=1)
+        return [
+            {
+                'index': int(idx),
+                'label': self.labels[idx],
+                'confidence': float(row[idx]),
+                'scores': {label: round(float(p), 4) for label, p in zip(self.labels, row)},
+            }
+            for idx, row in zip(best, probs)
+        ]
+
+# ============================================================================
+# PER-PROCESS SINGLETON
+# ============================================================================
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine(labels):
+    """Return this process's engine, loading the model on first use"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                model = load_model(len(labels))
+                _engine = InferenceEngine(model, labels)
+                logger.info("[+] Inference engine loaded: %s (%d classes, %.1f MB of weights, pid %d)",
+                            model.version, len(labels), getattr(model, 'nbytes', 0) / 1e6, os.getpid())
+    return _engine
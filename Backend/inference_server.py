@@ -0,0 +1,454 @@
+"""
+Local inference daemon shared by all web workers
+Each gunicorn worker only batches its own traffic. The daemon holds the
+model once and serves every worker on the host over a Unix domain socket,
+so concurrent requests from different workers share one forward pass.
+
+Workers still decode and preprocess images themselves (that work scales
+with workers); only the normalized float32 tensor crosses the socket, sent
+with sendmsg() straight from the preprocessing buffer and read with
+recv_into() into the array that is batched. When INFERENCE_SOCKET is unset
+or the daemon is unreachable, workers fall back to in-process inference.
+
+Framing: every message is an 8-byte header (magic 'CP', kind, code,
+payload length as uint32 little-endian) followed by the payload. A predict
+message carries one or more images back to back (batch uploads send a
+chunk at a time) and its reply one row of logits per image.
+
+    python -m inference_server --socket /run/crop-portal/inference.sock
+    python -m inference_server --socket /run/crop-portal/inference.sock --stats
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import struct
+import logging
+import argparse
+import threading
+import socketserver
+
+import numpy as np
+
+from batching import Histogram, MicroBatcher
+from imaging import InvalidImage
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+INFERENCE_SOCKET = os.getenv('INFERENCE_SOCKET', '')          # empty: in-process inference only
+INFERENCE_SOCKET_TIMEOUT = float(os.getenv('INFERENCE_SOCKET_TIMEOUT', 5))
+INFERENCE_RETRY_SECONDS = float(os.getenv('INFERENCE_RETRY_SECONDS', 5))
+
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 250, 1000)
+
+# ============================================================================
+# PROTOCOL
+# ============================================================================
+
+FRAME = struct.Struct('<2sBBI')
+MAGIC = b'CP'
+
+OP_HELLO = 1
+OP_PREDICT = 2
+OP_STATS = 3
+
+REPLY_OK = 0x80
+REPLY_ERROR = 0x81
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def send_frame(sock, kind, payload=b'', code=0):
+    """Send header and payload with one sendmsg() call, without copying the payload"""
+    view = memoryview(payload).cast('B')
+    header = FRAME.pack(MAGIC, kind, code, len(view))
+    sent = sock.sendmsg([header, view])
+    # Short writes are rare on a local socket; finish with sendall
+    if sent < len(header):
+        sock.sendall(header[sent:])
+        sent = len(header)
+    if sent - len(header) < len(view):
+        sock.sendall(view[sent - len(header):])
+
+
+def recv_into(sock, buffer):
+    view = memoryview(buffer).cast('B')
+    got = 0
+    while got < len(view):
+        n = sock.recv_into(view[got:])
+        if n == 0:
+            raise ConnectionError("connection closed mid-message")
+        got += n
+
+
+def recv_header(sock):
+    header = bytearray(FRAME.size)
+    recv_into(sock, header)
+    magic, kind, code, length = FRAME.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError(f"bad frame magic {magic!r}")
+    return kind, code, length
+
+
+def recv_bytes(sock, length):
+    data = bytearray(length)
+    recv_into(sock, data)
+    return bytes(data)
+
+# ============================================================================
+# DAEMON
+# ============================================================================
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """One thread per worker connection, all feeding one MicroBatcher"""
+
+    daemon_threads = True
+
+    def __init__(self, path, engine):
+        self.engine = engine
+        self.batcher = MicroBatcher(engine)
+        self.image_shape = (engine.input_size, engine.input_size, 3)
+        self.image_nbytes = int(np.prod(self.image_shape)) * 4
+        self.latency_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.connections = 0
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        _remove_stale_socket(path)
+        super().__init__(path, _ConnectionHandler)
+        os.chmod(path, 0o660)
+
+    def hello(self):
+        return {'model_version': self.engine.model_version, 'num_classes': self.engine.model.num_classes,
+                'input_size': self.engine.input_size, 'pid': os.getpid()}
+
+    def stats(self):
+        with self._lock:
+            counters = {'connections': self.connections, 'requests': self.requests, 'errors': self.errors}
+        return {**self.hello(), **counters, 'latency_ms': self.latency_ms.snapshot(),
+                'batching': self.batcher.stats()}
+
+
+class _ConnectionHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server, sock = self.server, self.request
+        with server._lock:
+            server.connections += 1
+        try:
+            while True:
+                try:
+                    kind, _, length = recv_header(sock)
+                except ConnectionError:
+                    return
+                if kind == OP_PREDICT:
+                    self._predict(length)
+                elif kind in (OP_HELLO, OP_STATS):
+                    recv_bytes(sock, length)
+                    reply = server.hello() if kind == OP_HELLO else server.stats()
+                    send_frame(sock, REPLY_OK, json.dumps(reply).encode())
+                else:
+                    raise ProtocolError(f"unknown op {kind}")
+        except (OSError, ProtocolError) as e:
+            logger.warning("Inference connection dropped: %s", e)
+        finally:
+            with server._lock:
+                server.connections -= 1
+
+    def _predict(self, length):
+        # One or more images back to back; the reply holds one row of logits per image
+        server, sock = self.server, self.request
+        started = time.perf_counter()
+        count, remainder = divmod(length, server.image_nbytes)
+        if remainder or not count:
+            raise ProtocolError(f"expected a multiple of {server.image_nbytes} image bytes, got {length}")
+        # Let a batch that is forming wait for these images while they arrive
+        server.batcher.announce(count)
+        try:
+            images = np.empty((count,) + server.image_shape, dtype=np.float32)
+            recv_into(sock, images)
+        except BaseException:
+            server.batcher.withdraw(count)
+            raise
+        try:
+            logits = np.stack([p['logits'] for p in server.batcher.submit_many(images, announced=True)])
+        except Exception as e:
+            with server._lock:
+                server.errors += 1
+            send_frame(sock, REPLY_ERROR, str(e).encode())
+            return
+        send_frame(sock, REPLY_OK, np.ascontiguousarray(logits, dtype=np.float32))
+        server.latency_ms.observe((time.perf_counter() - started) * 1000.0)
+        with server._lock:
+            server.requests += count
+
+
+class _LogitsEngine:
+    """Engine view for the daemon's batcher: predictions are raw logits, decoded by the caller"""
+
+    def __init__(self, engine):
+        self._engine = engine
+        self.max_batch_size = engine.max_batch_size
+        self.input_size = engine.input_size
+        self.model = engine.model
+
+    @property
+    def model_version(self):
+        return self._engine.model_version
+
+    def infer(self, images):
+        return [{'logits': row} for row in self._engine.logits(images)]
+
+
+def _remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)
+    else:
+        raise RuntimeError(f"another inference daemon is already listening on {path}")
+    finally:
+        probe.close()
+
+# ============================================================================
+# CLIENT
+# ============================================================================
+
+class DaemonUnavailable(Exception):
+    pass
+
+
+class InferenceClient:
+    """
+    predict() through the daemon when one is configured and healthy
+    Otherwise images go to the in-process batcher. After a failure the
+    daemon is skipped for INFERENCE_RETRY_SECONDS so requests do not pay a
+    connect timeout each. A daemon serving a different model version is
+    treated the same way (diagnoses are cached per model version), so once
+    it is restarted with this worker's model it is picked up again.
+    """
+
+    def __init__(self, engine, fallback, path=INFERENCE_SOCKET, timeout=INFERENCE_SOCKET_TIMEOUT,
+                 retry_seconds=INFERENCE_RETRY_SECONDS):
+        self.engine = engine
+        self.fallback = fallback
+        self.path = path
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self.remote = 0
+        self.fallbacks = 0
+        self.latency_ms = Histogram(LATENCY_BUCKETS_MS)
+        self._down_until = 0.0
+        self._incompatible = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def predict(self, source, timings=None):
+        """Same contract as MicroBatcher.predict()"""
+        if not self.enabled or time.monotonic() < self._down_until:
+            return self.fallback.predict(source, timings)
+        image = self.engine.preprocess(source, timings)
+        started = time.perf_counter()
+        try:
+            logits = self._remote_predict(image)
+        except DaemonUnavailable as e:
+            self._mark_down(e)
+            with self._lock:
+                self.fallbacks += 1
+            return self.fallback.submit(image)
+        self.latency_ms.observe((time.perf_counter() - started) * 1000.0)
+        with self._lock:
+            self.remote += 1
+        return self.engine.decode(logits[np.newaxis])[0]
+
+    def predict_many(self, sources):
+        """
+        Same contract as InferenceEngine.predict_many()
+        Each chunk of up to max_batch_size images goes to the daemon in one
+        message, or to the in-process batcher, so batch uploads share forward
+        passes with every other request.
+        """
+        outcomes = [None] * len(sources)
+        for start in range(0, len(sources), self.engine.max_batch_size):
+            images, slots = [], []
+            for i in range(start, min(start + self.engine.max_batch_size, len(sources))):
+                try:
+                    # preprocess() reuses one buffer per thread; keep a copy per image
+                    images.append(self.engine.preprocess(sources[i]).copy())
+                    slots.append(i)
+                except InvalidImage as e:
+                    outcomes[i] = e
+            if images:
+                for i, prediction in zip(slots, self._predict_images(images)):
+                    outcomes[i] = prediction
+        return outcomes
+
+    def _predict_images(self, images):
+        if not self.enabled or time.monotonic() < self._down_until:
+            return self.fallback.submit_many(images)
+        started = time.perf_counter()
+        try:
+            logits = self._remote_predict(np.stack(images))
+        except DaemonUnavailable as e:
+            self._mark_down(e)
+            with self._lock:
+                self.fallbacks += len(images)
+            return self.fallback.submit_many(images)
+        self.latency_ms.observe((time.perf_counter() - started) * 1000.0)
+        with self._lock:
+            self.remote += len(images)
+        return self.engine.decode(logits)
+
+    def _connection(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None and self._local.pid == os.getpid():
+            return sock
+        # Sockets inherited from a preloading master are shared with siblings; never reuse them
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+            send_frame(sock, OP_HELLO)
+            hello = self._reply(sock)
+        except BaseException:
+            sock.close()
+            raise
+        hello = json.loads(hello)
+        if hello['model_version'] != self.engine.model_version:
+            sock.close()
+            reason = f"daemon serves {hello['model_version']}, this worker {self.engine.model_version}"
+            if reason != self._incompatible:
+                logger.error("Not using inference daemon at %s: %s", self.path, reason)
+            # Callers back off for retry_seconds, then check again
+            self._incompatible = reason
+            raise DaemonUnavailable(reason)
+        if self._incompatible is not None:
+            logger.info("Inference daemon at %s now serves %s", self.path, self.engine.model_version)
+            self._incompatible = None
+        self._local.sock, self._local.pid = sock, os.getpid()
+        return sock
+
+    def _reply(self, sock, out=None):
+        kind, _, length = recv_header(sock)
+        if kind == REPLY_ERROR:
+            raise ProtocolError(recv_bytes(sock, length).decode(errors='replace'))
+        if kind != REPLY_OK:
+            raise ProtocolError(f"unexpected reply kind {kind}")
+        if out is None:
+            return recv_bytes(sock, length)
+        if length != out.nbytes:
+            raise ProtocolError(f"expected {out.nbytes} reply bytes, got {length}")
+        recv_into(sock, out)
+        return out
+
+    def _remote_predict(self, images):
+        """Logits for one image, or one row per image for a stack of them"""
+        try:
+            sock = self._connection()
+            send_frame(sock, OP_PREDICT, np.ascontiguousarray(images))
+            shape = images.shape[:-3] + (self.engine.model.num_classes,)
+            return self._reply(sock, np.empty(shape, dtype=np.float32))
+        except (OSError, ProtocolError, ValueError) as e:
+            self._drop_connection()
+            raise DaemonUnavailable(str(e))
+
+    def _drop_connection(self):
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def _mark_down(self, error):
+        with self._lock:
+            was_up = self._down_until <= time.monotonic()
+            self._down_until = time.monotonic() + self.retry_seconds
+        if was_up:
+            logger.warning("Inference daemon unavailable (%s); using in-process inference for %.0fs",
+                           error, self.retry_seconds)
+
+    def daemon_stats(self):
+        """The daemon's own queue depth, batch sizes and latency, or None"""
+        if not self.enabled or time.monotonic() < self._down_until:
+            return None
+        try:
+            sock = self._connection()
+            send_frame(sock, OP_STATS)
+            return json.loads(self._reply(sock))
+        except (OSError, ProtocolError, ValueError, DaemonUnavailable) as e:
+            self._drop_connection()
+            self._mark_down(e)
+            return None
+
+    def stats(self):
+        with self._lock:
+            counters = {'remote_requests': self.remote, 'fallbacks': self.fallbacks}
+        return {
+            'socket': self.path or None,
+            'enabled': self.enabled,
+            'incompatible': self._incompatible,
+            'available': self.enabled and time.monotonic() >= self._down_until,
+            **counters,
+            'client_latency_ms': self.latency_ms.snapshot(),
+            'daemon': self.daemon_stats(),
+        }
+
+# ============================================================================
+# ENTRY POINT
+# ============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--socket', default=INFERENCE_SOCKET or None, required=not INFERENCE_SOCKET)
+    parser.add_argument('--classes', type=int, default=4,
+                        help='number of classes (ignored when MODEL_PATH names a weight file)')
+    parser.add_argument('--stats', action='store_true', help="print a running daemon's stats and exit")
+    args = parser.parse_args()
+
+    if args.stats:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(args.socket)
+        send_frame(sock, OP_STATS)
+        kind, _, length = recv_header(sock)
+        print(json.dumps(json.loads(recv_bytes(sock, length)), indent=2))
+        return
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    from inference import InferenceEngine, MODEL_PATH, load_model
+    import model_format
+    classes = model_format.load(MODEL_PATH).metadata['config']['num_classes'] if MODEL_PATH else args.classes
+    model = load_model(classes)
+    engine = InferenceEngine(model, [str(i) for i in range(classes)])
+    server = InferenceServer(args.socket, _LogitsEngine(engine))
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logger.info("[+] Inference daemon serving %s on %s (pid %d)", model.version, args.socket, os.getpid())
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        logger.info("Inference daemon stopped")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
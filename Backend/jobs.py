@@ -0,0 +1,251 @@
+"""
+Asynchronous detection jobs
+Uploads are queued in SQLite and processed by a bounded pool of background
+threads, so a slow inference never holds a request worker. Jobs are leased
+while running; if a worker dies, the lease expires and another worker
+picks the job up again. Handlers renew the lease through report_progress,
+and every write for a claimed job matches on the lease it holds, so a run
+that lost its lease to another worker cannot record a result as well.
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import sqlite3
+import threading
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', 60))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 0.5))
+# Seconds before an SSE stream ends with a 'timeout' event and the client reconnects;
+# gunicorn_config.py caps it below the sync worker timeout
+JOB_STREAM_TIMEOUT = float(os.getenv('JOB_STREAM_TIMEOUT', 120))
+
+FINISHED_STATES = ('done', 'failed')
+
+# Created by migrations.py
+DETECTION_JOBS_DDL = '''
+    CREATE TABLE IF NOT EXISTS detection_jobs (
+        id TEXT PRIMARY KEY,
+        user_email TEXT,
+        filename TEXT,
+        filepath TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        progress REAL NOT NULL DEFAULT 0,
+        result TEXT,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        lease_until REAL,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+'''
+DETECTION_JOBS_INDEX_DDL = 'CREATE INDEX IF NOT EXISTS idx_detection_jobs_status ON detection_jobs (status, created_at)'
+
+
+class PermanentJobError(Exception):
+    """Raised by a job handler when retrying cannot help (e.g. unreadable image)"""
+
+
+class LeaseLost(Exception):
+    """Raised by report_progress once the job's lease has expired and another worker may own it"""
+
+# ============================================================================
+# QUEUE
+# ============================================================================
+
+class JobQueue:
+    """
+    SQLite-backed job queue with in-process worker threads
+    handler(job, report_progress) -> result dict
+    """
+
+    def __init__(self, database, handler, workers=JOB_WORKERS, lease_seconds=JOB_LEASE_SECONDS,
+                 max_attempts=JOB_MAX_ATTEMPTS, poll_interval=JOB_POLL_INTERVAL):
+        self.database = database
+        self.handler = handler
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    # ------------------------------------------------------------ public API
+
+    def submit(self, user_email, filename, filepath):
+        """Queue a saved upload for detection and return its job id"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with db.transaction(self.database) as conn:
+            conn.execute('''
+                INSERT INTO detection_jobs (id, user_email, filename, filepath, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (job_id, user_email, filename, filepath, now, now))
+        self.ensure_workers()
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        """Return a job as a JSON-ready dict, or None"""
+        conn = db.get_connection(self.database)
+        row = conn.execute('SELECT * FROM detection_jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": row['id'],
+            "user_email": row['user_email'],
+            "filename": row['filename'],
+            "status": row['status'],
+            "progress": row['progress'],
+            "result": json.loads(row['result']) if row['result'] else None,
+            "error": row['error'],
+            "attempts": row['attempts'],
+            "created_at": row['created_at'],
+            "updated_at": row['updated_at'],
+        }
+
+    def stream(self, job_id, timeout=JOB_STREAM_TIMEOUT, interval=0.25):
+        """Yield Server-Sent Events for a job until it finishes or the stream times out"""
+        deadline = time.monotonic() + timeout
+        last = None
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                yield _sse('error', {"error": "Job not found"})
+                return
+            state = (job['status'], job['progress'])
+            if state != last:
+                last = state
+                event = 'result' if job['status'] in FINISHED_STATES else 'progress'
+                yield _sse(event, job)
+            if job['status'] in FINISHED_STATES:
+                return
+            if time.monotonic() >= deadline:
+                yield _sse('timeout', {"job_id": job_id, "status": job['status']})
+                return
+            time.sleep(interval)
+
+    def stats(self):
+        conn = db.get_connection(self.database)
+        rows = conn.execute('SELECT status, COUNT(*) AS n FROM detection_jobs GROUP BY status').fetchall()
+        return {row['status']: row['n'] for row in rows}
+
+    # --------------------------------------------------------------- workers
+
+    def ensure_workers(self):
+        """Start this process's worker threads (threads do not survive fork)"""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._wakeup = threading.Event()
+            self._threads = [
+                threading.Thread(target=self._run, name=f'detection-job-{i}', daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            logger.info("[+] Started %d detection job workers (pid %d)", self.workers, self._pid)
+
+    def _claim(self):
+        """Lease the oldest runnable job; expired leases from dead workers are reclaimed"""
+        now = time.time()
+        with db.transaction(self.database, immediate=True) as conn:
+            row = conn.execute('''
+                SELECT * FROM detection_jobs
+                WHERE status = 'queued' OR (status = 'running' AND lease_until < ?)
+                ORDER BY created_at
+                LIMIT 1
+            ''', (now,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('''
+                UPDATE detection_jobs
+                SET status = 'running', attempts = attempts + 1, lease_until = ?, updated_at = ?
+                WHERE id = ?
+            ''', (now + self.lease_seconds, now, row['id']))
+        job = dict(row)
+        job['attempts'] += 1
+        job['lease_until'] = now + self.lease_seconds
+        return job
+
+    def _update(self, job, **fields):
+        """Update a claimed job; False (and nothing written) if its lease has moved on since"""
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f"{key} = ?" for key in fields)
+        # The lease doubles as a claim token: a worker whose lease expired and
+        # was reclaimed no longer matches, so it cannot overwrite the new run
+        with db.transaction(self.database) as conn:
+            updated = conn.execute(f'UPDATE detection_jobs SET {assignments} WHERE id = ? AND lease_until = ?',
+                                   (*fields.values(), job['id'], job['lease_until'])).rowcount
+        if updated and 'lease_until' in fields:
+            job['lease_until'] = fields['lease_until']
+        return bool(updated)
+
+    def _run(self):
+        while True:
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                logger.warning("Job claim failed: %s", e)
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            try:
+                self._process(job)
+            except Exception as e:
+                # e.g. 'database is locked' on a status write; the lease expires
+                # and the job is claimed again, and this thread carries on
+                logger.exception("Job %s could not be processed: %s", job['id'], e)
+
+    def _process(self, job):
+        job_id = job['id']
+        if job['attempts'] > self.max_attempts:
+            self._update(job, status='failed', error='Too many attempts', lease_until=None)
+            return
+
+        def report_progress(progress):
+            """Record progress and renew the lease; call at least once per lease period"""
+            if not self._update(job, progress=progress, lease_until=time.time() + self.lease_seconds):
+                raise LeaseLost(job_id)
+
+        try:
+            result = self.handler(job, report_progress)
+        except LeaseLost:
+            logger.warning("Job %s lost its lease to another worker; dropping this run", job_id)
+            return
+        except PermanentJobError as e:
+            logger.warning("Job %s failed: %s", job_id, e)
+            self._update(job, status='failed', error=str(e), lease_until=None)
+            return
+        except Exception as e:
+            logger.exception("Job %s errored (attempt %d): %s", job_id, job['attempts'], e)
+            status = 'failed' if job['attempts'] >= self.max_attempts else 'queued'
+            self._update(job, status=status, error=str(e), lease_until=None)
+            return
+        if not self._update(job, status='done', progress=1.0, result=json.dumps(result), error=None,
+                            lease_until=None):
+            logger.warning("Job %s finished after losing its lease; its result was not recorded", job_id)
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
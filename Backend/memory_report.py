@@ -0,0 +1,77 @@
+"""
+Per-process memory accounting from /proc
+RSS counts every resident page, including the preloaded model that gunicorn
+workers share copy-on-write with the master. The figures that matter when
+adding workers are the private pages (USS, what each extra worker costs)
+and PSS (shared pages split between the processes that map them).
+"""
+
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# smaps_rollup fields, in kB
+SMAPS_FIELDS = {
+    'Rss': 'rss_kb',
+    'Pss': 'pss_kb',
+    'Shared_Clean': 'shared_clean_kb',
+    'Shared_Dirty': 'shared_dirty_kb',
+    'Private_Clean': 'private_clean_kb',
+    'Private_Dirty': 'private_dirty_kb',
+    'Swap': 'swap_kb',
+}
+
+
+def process_memory(pid='self'):
+    """
+    Memory of one process in kB: rss, pss, shared and private (USS)
+    Needs Linux 4.14+ for smaps_rollup; elsewhere only rss is reported (from
+    statm) and the other fields are None.
+    """
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            values = {}
+            for line in f:
+                name, _, rest = line.partition(':')
+                if name in SMAPS_FIELDS:
+                    values[SMAPS_FIELDS[name]] = int(rest.split()[0])
+    except OSError:
+        return _statm_memory(pid)
+    shared = values.get('shared_clean_kb', 0) + values.get('shared_dirty_kb', 0)
+    private = values.get('private_clean_kb', 0) + values.get('private_dirty_kb', 0)
+    return {
+        'rss_kb': values.get('rss_kb', 0),
+        'pss_kb': values.get('pss_kb', 0),
+        'shared_kb': shared,
+        'private_kb': private,
+        'swap_kb': values.get('swap_kb', 0),
+    }
+
+
+def _statm_memory(pid):
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            resident = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return {'rss_kb': None, 'pss_kb': None, 'shared_kb': None, 'private_kb': None, 'swap_kb': None}
+    return {
+        'rss_kb': resident * os.sysconf('SC_PAGE_SIZE') // 1024,
+        'pss_kb': None,
+        'shared_kb': None,
+        'private_kb': None,
+        'swap_kb': None,
+    }
+
+
+def log_memory(label, pid='self', log=None):
+    """Log one line of rss / shared / private memory (log: any logger, e.g. gunicorn's server.log)"""
+    log = log or logger
+    mem = process_memory(pid)
+    if mem['private_kb'] is None:
+        log.info("[mem] %s: rss=%s kB", label, mem['rss_kb'])
+    else:
+        log.info("[mem] %s: rss=%.1f MB shared=%.1f MB private=%.1f MB pss=%.1f MB",
+                 label, mem['rss_kb'] / 1024, mem['shared_kb'] / 1024,
+                 mem['private_kb'] / 1024, mem['pss_kb'] / 1024)
+    return mem
@@ -0,0 +1,409 @@
+"""
+Prometheus metrics shared by every worker process
+Each process writes its counters, gauges and histogram buckets into its own
+memory-mapped file under METRICS_DIR (one float64 per series, updated in
+place, no syscalls per observation). /api/metrics reads all files and
+merges them, so whichever gunicorn worker answers the scrape reports the
+whole server. Files of exited workers keep counting towards counters and
+histograms; gauges only count live processes.
+
+Requests are timed per stage: handlers wrap work in stage('decode') and
+friends, DB statements are added to a 'db' stage by the db layer, and JSON
+encoding to 'serialize'. At the end of a request the stages feed
+crop_portal_stage_seconds and the Server-Timing response header.
+
+METRICS_DIR defaults to a fresh temporary directory created by the first
+process that needs it (the gunicorn master, see gunicorn_config.py) and
+inherited by its workers. Set it explicitly when workers are not forked
+from one parent, e.g. uvicorn --workers.
+"""
+
+import os
+import json
+import mmap
+import time
+import atexit
+import bisect
+import shutil
+import struct
+import logging
+import tempfile
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1').lower() in ('1', 'true', 'yes')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+DB_OPERATIONS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'BEGIN', 'COMMIT', 'CREATE', 'PRAGMA')
+
+FILE_INITIAL_BYTES = 64 * 1024
+_USED = struct.Struct('<Q')
+_KEY_LEN = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+
+_directory_owner = None
+
+# ============================================================================
+# SHARED STORAGE
+# ============================================================================
+
+def directory():
+    """METRICS_DIR, creating a temporary one (inherited by child processes) if unset"""
+    global _directory_owner
+    path = os.environ.get('METRICS_DIR')
+    if not path:
+        path = tempfile.mkdtemp(prefix='crop-portal-metrics-')
+        os.environ['METRICS_DIR'] = path
+        _directory_owner = os.getpid()
+        atexit.register(_remove_directory, path)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _remove_directory(path):
+    # Forked workers run atexit too; only the process that created the directory removes it
+    if _directory_owner == os.getpid():
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def reset():
+    """Delete files left by processes of an earlier run (call in the server's master before forking)"""
+    path = directory()
+    for name in os.listdir(path):
+        if name.endswith('.metrics') and name != f'{os.getpid()}.metrics':
+            os.unlink(os.path.join(path, name))
+
+
+class _ValueFile:
+    """
+    One process's series: a used-bytes header, then (key length, JSON key,
+    padding, float64) entries appended as series appear
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._size = max(os.fstat(self._fd).st_size, FILE_INITIAL_BYTES)
+        os.ftruncate(self._fd, self._size)
+        self._map = mmap.mmap(self._fd, self._size)
+        self._used = _USED.size
+        self._offsets = {}
+        self._lock = threading.Lock()
+        _USED.pack_into(self._map, 0, self._used)
+
+    def add(self, *updates):
+        """Apply (key, amount) updates under one lock acquisition"""
+        with self._lock:
+            for key, amount in updates:
+                offset = self._offsets.get(key)
+                if offset is None:
+                    offset = self._append(key)
+                value = _VALUE.unpack_from(self._map, offset)[0]
+                _VALUE.pack_into(self._map, offset, value + amount)
+
+    def _append(self, key):
+        encoded = json.dumps(key).encode()
+        padded = -(-(_KEY_LEN.size + len(encoded)) // 8) * 8
+        needed = self._used + padded + _VALUE.size
+        if needed > self._size:
+            while self._size < needed:
+                self._size *= 2
+            os.ftruncate(self._fd, self._size)
+            self._map.resize(self._size)
+        _KEY_LEN.pack_into(self._map, self._used, len(encoded))
+        self._map[self._used + _KEY_LEN.size:self._used + _KEY_LEN.size + len(encoded)] = encoded
+        offset = self._used + padded
+        _VALUE.pack_into(self._map, offset, 0.0)
+        # Publish the entry only once it is complete; readers stop at 'used'
+        self._used = needed
+        _USED.pack_into(self._map, 0, self._used)
+        self._offsets[key] = offset
+        return offset
+
+
+def _read_file(path):
+    """(key, value) pairs from one process's file"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < _USED.size:
+        return
+    used = min(_USED.unpack_from(data, 0)[0], len(data))
+    pos = _USED.size
+    while pos + _KEY_LEN.size <= used:
+        length = _KEY_LEN.unpack_from(data, pos)[0]
+        padded = -(-(_KEY_LEN.size + length) // 8) * 8
+        if pos + padded + _VALUE.size > used:
+            break
+        key = json.loads(data[pos + _KEY_LEN.size:pos + _KEY_LEN.size + length])
+        yield key, _VALUE.unpack_from(data, pos + padded)[0]
+        pos += padded + _VALUE.size
+
+
+_values = None
+_values_pid = None
+_values_lock = threading.Lock()
+
+def _process_values():
+    # A forked worker must not write into its parent's file
+    global _values, _values_pid
+    if _values_pid != os.getpid():
+        with _values_lock:
+            if _values_pid != os.getpid():
+                _values = _ValueFile(os.path.join(directory(), f'{os.getpid()}.metrics'))
+                _values_pid = os.getpid()
+    return _values
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+# ============================================================================
+# METRIC TYPES
+# ============================================================================
+
+_registry = {}
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry[name] = self
+
+    def _labels(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _add(self, series, labels, amount):
+        if METRICS_ENABLED:
+            _process_values().add(((self.name, series, labels), amount))
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1.0, **labels):
+        self._add('_total', self._labels(labels), amount)
+
+
+class Gauge(_Metric):
+    """Summed over live processes only"""
+    kind = 'gauge'
+
+    def inc(self, amount=1.0, **labels):
+        self._add('', self._labels(labels), amount)
+
+    def dec(self, amount=1.0, **labels):
+        self._add('', self._labels(labels), -amount)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        values = self._labels(labels)
+        # Buckets are stored per bucket and made cumulative when rendered
+        i = bisect.bisect_left(self.buckets, value)
+        bound = str(self.buckets[i]) if i < len(self.buckets) else '+Inf'
+        _process_values().add(((self.name, '_bucket', values + (bound,)), 1.0),
+                              ((self.name, '_sum', values), value),
+                              ((self.name, '_count', values), 1.0))
+
+# ============================================================================
+# EXPOSITION
+# ============================================================================
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+def _format_value(value):
+    return str(int(value)) if value.is_integer() and abs(value) < 2 ** 53 else repr(value)
+
+
+def collect():
+    """Merge every process's file: {(metric, series, labels tuple): value}"""
+    merged = {}
+    path = directory()
+    for name in os.listdir(path):
+        stem, ext = os.path.splitext(name)
+        if ext != '.metrics':
+            continue
+        pid = int(stem) if stem.isdigit() else None
+        alive = pid is None or _pid_alive(pid)
+        try:
+            entries = list(_read_file(os.path.join(path, name)))
+        except (OSError, ValueError) as e:
+            logger.warning("Skipping unreadable metrics file %s: %s", name, e)
+            continue
+        for (metric_name, series, labels), value in entries:
+            metric = _registry.get(metric_name)
+            if metric is None or (metric.kind == 'gauge' and not alive):
+                continue
+            key = (metric_name, series, tuple(labels))
+            merged[key] = merged.get(key, 0.0) + value
+    return merged
+
+
+def render():
+    """All registered metrics in the Prometheus text format"""
+    merged = collect()
+    by_metric = {}
+    for (metric_name, series, labels), value in merged.items():
+        by_metric.setdefault(metric_name, []).append((series, labels, value))
+
+    lines = []
+    for name in sorted(_registry):
+        metric = _registry[name]
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        samples = by_metric.get(name, [])
+        if metric.kind != 'histogram':
+            for series, labels, value in sorted(samples):
+                lines.append(f'{name}{series}{_label_text(metric.labelnames, labels)} {_format_value(value)}')
+            continue
+
+        width = len(metric.labelnames)
+        groups = {}
+        for series, labels, value in samples:
+            group = groups.setdefault(labels[:width], {'buckets': {}, 'sum': 0.0, 'count': 0.0})
+            if series == '_bucket':
+                group['buckets'][labels[width]] = value
+            else:
+                group[series[1:]] = value
+        for labels in sorted(groups):
+            group = groups[labels]
+            cumulative = 0.0
+            for bound in [str(b) for b in metric.buckets] + ['+Inf']:
+                cumulative += group['buckets'].get(bound, 0.0)
+                label_text = _label_text(metric.labelnames + ('le',), labels + (bound,))
+                lines.append(f'{name}_bucket{label_text} {_format_value(cumulative)}')
+            label_text = _label_text(metric.labelnames, labels)
+            lines.append(f'{name}_sum{label_text} {_format_value(group["sum"])}')
+            lines.append(f'{name}_count{label_text} {_format_value(group["count"])}')
+    return '\n'.join(lines) + '\n'
+
+# ============================================================================
+# REQUEST STAGES
+# ============================================================================
+
+REQUESTS = Counter('crop_portal_requests', 'HTTP requests by route, method and status',
+                   ('route', 'method', 'status'))
+REQUEST_SECONDS = Histogram('crop_portal_request_seconds', 'Time to handle a request, by route',
+                            ('route', 'method'))
+IN_FLIGHT = Gauge('crop_portal_requests_in_flight', 'Requests currently being handled, by route', ('route',))
+STAGE_SECONDS = Histogram('crop_portal_stage_seconds', 'Time spent in each stage of a request, by route',
+                          ('route', 'stage'))
+DB_SECONDS = Histogram('crop_portal_db_seconds', 'Time spent executing SQLite statements, by operation',
+                       ('operation',), buckets=DB_BUCKETS)
+
+# Stage name -> seconds for the request being handled in this context
+_stages = contextvars.ContextVar('crop_portal_stages', default=None)
+
+
+def record_stage(name, seconds):
+    """Add time to a stage of the current request; a no-op outside a request (e.g. background jobs)"""
+    stages = _stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def observe_query(sql, seconds):
+    """Called by the db layer for every statement"""
+    operation = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+    DB_SECONDS.observe(seconds, operation=operation if operation in DB_OPERATIONS else 'OTHER')
+    record_stage('db', seconds)
+
+
+def server_timing(stages, total):
+    """Server-Timing header value, stages in milliseconds"""
+    parts = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in stages.items()]
+    parts.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(parts)
+
+
+def init_app(app):
+    """Count, time and stage every request of a Flask app"""
+    from flask import g, request
+    from flask.json.provider import DefaultJSONProvider
+
+    class TimedJSONProvider(DefaultJSONProvider):
+        def response(self, *args, **kwargs):
+            with stage('serialize'):
+                return super().response(*args, **kwargs)
+
+    app.json = TimedJSONProvider(app)
+
+    def route():
+        # The URL rule, not the path, so /api/jobs/<job_id> stays one series
+        return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        g.metrics_route = route()
+        g.metrics_stages_token = _stages.set({})
+        IN_FLIGHT.inc(route=g.metrics_route)
+
+    @app.after_request
+    def finish_request_metrics(response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+        total = time.perf_counter() - started
+        stages = _stages.get() or {}
+        method = request.method
+        REQUESTS.inc(route=g.metrics_route, method=method, status=str(response.status_code))
+        REQUEST_SECONDS.observe(total, route=g.metrics_route, method=method)
+        for name, seconds in stages.items():
+            STAGE_SECONDS.observe(seconds, route=g.metrics_route, stage=name)
+        response.headers['Server-Timing'] = server_timing(stages, total)
+        return response
+
+    @app.teardown_request
+    def end_request_metrics(exc):
+        token = g.pop('metrics_stages_token', None)
+        if token is None:
+            return
+        IN_FLIGHT.dec(route=g.metrics_route)
+        if g.pop('metrics_started', None) is not None:
+            # after_request never ran: the handler raised past Flask's error handling
+            REQUESTS.inc(route=g.metrics_route, method=request.method, status='500')
+        _stages.reset(token)
@@ -0,0 +1,194 @@
+"""
+Schema migrations keyed on PRAGMA user_version
+Every schema change is a numbered step. migrate() applies the steps a
+database has not seen yet, each in its own BEGIN IMMEDIATE transaction
+that also sets user_version, so a crash leaves the database at a step
+boundary and a process that waited for the lock finds nothing left to do.
+
+Migrations run once per start, in the gunicorn master before any worker
+forks (gunicorn_config.on_starting), or as a release step with
+python -m migrations. Workers importing an app only compare user_version
+with SCHEMA_VERSION: one read, no write lock. A worker finding an older
+schema (an app started outside gunicorn) migrates it, or refuses to start
+with MIGRATE_ON_START=0.
+
+app.py, app_v2_jwt.py and app_production.py share this one schema and,
+run from Backend/, the same crop_portal.db; none of them creates tables
+itself. New steps go at the end of MIGRATIONS and should be online: add a
+table, column or index, backfill in batches; rewriting a large table
+(step 3) is only for databases from before the layout change. Databases
+first created by the old app_production.py (text result columns,
+password_hash NOT NULL) are brought onto the same layout by steps 2 and 3.
+
+    python -m migrations              # migrate ./crop_portal.db
+    python -m migrations --status
+    python -m migrations --database /srv/crop_portal.db --vacuum
+"""
+
+import os
+import time
+import logging
+
+import db
+from pagination import HISTORY_INDEX_DDL
+from diseases import DISEASE_DB, DISEASES_DDL, ANALYSIS_RESULTS_DDL, migrate_analysis_results
+from diagnosis_cache import DIAGNOSIS_CACHE_DDL, DIAGNOSIS_CACHE_INDEX_DDL
+from jobs import DETECTION_JOBS_DDL, DETECTION_JOBS_INDEX_DDL
+from rollups import STATS_ROLLUPS_DDL, STATS_WATERMARK_DDL
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+MIGRATE_ON_START = os.getenv('MIGRATE_ON_START', '1').lower() in ('1', 'true', 'yes')
+# The file the apps use: crop_portal.db in the working directory
+DEFAULT_DATABASE = os.path.abspath('crop_portal.db')
+
+USERS_DDL = '''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL,
+        password_hash TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+
+class SchemaOutdated(RuntimeError):
+    pass
+
+# ============================================================================
+# STEPS
+# ============================================================================
+
+def _baseline(conn):
+    """Every table and index, for new databases; existing ones keep their tables"""
+    for ddl in (USERS_DDL, DISEASES_DDL, ANALYSIS_RESULTS_DDL, HISTORY_INDEX_DDL,
+                DIAGNOSIS_CACHE_DDL, DETECTION_JOBS_DDL, DETECTION_JOBS_INDEX_DDL):
+        conn.execute(ddl)
+
+
+def _users_password_hash(conn):
+    """
+    app.py created users without password_hash, which app_v2_jwt.py stores;
+    the old app_production.py created it NOT NULL
+    """
+    columns = {row[1]: row[3] for row in conn.execute('PRAGMA table_info(users)')}
+    if 'password_hash' not in columns:
+        conn.execute('ALTER TABLE users ADD COLUMN password_hash TEXT')
+    elif columns['password_hash']:
+        # Copy into a new table renamed over the old one, so other tables'
+        # references to users keep pointing at users
+        conn.execute(USERS_DDL.replace('EXISTS users', 'EXISTS users_nullable_hash'))
+        conn.execute('''
+            INSERT INTO users_nullable_hash (id, email, name, password_hash, created_at)
+            SELECT id, email, name, password_hash, created_at FROM users
+        ''')
+        conn.execute('DROP TABLE users')
+        conn.execute('ALTER TABLE users_nullable_hash RENAME TO users')
+
+
+def _analysis_results_disease_ids(conn):
+    migrate_analysis_results(conn, DISEASE_DB)
+
+
+def _stats_rollups(conn):
+    """Empty counts and a mark at 0: existing results are counted by python -m rollups"""
+    conn.execute(STATS_ROLLUPS_DDL)
+    conn.execute(STATS_WATERMARK_DDL)
+
+
+def _diagnosis_cache_ids(conn):
+    """Rows held copies of the disease text; the cached diagnoses are dropped, not converted"""
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(diagnosis_cache)')}
+    if 'result' in columns:
+        conn.execute('DROP TABLE diagnosis_cache')
+    conn.execute(DIAGNOSIS_CACHE_DDL)
+    conn.execute(DIAGNOSIS_CACHE_INDEX_DDL)
+
+
+MIGRATIONS = [
+    (1, 'baseline tables and indexes', _baseline),
+    (2, 'users.password_hash', _users_password_hash),
+    (3, 'analysis_results text columns to disease ids', _analysis_results_disease_ids),
+    (4, 'hourly and daily stats rollups', _stats_rollups),
+    (5, 'diagnosis_cache disease ids and expiry index', _diagnosis_cache_ids),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# ============================================================================
+# RUNNER
+# ============================================================================
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(database, migrations=MIGRATIONS):
+    """Apply pending steps in order; returns the versions applied by this call"""
+    conn = db.get_connection(database)
+    applied = []
+    for version, description, step in migrations:
+        if schema_version(conn) >= version:
+            continue
+        started = time.perf_counter()
+        with db.transaction(database, immediate=True) as tx:
+            # Another process may have applied it while this one waited for the lock
+            if schema_version(tx) >= version:
+                continue
+            step(tx)
+            tx.execute(f'PRAGMA user_version = {int(version)}')
+        applied.append(version)
+        logger.info("Migrated %s to schema version %d (%s) in %.0f ms",
+                    database, version, description, (time.perf_counter() - started) * 1000)
+    current = schema_version(conn)
+    if current > SCHEMA_VERSION:
+        logger.warning("%s is at schema version %d, newer than this code (%d)", database, current, SCHEMA_VERSION)
+    return applied
+
+
+def ensure(database):
+    """Startup check: one read of user_version once the database is current; returns the version"""
+    version = schema_version(db.get_connection(database))
+    if version >= SCHEMA_VERSION:
+        return version
+    if not MIGRATE_ON_START:
+        raise SchemaOutdated(f"{database} is at schema version {version}, this code needs {SCHEMA_VERSION}; "
+                             f"run python -m migrations")
+    migrate(database)
+    return schema_version(db.get_connection(database))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default=DEFAULT_DATABASE)
+    parser.add_argument('--status', action='store_true', help='print the schema version and pending steps only')
+    parser.add_argument('--vacuum', action='store_true', help='rebuild the file afterwards to return freed pages')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    conn = db.get_connection(args.database)
+    version = schema_version(conn)
+    pending = [(v, description) for v, description, _ in MIGRATIONS if v > version]
+    print(f"{args.database}: schema version {version}, code version {SCHEMA_VERSION}")
+    for v, description in pending:
+        print(f"  pending {v}: {description}")
+    if args.status:
+        return
+
+    before = os.path.getsize(args.database)
+    migrate(args.database)
+    if args.vacuum:
+        conn.execute('VACUUM')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    print(f"now at schema version {schema_version(conn)}; "
+          f"{before / 1e6:.1f} MB -> {os.path.getsize(args.database) / 1e6:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
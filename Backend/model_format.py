@@ -0,0 +1,199 @@
+"""
+Memory-mapped model weight files
+One file holds a small JSON header followed by 64-byte aligned tensors:
+
+    magic (8 bytes) | header length (uint32 LE) | JSON header | padding | tensors...
+
+Opening a file parses only the header and maps the rest with numpy.memmap,
+so a worker start or restart costs milliseconds however big the model is,
+and every process on the node shares the same page-cache pages. Weights
+may be stored as float32, float16 or int8 with one float32 scale per output
+column (stored as '<name>.scale'); the engine dequantizes on the fly.
+
+    python -m model_format export model.cpw --dtype int8
+    python -m model_format convert model.cpw model-fp16.cpw --dtype float16
+    python -m model_format inspect model.cpw
+"""
+
+import os
+import json
+import struct
+import argparse
+import tempfile
+
+import numpy as np
+
+MAGIC = b'\x93CPWTS\x00\x00'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+STORAGE_DTYPES = ('float32', 'float16', 'int8')
+
+_PREFIX = struct.Struct('<8sI')
+
+
+class WeightFile:
+    """A mapped weight file: metadata from the header and read-only tensor views"""
+
+    def __init__(self, path, metadata, tensors, storage):
+        self.path = path
+        self.metadata = metadata
+        self.tensors = tensors
+        self.storage = storage
+
+    @property
+    def nbytes(self):
+        return sum(t.nbytes for t in self.tensors.values())
+
+
+# ============================================================================
+# QUANTIZATION
+# ============================================================================
+
+def quantize_int8(weight):
+    """Symmetric per-column int8: weight ~= q * scale, scale shaped (columns,)"""
+    weight = np.asarray(weight, dtype=np.float32)
+    peak = np.abs(weight).max(axis=0)
+    scale = np.where(peak > 0, peak / 127.0, 1.0).astype(np.float32)
+    q = np.clip(np.rint(weight / scale), -127, 127).astype(np.int8)
+    return q, scale
+
+
+def dequantize(tensors, name):
+    """float32 copy of one stored weight (used by the converter, not at inference time)"""
+    stored = tensors[name]
+    scale = tensors.get(f'{name}.scale')
+    weight = np.asarray(stored, dtype=np.float32)
+    return weight * scale if scale is not None else weight
+
+
+def encode_tensors(tensors, storage):
+    """
+    Convert float32 tensors to the storage dtype
+    Only matrices are reduced; biases and other 1-d tensors stay float32.
+    """
+    if storage not in STORAGE_DTYPES:
+        raise ValueError(f"Unknown storage dtype '{storage}' (expected one of {', '.join(STORAGE_DTYPES)})")
+    encoded = {}
+    for name, tensor in tensors.items():
+        tensor = np.asarray(tensor, dtype=np.float32)
+        if tensor.ndim < 2 or storage == 'float32':
+            encoded[name] = tensor
+        elif storage == 'float16':
+            encoded[name] = tensor.astype(np.float16)
+        else:
+            encoded[name], encoded[f'{name}.scale'] = quantize_int8(tensor)
+    return encoded
+
+# ============================================================================
+# READ / WRITE
+# ============================================================================
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def save(path, tensors, metadata, storage='float32'):
+    """
+    Write float32 tensors (name -> array) in the given storage dtype
+    The file is written next to its destination and renamed into place, so
+    processes that already map the old file keep a consistent view.
+    """
+    tensors = encode_tensors(tensors, storage)
+    entries, offset = {}, 0
+    for name, tensor in tensors.items():
+        tensor = np.ascontiguousarray(tensor)
+        entries[name] = {'dtype': tensor.dtype.str, 'shape': list(tensor.shape),
+                         'offset': offset, 'nbytes': tensor.nbytes}
+        offset = _align(offset + tensor.nbytes)
+
+    header = {'format_version': FORMAT_VERSION, 'storage': storage, 'metadata': metadata, 'tensors': entries}
+    header_bytes = json.dumps(header, separators=(',', ':')).encode()
+    data_start = _align(_PREFIX.size + len(header_bytes))
+    header_bytes = header_bytes.ljust(data_start - _PREFIX.size, b' ')
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(_PREFIX.pack(MAGIC, len(header_bytes)))
+            out.write(header_bytes)
+            for name, tensor in tensors.items():
+                out.seek(data_start + entries[name]['offset'])
+                out.write(np.ascontiguousarray(tensor).tobytes())
+            out.truncate(data_start + offset)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def load(path):
+    """Map a weight file; tensors are read-only views into one numpy.memmap"""
+    with open(path, 'rb') as f:
+        prefix = f.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size or prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a model weight file")
+        _, header_len = _PREFIX.unpack(prefix)
+        header = json.loads(f.read(header_len))
+    if header.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f"{path}: unsupported weight format version {header.get('format_version')}")
+
+    raw = np.memmap(path, dtype=np.uint8, mode='r')
+    data_start = _PREFIX.size + header_len
+    tensors = {}
+    for name, entry in header['tensors'].items():
+        start = data_start + entry['offset']
+        end = start + entry['nbytes']
+        if end > len(raw):
+            raise ValueError(f"{path}: tensor '{name}' runs past the end of the file")
+        tensors[name] = raw[start:end].view(np.dtype(entry['dtype'])).reshape(entry['shape'])
+    return WeightFile(path, header['metadata'], tensors, header['storage'])
+
+# ============================================================================
+# CLI
+# ============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help='write the seeded reference model')
+    export.add_argument('out')
+    export.add_argument('--dtype', choices=STORAGE_DTYPES, default='float32')
+    export.add_argument('--classes', type=int, default=4)
+    export.add_argument('--input-size', type=int)
+    export.add_argument('--hidden', type=int)
+    export.add_argument('--seed', type=int)
+
+    convert = commands.add_parser('convert', help='rewrite a weight file in another storage dtype')
+    convert.add_argument('src')
+    convert.add_argument('out')
+    convert.add_argument('--dtype', choices=STORAGE_DTYPES, required=True)
+
+    inspect = commands.add_parser('inspect', help='print a weight file header')
+    inspect.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        from inference import ReferenceModel
+        options = {k: v for k, v in (('input_size', args.input_size), ('hidden', args.hidden),
+                                     ('seed', args.seed)) if v is not None}
+        model = ReferenceModel(args.classes, **options)
+        save(args.out, model.tensors(), model.metadata(), args.dtype)
+    elif args.command == 'convert':
+        source = load(args.src)
+        names = [name for name in source.tensors if not name.endswith('.scale')]
+        save(args.out, {name: dequantize(source.tensors, name) for name in names}, source.metadata, args.dtype)
+    else:
+        weights = load(args.path)
+        print(json.dumps({'storage': weights.storage, 'metadata': weights.metadata, 'nbytes': weights.nbytes,
+                          'tensors': {n: f"{t.dtype}{list(t.shape)}" for n, t in weights.tensors.items()}},
+                         indent=2))
+        return
+    weights = load(args.out)
+    print(f"wrote {args.out}: {weights.storage}, {os.path.getsize(args.out) / 1e6:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
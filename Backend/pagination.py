@@ -0,0 +1,103 @@
+"""
+Keyset pagination for analysis history
+Pages are addressed by an opaque cursor holding the (created_at, id) of the
+last row served, so every page is one index seek on
+idx_analysis_results_user_created no matter how deep the client scrolls.
+"""
+
+import json
+import base64
+import binascii
+
+HISTORY_DEFAULT_LIMIT = 50
+HISTORY_MAX_LIMIT = 200
+
+HISTORY_INDEX_DDL = '''
+    CREATE INDEX IF NOT EXISTS idx_analysis_results_user_created
+    ON analysis_results (user_email, created_at DESC, id DESC)
+'''
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(created_at, row_id):
+    raw = json.dumps([created_at, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise InvalidCursor(str(e))
+    if not isinstance(created_at, str) or not isinstance(row_id, int):
+        raise InvalidCursor("Malformed cursor")
+    return created_at, row_id
+
+
+def clamp_limit(limit):
+    if limit is None:
+        return HISTORY_DEFAULT_LIMIT
+    return max(1, min(limit, HISTORY_MAX_LIMIT))
+
+
+def _with_disease(row, diseases):
+    row_id, disease_id, confidence, model_version, created_at = row
+    entry = diseases.get(disease_id) or {}
+    return {
+        "id": row_id,
+        "disease": entry.get('disease'),
+        "confidence": confidence,
+        "description": entry.get('description'),
+        "model_version": model_version,
+        "created_at": created_at,
+    }
+
+
+def fetch_history_page(conn, user_email, diseases, limit=None, before=None):
+    """
+    Return (rows, next_cursor) for one page of a user's history, newest first
+    Rows store a disease id; name and description come from diseases (a
+    diseases.DiseaseCatalog) rather than the database. next_cursor is None
+    on the last page.
+    """
+    limit = clamp_limit(limit)
+    # Fetch one extra row to learn whether another page exists
+    if before:
+        created_at, row_id = decode_cursor(before)
+        cursor = conn.execute('''
+            SELECT id, disease_id, confidence, model_version, created_at
+            FROM analysis_results
+            WHERE user_email = ? AND (created_at, id) < (?, ?)
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (user_email, created_at, row_id, limit + 1))
+    else:
+        cursor = conn.execute('''
+            SELECT id, disease_id, confidence, model_version, created_at
+            FROM analysis_results
+            WHERE user_email = ?
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (user_email, limit + 1))
+    rows = [_with_disease(row, diseases) for row in cursor.fetchall()]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last['created_at'], last['id'])
+    return rows, next_cursor
+
+
+def history_version(conn, user_email):
+    """Id of the user's newest row, which changes whenever history grows; one index seek"""
+    row = conn.execute('''
+        SELECT id FROM analysis_results
+        WHERE user_email = ?
+        ORDER BY created_at DESC, id DESC
+        LIMIT 1
+    ''', (user_email,)).fetchone()
+    return row[0] if row else None
@@ -0,0 +1,136 @@
+"""
+Password hashing on a bounded thread pool
+PBKDF2/scrypt cost tens to hundreds of milliseconds of CPU per call. Hashing
+runs on a small executor (hashlib releases the GIL while it works), and
+every hash holds one of PASSWORD_HASH_CONCURRENCY slots shared by all the
+workers on the host (flock slot files, as for admission.py's inference
+cap), so a burst of logins cannot starve /api/detect of CPU however many
+gunicorn workers there are. Logins fail fast with PasswordHasherBusy when
+no slot frees up within PASSWORD_HASH_QUEUE_TIMEOUT_MS or too many are
+already waiting in this process.
+
+Hashes are compared on werkzeug's expanded method string, so a bare
+PASSWORD_HASH_METHOD=scrypt matches the scrypt:32768:8:1 prefix werkzeug
+writes and only a real change of method or work factor triggers a rehash.
+"""
+
+import os
+import hmac
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
+
+import metrics
+from metrics import stage
+from admission import SlotPool
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+# werkzeug method string; bare 'scrypt' or 'pbkdf2' use werkzeug's own (current) work factors
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt')
+# Hashes running at once across every worker on the host
+PASSWORD_HASH_CONCURRENCY = int(os.getenv('PASSWORD_HASH_CONCURRENCY', max(1, (os.cpu_count() or 2) // 2)))
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', PASSWORD_HASH_CONCURRENCY))
+PASSWORD_HASH_MAX_WAITING = int(os.getenv('PASSWORD_HASH_MAX_WAITING', 32))
+PASSWORD_HASH_QUEUE_TIMEOUT_MS = float(os.getenv('PASSWORD_HASH_QUEUE_TIMEOUT_MS', 250))
+
+HASH_PREFIXES = ('pbkdf2:', 'scrypt:')
+
+
+class PasswordHasherBusy(Exception):
+    """No hashing slot free (or too many callers waiting); the caller should retry later"""
+
+
+def expand_method(method):
+    """The method prefix werkzeug writes for method, e.g. 'scrypt' -> 'scrypt:32768:8:1'"""
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        n, r, p = args if args else (2 ** 15, 8, 1)
+        return f"scrypt:{int(n)}:{int(r)}:{int(p)}"
+    if name == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{hash_name}:{iterations}"
+    raise ValueError(f"Invalid hash method '{method}'")
+
+
+class PasswordHasher:
+    def __init__(self, method=PASSWORD_HASH_METHOD, workers=PASSWORD_HASH_WORKERS,
+                 max_waiting=PASSWORD_HASH_MAX_WAITING, concurrency=PASSWORD_HASH_CONCURRENCY,
+                 queue_timeout_ms=PASSWORD_HASH_QUEUE_TIMEOUT_MS, slot_directory=None):
+        self.method = expand_method(method)
+        self.workers = workers
+        self.concurrency = max(1, concurrency)
+        self.queue_timeout = queue_timeout_ms / 1000.0
+        self._waiting = threading.BoundedSemaphore(workers + max_waiting)
+        self._host_slots = SlotPool(slot_directory or os.path.join(metrics.directory(), 'password-slots'),
+                                    self.concurrency)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        # Executor threads do not survive fork; each worker process builds its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='password-hash')
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _run(self, fn, *args):
+        with stage('password_hash'):
+            if not self._waiting.acquire(blocking=False):
+                raise PasswordHasherBusy()
+            try:
+                slot = self._host_slots.acquire(self.queue_timeout)
+                if slot is None:
+                    raise PasswordHasherBusy()
+                try:
+                    return self._pool().submit(fn, *args).result()
+                finally:
+                    self._host_slots.release(slot)
+            finally:
+                self._waiting.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def needs_rehash(self, stored):
+        """True for plaintext legacy rows and hashes made with another method or work factor"""
+        try:
+            return expand_method(stored.split('$', 1)[0]) != self.method
+        except ValueError:
+            return True
+
+    def verify(self, stored, password):
+        """Return (matches, needs_rehash)"""
+        if not stored:
+            return False, False
+        if not stored.startswith(HASH_PREFIXES):
+            # Rows written before hashing was introduced hold the plaintext password
+            return hmac.compare_digest(stored.encode(), password.encode()), True
+        return self._run(check_password_hash, stored, password), self.needs_rehash(stored)
+
+    def rehash_later(self, password, save):
+        """Hash with the current method in the background and hand the result to save(new_hash)"""
+        def task():
+            # Only with a slot to spare; otherwise the next login tries again
+            slot = self._host_slots.try_acquire()
+            if slot is None:
+                return
+            try:
+                save(generate_password_hash(password, self.method))
+            except Exception as e:
+                logger.exception("Password rehash failed: %s", e)
+            finally:
+                self._host_slots.release(slot)
+        if self._waiting.acquire(blocking=False):
+            future = self._pool().submit(task)
+            future.add_done_callback(lambda _: self._waiting.release())
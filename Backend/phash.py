@@ -0,0 +1,157 @@
+"""
+Perceptual hashing for near-duplicate uploads
+A DCT-based pHash (64 bits) survives small crops, exposure changes and
+recompression, so bursts of near-identical leaf photos can reuse one
+diagnosis instead of running inference on each.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from imaging import InvalidImage, open_image
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+PHASH_ENABLED = os.getenv('PHASH_ENABLED', '1').lower() in ('1', 'true', 'yes')
+PHASH_THRESHOLD = int(os.getenv('PHASH_THRESHOLD', 6))        # max Hamming distance out of 64 bits
+PHASH_SCOPE = os.getenv('PHASH_SCOPE', 'user')                # 'user' or 'global'
+PHASH_INDEX_SIZE = int(os.getenv('PHASH_INDEX_SIZE', 256))    # recent hashes kept per scope
+PHASH_MAX_SCOPES = int(os.getenv('PHASH_MAX_SCOPES', 4096))   # users tracked before LRU eviction
+
+HASH_SIZE = 8
+SAMPLE_SIZE = 32
+
+# ============================================================================
+# HASHING
+# ============================================================================
+
+def _dct_matrix(n):
+    """Orthonormal DCT-II basis, so dct(x) == D @ x @ D.T"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    d = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    d[0] /= np.sqrt(2.0)
+    return d.astype(np.float32)
+
+_DCT = _dct_matrix(SAMPLE_SIZE)
+_DCT_LOW = np.ascontiguousarray(_DCT[:HASH_SIZE])
+
+# Bits set in every byte value, for vectorized popcount
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def phash(source):
+    """64-bit perceptual hash of an image path or file object"""
+    with open_image(source) as img:
+        img.draft('L', (SAMPLE_SIZE * 2, SAMPLE_SIZE * 2))
+        try:
+            small = img.convert('L').resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.BILINEAR)
+        except (OSError, SyntaxError, ValueError, EOFError) as e:
+            raise InvalidImage(str(e)) from e
+    pixels = np.asarray(small, dtype=np.float32)
+    low = _DCT_LOW @ pixels @ _DCT_LOW.T
+    coefficients = low.ravel()
+    # The DC term only tracks overall brightness; leave it out of the threshold
+    bits = coefficients > np.median(coefficients[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+# ============================================================================
+# INDEX
+# ============================================================================
+
+class _Ring:
+    __slots__ = ('hashes', 'results', 'size', 'pos')
+
+    def __init__(self, capacity):
+        self.hashes = np.zeros(capacity, dtype=np.uint64)
+        self.results = [None] * capacity
+        self.size = 0
+        self.pos = 0
+
+
+class NearDuplicateIndex:
+    """
+    Recent (hash, diagnosis) pairs per user, or one global ring
+    Memory is bounded by index_size entries per scope and max_scopes scopes.
+    """
+
+    def __init__(self, threshold=PHASH_THRESHOLD, scope=PHASH_SCOPE,
+                 index_size=PHASH_INDEX_SIZE, max_scopes=PHASH_MAX_SCOPES):
+        self.threshold = threshold
+        self.per_user = scope == 'user'
+        self.index_size = index_size
+        self.max_scopes = max_scopes
+        self._rings = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.near_hits = 0
+        self.inference_ms_saved = 0.0
+        self._inference_ms = None
+
+    def _scope(self, user_email):
+        return user_email if self.per_user else '*'
+
+    def lookup(self, user_email, image_hash):
+        """Return (diagnosis, distance) for the closest recent hash within threshold, or None"""
+        key = self._scope(user_email)
+        with self._lock:
+            self.lookups += 1
+            ring = self._rings.get(key)
+            if ring is None or ring.size == 0:
+                return None
+            self._rings.move_to_end(key)
+            diff = ring.hashes[:ring.size] ^ np.uint64(image_hash)
+            distances = _POPCOUNT[diff.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+            best = int(distances.argmin())
+            distance = int(distances[best])
+            if distance > self.threshold:
+                return None
+            self.near_hits += 1
+            if self._inference_ms is not None:
+                self.inference_ms_saved += self._inference_ms
+            return ring.results[best], distance
+
+    def add(self, user_email, image_hash, diagnosis):
+        key = self._scope(user_email)
+        with self._lock:
+            ring = self._rings.get(key)
+            if ring is None:
+                ring = self._rings[key] = _Ring(self.index_size)
+                while len(self._rings) > self.max_scopes:
+                    self._rings.popitem(last=False)
+            self._rings.move_to_end(key)
+            ring.hashes[ring.pos] = image_hash
+            ring.results[ring.pos] = diagnosis
+            ring.pos = (ring.pos + 1) % self.index_size
+            ring.size = min(ring.size + 1, self.index_size)
+
+    def record_inference(self, started, images=1):
+        """Track a moving average of inference time per image to estimate what near hits save"""
+        elapsed = (time.perf_counter() - started) * 1000.0 / images
+        with self._lock:
+            if self._inference_ms is None:
+                self._inference_ms = elapsed
+            else:
+                self._inference_ms = 0.9 * self._inference_ms + 0.1 * elapsed
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": PHASH_ENABLED,
+                "scope": 'user' if self.per_user else 'global',
+                "threshold": self.threshold,
+                "scopes": len(self._rings),
+                "lookups": self.lookups,
+                "near_hits": self.near_hits,
+                "hit_rate": round(self.near_hits / self.lookups, 4) if self.lookups else 0.0,
+                "avg_inference_ms": round(self._inference_ms or 0.0, 3),
+                "inference_ms_saved": round(self.inference_ms_saved, 3),
+            }
@@ -0,0 +1,253 @@
+"""
+Hourly and daily detection counts, maintained as results are written
+stats_rollups holds one count per (period, bucket, user, disease), plus a
+global row per (period, bucket, disease) under user_email ''. The
+dashboard's charts read a window of buckets by primary key, so /api/stats
+costs the same for a user with ten results as for one with a million.
+
+apply() folds every analysis_results row above a high-water mark into the
+counts and moves the mark, all inside the caller's transaction: the result
+writer calls it right after its INSERT, so counts commit (or roll back)
+with the rows they count, in sync and write_behind mode alike. Ids are
+assigned under SQLite's write lock, so they commit in order and the mark
+never skips a row; rows written some other way (seeding scripts, imports)
+are picked up by the next write.
+
+Databases that already had results when the tables were added start with
+the mark at 0. Each write then folds in at most STATS_APPLY_MAX_ROWS old
+rows; the backfill command catches up in one go:
+
+    python -m rollups                    # backfill ./crop_portal.db
+    python -m rollups --rebuild          # recount everything from scratch
+    python -m rollups --prune-hourly 30  # drop hourly buckets older than 30 days
+"""
+
+import os
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+# Old rows folded in per write while a database catches up (0: no limit)
+STATS_APPLY_MAX_ROWS = int(os.getenv('STATS_APPLY_MAX_ROWS', 1000))
+STATS_DEFAULT_DAYS = int(os.getenv('STATS_DEFAULT_DAYS', 30))
+STATS_MAX_DAYS = int(os.getenv('STATS_MAX_DAYS', 366))
+STATS_DEFAULT_HOURS = int(os.getenv('STATS_DEFAULT_HOURS', 48))
+STATS_MAX_HOURS = int(os.getenv('STATS_MAX_HOURS', 168))
+
+GLOBAL = ''
+# Bucket keys are prefixes of created_at ('YYYY-MM-DD HH:MM:SS', UTC)
+PERIODS = {'hour': 13, 'day': 10}
+
+STATS_ROLLUPS_DDL = '''
+    CREATE TABLE IF NOT EXISTS stats_rollups (
+        period TEXT NOT NULL,
+        user_email TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        disease_id INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (period, user_email, bucket, disease_id)
+    ) WITHOUT ROWID
+'''
+
+STATS_WATERMARK_DDL = '''
+    CREATE TABLE IF NOT EXISTS stats_watermark (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        last_result_id INTEGER NOT NULL
+    )
+'''
+
+ROLLUP_UPSERT = '''
+    INSERT INTO stats_rollups (period, user_email, bucket, disease_id, count) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (period, user_email, bucket, disease_id) DO UPDATE SET count = count + excluded.count
+'''
+
+# ============================================================================
+# MAINTENANCE
+# ============================================================================
+
+def watermark(conn):
+    """Id of the last analysis result counted"""
+    row = conn.execute('SELECT last_result_id FROM stats_watermark WHERE id = 0').fetchone()
+    return row[0] if row else 0
+
+
+def apply(conn, max_rows=STATS_APPLY_MAX_ROWS):
+    """
+    Count results above the mark and advance it; returns the rows counted
+    Must run inside a write transaction (the result writer's, or one opened
+    with BEGIN IMMEDIATE) so two processes never count the same rows.
+    """
+    start = watermark(conn)
+    if max_rows:
+        end = conn.execute('''
+            SELECT MAX(id) FROM (SELECT id FROM analysis_results WHERE id > ? ORDER BY id LIMIT ?)
+        ''', (start, max_rows)).fetchone()[0]
+    else:
+        end = conn.execute('SELECT MAX(id) FROM analysis_results').fetchone()[0]
+    if end is None or end <= start:
+        return 0
+
+    counts = {}
+    rows = 0
+    for user_email, disease_id, hour, n in conn.execute('''
+            SELECT user_email, disease_id, substr(created_at, 1, 13), COUNT(*)
+            FROM analysis_results WHERE id > ? AND id <= ?
+            GROUP BY 1, 2, 3
+    ''', (start, end)):
+        rows += n
+        for period, width in PERIODS.items():
+            bucket = hour[:width]
+            # Results without a user only count towards the global totals
+            for owner in (GLOBAL, user_email) if user_email else (GLOBAL,):
+                key = (period, owner, bucket, disease_id)
+                counts[key] = counts.get(key, 0) + n
+    conn.executemany(ROLLUP_UPSERT, [key + (n,) for key, n in counts.items()])
+    conn.execute('''
+        INSERT INTO stats_watermark (id, last_result_id) VALUES (0, ?)
+        ON CONFLICT (id) DO UPDATE SET last_result_id = excluded.last_result_id
+    ''', (end,))
+    return rows
+
+
+def lag(conn):
+    """Results not counted yet (non-zero until a backfill finishes)"""
+    newest = conn.execute('SELECT MAX(id) FROM analysis_results').fetchone()[0] or 0
+    return max(0, newest - watermark(conn))
+
+# ============================================================================
+# QUERIES
+# ============================================================================
+
+def window(period, span, now=None):
+    """Bucket keys of the last span periods, oldest first, ending with the current one"""
+    now = now or datetime.now(timezone.utc)
+    if period == 'day':
+        today = now.date()
+        return [(today - timedelta(days=i)).isoformat() for i in range(span - 1, -1, -1)]
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    return [(hour - timedelta(hours=i)).strftime('%Y-%m-%d %H') for i in range(span - 1, -1, -1)]
+
+
+def clamp_span(period, span):
+    if period == 'day':
+        default, maximum = STATS_DEFAULT_DAYS, STATS_MAX_DAYS
+    else:
+        default, maximum = STATS_DEFAULT_HOURS, STATS_MAX_HOURS
+    if span is None or span < 1:
+        return default
+    return min(span, maximum)
+
+
+def series(conn, user_email, period, buckets, diseases):
+    """
+    Totals and per-bucket counts for one user (or GLOBAL) over buckets
+    Disease versions are merged by name, since the chart shows one slice
+    per disease whatever advice was current at the time.
+    """
+    rows = conn.execute('''
+        SELECT bucket, disease_id, count FROM stats_rollups
+        WHERE period = ? AND user_email = ? AND bucket >= ? AND bucket <= ?
+    ''', (period, user_email, buckets[0], buckets[-1])).fetchall()
+
+    by_bucket = {bucket: {} for bucket in buckets}
+    by_disease = {}
+    for bucket, disease_id, count in rows:
+        entry = diseases.get(disease_id)
+        name = entry['disease'] if entry else 'Unknown'
+        slot = by_bucket[bucket]
+        slot[name] = slot.get(name, 0) + count
+        by_disease[name] = by_disease.get(name, 0) + count
+    return {
+        "total": sum(by_disease.values()),
+        "by_disease": by_disease,
+        "series": [{"bucket": bucket, "total": sum(counts.values()), "by_disease": counts}
+                   for bucket, counts in by_bucket.items()],
+    }
+
+
+def stats(conn, user_email, diseases, period='day', span=None, now=None):
+    """The /api/stats payload: the user's counts (when given) and the global ones"""
+    if period not in PERIODS:
+        raise ValueError(f"Unknown period '{period}' (expected 'day' or 'hour')")
+    buckets = window(period, clamp_span(period, span), now)
+    payload = {
+        "period": period,
+        "from": buckets[0],
+        "to": buckets[-1],
+        "global": series(conn, GLOBAL, period, buckets, diseases),
+        "pending": lag(conn),
+    }
+    if user_email:
+        payload["user"] = series(conn, user_email, period, buckets, diseases)
+    return payload
+
+
+def stats_version(conn, period='day'):
+    """Changes whenever a count or the current bucket does; two primary key reads"""
+    bucket = window(period if period in PERIODS else 'day', 1)[0]
+    return watermark(conn), bucket
+
+# ============================================================================
+# BACKFILL
+# ============================================================================
+
+def backfill(database, batch=50_000, rebuild=False):
+    """Count every result not counted yet, one transaction per batch; returns rows counted"""
+    import db
+
+    if rebuild:
+        with db.transaction(database, immediate=True) as conn:
+            conn.execute('DELETE FROM stats_rollups')
+            conn.execute('DELETE FROM stats_watermark')
+    total = 0
+    started = time.perf_counter()
+    while True:
+        # Short transactions, so live writers only ever wait for one batch
+        with db.transaction(database, immediate=True) as conn:
+            counted = apply(conn, batch)
+        if not counted:
+            break
+        total += counted
+        logger.info("Counted %d results (%d so far, %.0f rows/s)",
+                    counted, total, total / (time.perf_counter() - started))
+    return total
+
+
+def prune_hourly(database, days):
+    """Drop hourly buckets older than days; daily ones are kept"""
+    import db
+
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d %H')
+    with db.transaction(database, immediate=True) as conn:
+        return conn.execute("DELETE FROM stats_rollups WHERE period = 'hour' AND bucket < ?",
+                            (cutoff,)).rowcount
+
+
+def main():
+    import argparse
+    import migrations
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default=migrations.DEFAULT_DATABASE)
+    parser.add_argument('--batch', type=int, default=50_000, help='results counted per transaction')
+    parser.add_argument('--rebuild', action='store_true', help='discard the counts and recount every result')
+    parser.add_argument('--prune-hourly', type=int, metavar='DAYS', help='drop hourly buckets older than DAYS')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    migrations.migrate(args.database)
+    started = time.perf_counter()
+    counted = backfill(args.database, args.batch, args.rebuild)
+    print(f"counted {counted:,} results in {time.perf_counter() - started:.1f}s")
+    if args.prune_hourly is not None:
+        print(f"dropped {prune_hourly(args.database, args.prune_hourly):,} hourly buckets")
+
+
+if __name__ == '__main__':
+    main()
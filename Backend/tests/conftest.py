@@ -0,0 +1,35 @@
+"""
+Shared fixtures
+Modules import each other flat from Backend/, so the tests put it on
+sys.path. Every test process gets its own METRICS_DIR (the admission slots
+and metrics files live there), and each test its own scratch database.
+
+    cd Backend && python -m pytest -q
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix='crop-portal-tests-'))
+
+import db  # noqa: E402
+import migrations  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path):
+    """Path of an empty SQLite file; this thread's pooled connections are closed afterwards"""
+    yield str(tmp_path / 'crop_portal.db')
+    db.close_connections()
+
+
+@pytest.fixture
+def migrated(database):
+    """A scratch database at the current schema version"""
+    migrations.migrate(database)
+    return database
@@ -0,0 +1,92 @@
+import multiprocessing
+
+import pytest
+
+import db
+from admission import RateLimiter, SlotPool
+
+LIMITS = {'ip': (60.0, 5), 'user': (30.0, 2)}   # 1 token/s burst 5; 0.5 token/s burst 2
+IP, USER = ('ip', '203.0.113.7'), ('user', 'a@example.com')
+
+
+@pytest.fixture
+def limiter(database):
+    return RateLimiter(database, LIMITS)
+
+
+def tokens(limiter, kind, key):
+    row = db.get_connection(limiter.database).execute(
+        'SELECT tokens FROM rate_limit_buckets WHERE key = ?', (f'{kind}:{key}',)).fetchone()
+    return None if row is None else row[0]
+
+
+def test_burst_then_refill(limiter):
+    assert [limiter.check([IP], now=100) for _ in range(5)] == [0] * 5
+    assert limiter.check([IP], now=100) == pytest.approx(1.0)
+    assert limiter.check([IP], now=100.5) == pytest.approx(0.5)
+    assert limiter.check([IP], now=101) == 0
+    # Refill stops at the burst
+    assert [limiter.check([IP], now=1000) for _ in range(6)].count(0) == 5
+
+
+def test_rejected_check_takes_from_no_bucket(limiter):
+    assert limiter.check([IP, USER], now=0) == 0
+    assert limiter.check([IP, USER], now=0) == 0
+    # The user bucket is empty; the IP bucket must not pay for the refused request
+    assert limiter.check([IP, USER], now=0) == pytest.approx(2.0)
+    assert tokens(limiter, *IP) == pytest.approx(3)
+    assert tokens(limiter, *USER) == pytest.approx(0)
+
+
+def test_cost_and_debt(limiter):
+    assert limiter.check([IP], cost=3, now=0) == 0
+    limiter.charge([IP, USER], 4, now=0)
+    assert tokens(limiter, *IP) == pytest.approx(-2)
+    assert tokens(limiter, *USER) == pytest.approx(-2)
+    # Debt is paid back before the next request: 3 s to get from -2 to 1 token
+    assert limiter.check([IP], now=0) == pytest.approx(3.0)
+    assert limiter.check([IP], now=3) == 0
+
+
+def test_none_keys_are_skipped(limiter):
+    assert limiter.check([IP, ('user', None)], now=0) == 0
+    assert tokens(limiter, 'user', None) is None
+
+
+def test_prune_drops_only_full_buckets(limiter):
+    limiter.check([IP], now=0)
+    limiter.check([('ip', 'other')], cost=5, now=9)
+    assert limiter.prune(now=10) == 1
+    assert tokens(limiter, *IP) is None
+    assert tokens(limiter, 'ip', 'other') == pytest.approx(0)
+
+
+def _hammer(database, start, results):
+    limiter = RateLimiter(database, {'ip': (0.0, 10)})
+    start.wait()
+    results.put(sum(limiter.check([IP]) == 0 for _ in range(50)))
+
+
+def test_processes_share_one_bucket(database):
+    context = multiprocessing.get_context('fork')
+    start, results = context.Event(), context.Queue()
+    db.close_connections()
+    workers = [context.Process(target=_hammer, args=(database, start, results)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    allowed = sum(results.get(timeout=30) for _ in workers)
+    for worker in workers:
+        worker.join()
+    assert allowed == 10
+
+
+def test_slot_pool_caps_holders(tmp_path):
+    directory = str(tmp_path / 'slots')
+    first, second = SlotPool(directory, 2), SlotPool(directory, 2)
+    held = [first.try_acquire(), second.try_acquire()]
+    assert None not in held and held[0] != held[1]
+    assert first.try_acquire() is None
+    assert second.acquire(timeout=0.02) is None
+    first.release(held[0])
+    assert second.acquire(timeout=0.02) == held[0]
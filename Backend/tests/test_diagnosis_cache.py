@@ -0,0 +1,64 @@
+import pytest
+
+import db
+from diagnosis_cache import DiagnosisCache
+from diseases import DISEASE_DB, DiseaseCatalog
+
+DAY = 86400
+
+
+@pytest.fixture
+def catalog(migrated):
+    return DiseaseCatalog(migrated, DISEASE_DB)
+
+
+def diagnosis(index, confidence=0.9):
+    scores = {entry['disease']: 0.0 for entry in DISEASE_DB}
+    scores[DISEASE_DB[index]['disease']] = confidence
+    return {**DISEASE_DB[index], 'confidence': confidence, 'scores': scores}
+
+
+def stored_rows(database):
+    return db.get_connection(database).execute('SELECT COUNT(*) FROM diagnosis_cache').fetchone()[0]
+
+
+def test_rows_hold_ids_not_advice_text(migrated, catalog):
+    cache = DiagnosisCache(migrated, catalog)
+    cache.put('abc', 'v1', diagnosis(1), now=0)
+    row = db.get_connection(migrated).execute('SELECT * FROM diagnosis_cache').fetchone()
+    assert row['disease_id'] == catalog.id_for(DISEASE_DB[1]['disease'])
+    assert DISEASE_DB[1]['description'] not in tuple(str(value) for value in row)
+
+    # Another worker, with nothing in memory, rebuilds the same diagnosis from the row
+    assert DiagnosisCache(migrated, catalog).get('abc', 'v1', now=1) == diagnosis(1)
+    assert DiagnosisCache(migrated, catalog).get('abc', 'v2', now=1) is None
+
+
+def test_hits_show_the_current_advice(migrated, catalog):
+    DiagnosisCache(migrated, catalog).put('abc', 'v1', diagnosis(0), now=0)
+    changed = [dict(entry) for entry in DISEASE_DB]
+    changed[0]['treatment'] = ['New advice']
+    updated = DiagnosisCache(migrated, DiseaseCatalog(migrated, changed))
+    assert updated.get('abc', 'v1', now=1)['treatment'] == ['New advice']
+
+
+def test_expired_rows_miss_and_are_pruned(migrated, catalog):
+    cache = DiagnosisCache(migrated, catalog, ttl_days=1, prune_every=0)
+    cache.put('old', 'v1', diagnosis(0), now=0)
+    cache.put('new', 'v1', diagnosis(0), now=DAY)
+    assert cache.get('old', 'v1', now=DAY + 1) is None
+    assert DiagnosisCache(migrated, catalog, ttl_days=1).get('old', 'v1', now=DAY + 1) is None
+    assert cache.prune(now=DAY + 1) == 1
+    assert cache.get('new', 'v1', now=DAY + 1) is not None
+
+
+def test_table_is_capped_at_max_rows(migrated, catalog):
+    cache = DiagnosisCache(migrated, catalog, max_rows=50, prune_every=25)
+    for i in range(120):
+        cache.put(f'img{i}', 'v1', diagnosis(i % len(DISEASE_DB)), now=i)
+    assert stored_rows(migrated) <= 50 + 25
+    cache.prune(now=120)
+    assert stored_rows(migrated) == 50
+    fresh = DiagnosisCache(migrated, catalog)
+    assert fresh.get('img119', 'v1', now=120) is not None
+    assert fresh.get('img0', 'v1', now=120) is None
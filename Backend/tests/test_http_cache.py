@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import gzip
+import subprocess
+
+import pytest
+from flask import Flask, jsonify
+
+import http_cache
+from http_cache import conditional
+
+from benchmarks.bench_conditional import BACKEND
+
+
+@pytest.fixture
+def counting_app():
+    """A route over a 'database' whose version is state['version']; state['calls'] counts view runs"""
+    state = {'version': 1, 'calls': 0}
+    app = Flask(__name__)
+    http_cache.init_app(app)
+
+    @app.route('/items')
+    @conditional(lambda: state['version'])
+    def items():
+        state['calls'] += 1
+        return jsonify({'items': [{'id': i, 'name': f'item {i}'} for i in range(200)]})
+
+    http_cache.body_cache.clear()
+    return app.test_client(), state
+
+
+def test_revalidation_skips_the_view_and_the_body(counting_app):
+    client, state = counting_app
+    first = client.get('/items')
+    assert first.status_code == 200 and state['calls'] == 1
+
+    again = client.get('/items', headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+    assert again.data == b''
+    assert state['calls'] == 1
+
+
+def test_new_data_changes_the_etag(counting_app):
+    client, state = counting_app
+    etag = client.get('/items').headers['ETag']
+    state['version'] += 1
+    response = client.get('/items', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert state['calls'] == 2
+
+
+def test_gzipped_body_has_its_own_etag_and_revalidates(counting_app):
+    client, state = counting_app
+    plain = client.get('/items', headers={'Accept-Encoding': 'identity'})
+    zipped = client.get('/items', headers={'Accept-Encoding': 'gzip'})
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert len(zipped.data) < len(plain.data)
+    assert gzip.decompress(zipped.data) == plain.data
+    assert zipped.headers['ETag'] == plain.headers['ETag'][:-1] + http_cache.GZIP_SUFFIX + '"'
+
+    response = client.get('/items', headers={'Accept-Encoding': 'gzip', 'If-None-Match': zipped.headers['ETag']})
+    assert response.status_code == 304
+    assert state['calls'] == 2
+
+
+def test_benchmark_shows_bytes_and_time_saved(tmp_path):
+    report_path = tmp_path / 'conditional.json'
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.bench_conditional', '--rows', '500',
+                             '--repeat', '100', '--json', str(report_path)],
+                            cwd=BACKEND, env=dict(os.environ, PYTHONPATH=BACKEND), capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+    report = json.loads(report_path.read_text())
+    history = report['targets']['history']
+    assert history['304']['bytes'] == 0
+    assert history['304']['median_ms'] < history['full']['median_ms']
+    assert history['gzip']['bytes'] < history['full']['bytes'] / 5
@@ -0,0 +1,78 @@
+import io
+import time
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from inference import InferenceEngine, load_model
+from inference_server import InferenceClient, InferenceServer, _LogitsEngine
+
+LABELS = ['a', 'b', 'c', 'd']
+
+
+class _OtherVersion(_LogitsEngine):
+    @property
+    def model_version(self):
+        return 'some-other-model'
+
+
+class _CountingFallback:
+    def __init__(self, engine):
+        self.engine = engine
+        self.calls = 0
+
+    def predict(self, source, timings=None):
+        self.calls += 1
+        return self.engine.predict(source)
+
+    def submit(self, image):
+        self.calls += 1
+        return self.engine.infer([image])[0]
+
+
+@pytest.fixture(scope='module')
+def engine():
+    return InferenceEngine(load_model(len(LABELS)), LABELS)
+
+
+@pytest.fixture
+def image():
+    buf = io.BytesIO()
+    Image.fromarray(np.random.default_rng(0).integers(0, 255, (64, 64, 3), dtype=np.uint8)).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def serve(path, engine_view):
+    server = InferenceServer(path, engine_view)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+
+
+def test_daemon_is_used_again_once_it_serves_the_same_model(tmp_path, engine, image):
+    path = str(tmp_path / 'inference.sock')
+    fallback = _CountingFallback(engine)
+    client = InferenceClient(engine, fallback, path=path, retry_seconds=0.05)
+
+    mismatched = serve(path, _OtherVersion(engine))
+    expected = client.predict(io.BytesIO(image))
+    assert fallback.calls == 1
+    assert client.stats()['incompatible']
+    stop(mismatched)
+
+    # The daemon is restarted with this worker's model
+    matching = serve(path, _LogitsEngine(engine))
+    try:
+        time.sleep(0.1)
+        assert client.predict(io.BytesIO(image))['index'] == expected['index']
+        assert fallback.calls == 1
+        assert client.remote == 1
+        assert client.stats()['incompatible'] is None
+    finally:
+        stop(matching)
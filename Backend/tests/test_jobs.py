@@ -0,0 +1,90 @@
+import time
+import sqlite3
+import threading
+
+import db
+from jobs import JobQueue, PermanentJobError
+
+
+def make_queue(database, handler, **kwargs):
+    kwargs.setdefault('workers', 1)
+    kwargs.setdefault('poll_interval', 0.01)
+    return JobQueue(database, handler, **kwargs)
+
+
+def wait_for(queue, job_id, states=('done', 'failed'), timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.get(job_id)
+        if job['status'] in states:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} still {queue.get(job_id)['status']}")
+
+
+def test_job_runs_to_done(migrated):
+    queue = make_queue(migrated, lambda job, report: {'ok': job['filename']})
+    job = wait_for(queue, queue.submit('a@example.com', 'leaf.jpg', '/tmp/leaf.jpg'))
+    assert (job['status'], job['progress'], job['result']) == ('done', 1.0, {'ok': 'leaf.jpg'})
+
+
+def test_permanent_error_fails_without_retry(migrated):
+    def handler(job, report):
+        raise PermanentJobError('not an image')
+    queue = make_queue(migrated, handler)
+    job = wait_for(queue, queue.submit('a@example.com', 'x', '/tmp/x'))
+    assert (job['status'], job['error'], job['attempts']) == ('failed', 'not an image', 1)
+
+
+def test_worker_survives_a_failing_status_write(migrated, monkeypatch):
+    queue = make_queue(migrated, lambda job, report: {'ok': True})
+    real_update = queue._update
+    failures = []
+
+    def flaky_update(job, **fields):
+        if fields.get('status') == 'done' and not failures:
+            failures.append(job['id'])
+            raise sqlite3.OperationalError('database is locked')
+        return real_update(job, **fields)
+
+    monkeypatch.setattr(queue, '_update', flaky_update)
+    first = queue.submit('a@example.com', 'one', '/tmp/one')
+    second = queue.submit('a@example.com', 'two', '/tmp/two')
+    # The thread that hit the error went on to run the next job
+    assert wait_for(queue, second)['status'] == 'done'
+    assert failures == [first]
+
+
+def test_run_that_lost_its_lease_records_nothing(migrated):
+    saved = []
+    release = threading.Event()
+
+    def slow_handler(job, report):
+        if job['attempts'] == 1:
+            release.wait(5)
+            report(0.8)  # the lease is gone by now
+        saved.append(job['attempts'])
+        return {'attempt': job['attempts']}
+
+    queue = make_queue(migrated, slow_handler, workers=2, lease_seconds=0.2)
+    job_id = queue.submit('a@example.com', 'leaf.jpg', '/tmp/leaf.jpg')
+    # The second thread reclaims the expired lease and finishes the job
+    job = wait_for(queue, job_id)
+    release.set()
+    time.sleep(0.1)
+    assert job['result'] == {'attempt': 2}
+    assert saved == [2]
+    assert queue.get(job_id)['result'] == {'attempt': 2}
+
+
+def test_stale_terminal_write_is_ignored(migrated):
+    queue = JobQueue(migrated, lambda job, report: None, workers=0, lease_seconds=0.05)
+    job_id = queue.submit('a@example.com', 'leaf.jpg', '/tmp/leaf.jpg')
+    stale = queue._claim()
+    time.sleep(0.1)
+    fresh = queue._claim()
+    assert fresh['id'] == stale['id'] == job_id
+    assert not queue._update(stale, status='done', lease_until=None)
+    assert queue._update(fresh, status='done', lease_until=None)
+    row = db.get_connection(migrated).execute('SELECT status, attempts FROM detection_jobs').fetchone()
+    assert tuple(row) == ('done', 2)
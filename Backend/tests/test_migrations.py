@@ -0,0 +1,87 @@
+import sqlite3
+
+import pytest
+
+import db
+import migrations
+
+# Tables as the old app_production.py created them: text result columns, password_hash NOT NULL
+LEGACY_SCHEMA = '''
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL,
+        password_hash TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE analysis_results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_email TEXT NOT NULL,
+        disease TEXT,
+        confidence REAL,
+        description TEXT,
+        treatment TEXT,
+        prevention TEXT,
+        filename TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    INSERT INTO users (email, name, password_hash) VALUES ('old@example.com', 'Old', 'pbkdf2:sha256:1$x$y');
+    INSERT INTO analysis_results (user_email, disease, confidence, filename)
+    VALUES ('old@example.com', 'Healthy', 0.9, 'a.jpg');
+'''
+
+
+def columns(conn, table):
+    return {row[1]: row for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def test_new_database_reaches_the_current_version(database):
+    assert migrations.migrate(database) == [version for version, _, _ in migrations.MIGRATIONS]
+    conn = db.get_connection(database)
+    assert migrations.schema_version(conn) == migrations.SCHEMA_VERSION
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {'users', 'diseases', 'analysis_results', 'diagnosis_cache', 'detection_jobs',
+            'stats_rollups'} <= tables
+
+
+def test_migrate_is_idempotent(migrated):
+    assert migrations.migrate(migrated) == []
+    assert migrations.ensure(migrated) == migrations.SCHEMA_VERSION
+
+
+def test_legacy_production_database_is_converted(database):
+    conn = sqlite3.connect(database)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.close()
+
+    migrations.migrate(database)
+    conn = db.get_connection(database)
+    assert columns(conn, 'users')['password_hash'][3] == 0  # nullable now
+    assert 'disease_id' in columns(conn, 'analysis_results')
+    assert tuple(conn.execute('SELECT email, password_hash FROM users').fetchone()) == (
+        'old@example.com', 'pbkdf2:sha256:1$x$y')
+    row = conn.execute('''
+        SELECT d.name FROM analysis_results r JOIN diseases d ON d.id = r.disease_id
+    ''').fetchone()
+    assert row[0] == 'Healthy'
+    assert conn.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+    assert conn.execute('PRAGMA foreign_key_check').fetchall() == []
+
+
+def test_a_failing_step_leaves_the_previous_version(database):
+    def broken(conn):
+        conn.execute('CREATE TABLE half_done (id INTEGER)')
+        raise RuntimeError('step failed')
+
+    steps = migrations.MIGRATIONS[:1] + [(2, 'broken', broken)]
+    with pytest.raises(RuntimeError):
+        migrations.migrate(database, steps)
+    conn = db.get_connection(database)
+    assert migrations.schema_version(conn) == 1
+    assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'half_done'").fetchone()[0] == 0
+
+
+def test_ensure_refuses_an_old_schema_when_migrations_are_off(database, monkeypatch):
+    monkeypatch.setattr(migrations, 'MIGRATE_ON_START', False)
+    with pytest.raises(migrations.SchemaOutdated):
+        migrations.ensure(database)
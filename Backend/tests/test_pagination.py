@@ -0,0 +1,46 @@
+import pytest
+
+import db
+from pagination import InvalidCursor, decode_cursor, encode_cursor, fetch_history_page
+from benchmarks.bench_history import HOT_USER, assert_index_used, populate, query_plans
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor('2024-03-01 12:00:00', 42)
+    assert '=' not in cursor
+    assert decode_cursor(cursor) == ('2024-03-01 12:00:00', 42)
+
+
+@pytest.mark.parametrize('cursor', [
+    '!!not base64!!',
+    encode_cursor('2024-03-01', 1)[:-3],      # truncated
+    'WzEsMl0',                                 # [1,2]: created_at is not a string
+    'WyIyMDI0IiwiMSJd',                        # ["2024","1"]: id is not an int
+    'bnVsbA',                                  # null
+])
+def test_invalid_cursors_are_rejected(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor)
+
+
+def test_pages_follow_the_cursor_without_gaps_or_repeats(migrated):
+    catalog = populate(migrated, rows=500, users=5, hot_share=0.5)
+    conn = db.get_connection(migrated)
+    expected = [row['id'] for row in conn.execute(
+        'SELECT id FROM analysis_results WHERE user_email = ? ORDER BY created_at DESC, id DESC', (HOT_USER,))]
+
+    seen, cursor = [], None
+    while True:
+        rows, cursor = fetch_history_page(conn, HOT_USER, catalog, limit=37, before=cursor)
+        seen.extend(row['id'] for row in rows)
+        if cursor is None:
+            break
+    assert seen == expected
+    assert all(row['disease'] for row in rows)
+
+
+def test_history_queries_seek_the_covering_index(migrated):
+    populate(migrated, rows=2000, users=20, hot_share=0.3)
+    first, later = query_plans(db.get_connection(migrated))
+    assert_index_used(first)
+    assert_index_used(later)
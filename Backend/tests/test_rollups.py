@@ -0,0 +1,118 @@
+import random
+from collections import Counter
+from datetime import datetime, timezone
+
+import pytest
+
+import db
+import rollups
+from diseases import DISEASE_DB, DiseaseCatalog
+from write_behind import WriteBehindWriter
+
+INSERT = '''
+    INSERT INTO analysis_results (user_email, disease_id, confidence, model_version, filename, created_at)
+    VALUES (?, ?, ?, 'test', 'leaf.jpg', ?)
+'''
+USERS = ['a@example.com', 'b@example.com', None]
+
+
+@pytest.fixture
+def catalog(migrated):
+    return DiseaseCatalog(migrated, DISEASE_DB)
+
+
+def random_rows(catalog, n, seed=1):
+    rng = random.Random(seed)
+    return [(rng.choice(USERS), rng.choice(catalog.ids), rng.random(),
+             f'2024-05-{rng.randint(1, 3):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00')
+            for _ in range(n)]
+
+
+def rollup_counts(conn):
+    return {(row[0], row[1], row[2], row[3]): row[4]
+            for row in conn.execute('SELECT period, user_email, bucket, disease_id, count FROM stats_rollups')}
+
+
+def exact_counts(rows):
+    counts = Counter()
+    for user, disease_id, _, created_at in rows:
+        for period, width in rollups.PERIODS.items():
+            counts[(period, rollups.GLOBAL, created_at[:width], disease_id)] += 1
+            if user:
+                counts[(period, user, created_at[:width], disease_id)] += 1
+    return dict(counts)
+
+
+def test_result_writer_keeps_counts_and_mark_in_step(migrated, catalog):
+    writer = WriteBehindWriter(migrated, INSERT, mode='sync', after_write=rollups.apply)
+    rows = random_rows(catalog, 300)
+    for row in rows[:100]:
+        writer.write(row)
+    writer.write_many(rows[100:])
+
+    conn = db.get_connection(migrated)
+    assert rollup_counts(conn) == exact_counts(rows)
+    assert rollups.watermark(conn) == conn.execute('SELECT MAX(id) FROM analysis_results').fetchone()[0]
+    assert rollups.lag(conn) == 0
+
+
+def test_rows_written_elsewhere_are_counted_by_the_next_write(migrated, catalog):
+    seeded = random_rows(catalog, 50, seed=2)
+    with db.transaction(migrated) as conn:
+        conn.executemany(INSERT, seeded)
+    conn = db.get_connection(migrated)
+    assert rollups.lag(conn) == 50
+
+    live = random_rows(catalog, 1, seed=3)
+    WriteBehindWriter(migrated, INSERT, mode='sync', after_write=rollups.apply).write(live[0])
+    assert rollups.lag(conn) == 0
+    assert rollup_counts(conn) == exact_counts(seeded + live)
+
+
+def test_catching_up_is_bounded_per_write(migrated, catalog):
+    with db.transaction(migrated) as conn:
+        conn.executemany(INSERT, random_rows(catalog, 250, seed=4))
+    with db.transaction(migrated, immediate=True) as conn:
+        assert rollups.apply(conn, max_rows=100) == 100
+        assert rollups.watermark(conn) == 100
+    assert rollups.backfill(migrated, batch=60) == 150
+    assert rollups.lag(db.get_connection(migrated)) == 0
+
+
+def test_rolled_back_write_leaves_counts_and_mark(migrated, catalog):
+    rows = random_rows(catalog, 20, seed=5)
+    writer = WriteBehindWriter(migrated, INSERT, mode='sync', after_write=rollups.apply)
+    writer.write_many(rows)
+    conn = db.get_connection(migrated)
+    before = rollup_counts(conn), rollups.watermark(conn)
+
+    def failing_apply(tx):
+        rollups.apply(tx)
+        raise RuntimeError('disk full')
+
+    with pytest.raises(RuntimeError):
+        WriteBehindWriter(migrated, INSERT, mode='sync', after_write=failing_apply).write_many(rows)
+    assert (rollup_counts(conn), rollups.watermark(conn)) == before
+    assert conn.execute('SELECT COUNT(*) FROM analysis_results').fetchone()[0] == 20
+
+
+def test_rebuild_matches_incremental_counts(migrated, catalog):
+    writer = WriteBehindWriter(migrated, INSERT, mode='sync', after_write=rollups.apply)
+    for start in range(0, 200, 7):
+        writer.write_many(random_rows(catalog, 7, seed=start))
+    conn = db.get_connection(migrated)
+    incremental = rollup_counts(conn)
+    rollups.backfill(migrated, rebuild=True)
+    assert rollup_counts(conn) == incremental
+
+
+def test_stats_reads_the_window(migrated, catalog):
+    rows = random_rows(catalog, 100, seed=6)
+    WriteBehindWriter(migrated, INSERT, mode='sync', after_write=rollups.apply).write_many(rows)
+    now = datetime(2024, 5, 3, 12, tzinfo=timezone.utc)
+    payload = rollups.stats(db.get_connection(migrated), 'a@example.com', catalog, 'day', 2, now=now)
+    assert [entry['bucket'] for entry in payload['global']['series']] == ['2024-05-02', '2024-05-03']
+    assert payload['global']['total'] == sum(row[3][:10] in ('2024-05-02', '2024-05-03') for row in rows)
+    assert payload['user']['total'] == sum(row[0] == 'a@example.com' and row[3][:10] >= '2024-05-02'
+                                           for row in rows)
+    assert payload['pending'] == 0
@@ -0,0 +1,42 @@
+from token_cache import VerifiedTokenCache
+
+TOKEN = 'header.payload.signature'
+
+
+def test_hit_until_ttl():
+    cache = VerifiedTokenCache(max_entries=10, ttl=300)
+    cache.put(TOKEN, {'email': 'a@example.com', 'exp': 1000 + 86400}, now=1000)
+    assert cache.get(TOKEN, now=1299) == {'email': 'a@example.com', 'exp': 1000 + 86400}
+    # A day-long token is still re-verified after the cache TTL
+    assert cache.get(TOKEN, now=1300) is None
+    assert cache.stats()['expired'] == 1
+
+
+def test_token_expiry_comes_first_when_sooner():
+    cache = VerifiedTokenCache(max_entries=10, ttl=300)
+    cache.put(TOKEN, {'email': 'a@example.com', 'exp': 1010}, now=1000)
+    assert cache.get(TOKEN, now=1009) is not None
+    assert cache.get(TOKEN, now=1010) is None
+
+
+def test_tampered_token_misses():
+    cache = VerifiedTokenCache(max_entries=10, ttl=300)
+    cache.put(TOKEN, {'email': 'a@example.com'}, now=1000)
+    assert cache.get(TOKEN + 'x', now=1000) is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = VerifiedTokenCache(max_entries=2, ttl=300)
+    cache.put('t1', {'n': 1}, now=0)
+    cache.put('t2', {'n': 2}, now=0)
+    cache.get('t1', now=1)
+    cache.put('t3', {'n': 3}, now=1)
+    assert cache.get('t2', now=1) is None
+    assert cache.get('t1', now=1) == {'n': 1}
+    assert cache.stats()['entries'] == 2
+
+
+def test_size_zero_disables():
+    cache = VerifiedTokenCache(max_entries=0)
+    cache.put(TOKEN, {'email': 'a@example.com'})
+    assert cache.get(TOKEN) is None
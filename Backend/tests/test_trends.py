@@ -0,0 +1,83 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+import trends
+from benchmarks.bench_trends import single_bucket, zipf_stream
+
+DEPTH = 4
+
+
+@pytest.fixture(scope='module')
+def stream():
+    return zipf_stream(100_000, 10_000, 1.1, seed=5)
+
+
+def test_error_stays_within_the_bound_and_shrinks_with_memory(stream):
+    exact = Counter(stream)
+    heavy = [key for key, _ in exact.most_common(100)]
+    results = []
+    for width in (256, 1024, 4096):
+        window, nbytes = single_bucket(stream, width, 64, DEPTH)
+        errors = [window.estimate(key) - exact[key] for key in heavy]
+        # A count-min sketch never undercounts, and overcounts by at most e / width of the events
+        assert min(errors) >= 0
+        assert max(errors) <= np.e / width * len(stream)
+        results.append((nbytes, sum(errors) / len(errors)))
+    sizes, mean_errors = zip(*results)
+    assert list(sizes) == sorted(sizes)
+    assert list(mean_errors) == sorted(mean_errors, reverse=True)
+    assert mean_errors[-1] < mean_errors[0] / 4
+
+
+def test_top_k_recall(stream):
+    true_top = [key for key, _ in Counter(stream).most_common(10)]
+    window, _ = single_bucket(stream, 1024, 64, DEPTH)
+    assert [key for key, _ in window.top(10)] == true_top
+
+
+def test_rings_of_several_processes_merge():
+    width, capacity, slots, bucket = 512, 16, 4, 60
+    nbytes = trends.Ring.nbytes(slots, DEPTH, width, capacity)
+    writers = [trends.Aggregator(bytearray(nbytes), slots, bucket, DEPTH, width, capacity) for _ in range(3)]
+    for i, writer in enumerate(writers):
+        writer.observe_many({'Leaf Blight': 10 * (i + 1), 'Rust': 5}, now=1000)
+    window = trends.Window(1000, slots * bucket, bucket, bucket, DEPTH, width)
+    for writer in writers:
+        assert window.add(writer.ring)
+    assert window.events == 60 + 15
+    assert window.top(2) == [('Leaf Blight', 60), ('Rust', 15)]
+
+
+def test_buckets_leave_the_window():
+    width, capacity, slots, bucket = 512, 16, 4, 60
+    writer = trends.Aggregator(bytearray(trends.Ring.nbytes(slots, DEPTH, width, capacity)),
+                               slots, bucket, DEPTH, width, capacity)
+    writer.observe('Old', now=0)
+    writer.observe('New', now=3 * bucket)
+    window = trends.Window(3 * bucket, slots * bucket, bucket, bucket, DEPTH, width)
+    window.add(writer.ring)
+    assert dict(window.top(5)) == {'Old': 1, 'New': 1}
+
+    later = trends.Window(4 * bucket, slots * bucket, bucket, bucket, DEPTH, width)
+    later.add(writer.ring)
+    assert dict(later.top(5)) == {'New': 1}
+    assert later.estimate('New', later.recent) == 0
+
+    # Slot 0 is reused for epoch 4 and no longer counts 'Old'
+    writer.observe('Newest', now=4 * bucket)
+    current = trends.Window(4 * bucket, slots * bucket, bucket, bucket, DEPTH, width)
+    current.add(writer.ring)
+    assert dict(current.top(5)) == {'New': 1, 'Newest': 1}
+
+
+def test_snapshot_ignores_non_positive_spans(tmp_path, monkeypatch):
+    monkeypatch.setenv('TRENDS_DIR', str(tmp_path))
+    for window, recent in ((0, 0), (-60, -1)):
+        payload = trends.snapshot(10, window, recent)
+        assert (payload['window_seconds'], payload['recent_seconds']) == \
+            (trends.TRENDS_WINDOW_SECONDS, trends.TRENDS_RECENT_SECONDS)
+    # The recent part never exceeds the window
+    payload = trends.snapshot(10, 120, 600)
+    assert (payload['window_seconds'], payload['recent_seconds']) == (120, 120)
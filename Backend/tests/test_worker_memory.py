@@ -0,0 +1,24 @@
+import pytest
+
+from memory_report import process_memory
+from benchmarks.bench_workers import run_server, sample_jpeg
+
+pytestmark = pytest.mark.skipif(process_memory()['private_kb'] is None,
+                                reason='needs /proc/<pid>/smaps_rollup (Linux 4.14+)')
+
+HIDDEN = 2048
+
+
+def test_preloaded_workers_share_the_weights():
+    from inference import ReferenceModel
+    weights_mb = ReferenceModel(4, hidden=HIDDEN).nbytes / 2**20
+    image = sample_jpeg()
+    runs = [run_server(workers, True, HIDDEN, 4, image) for workers in (1, 3)]
+
+    assert [run['workers'] for run in runs] == [1, 3]
+    private = [run['worker_private_mb'] for run in runs]
+    # Each worker's own pages stay well under one copy of the weights, and do not grow with the worker count
+    assert max(private) < weights_mb / 2, (private, weights_mb)
+    assert max(private) / min(private) - 1.0 < 0.25, private
+    # Every worker maps the weights as shared pages
+    assert min(run['worker_shared_mb'] for run in runs) > weights_mb * 0.9
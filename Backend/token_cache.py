@@ -0,0 +1,87 @@
+"""
+Cache of already-verified JWTs
+Clients resend the same token on every request, so the HMAC check and claim
+parsing only need to run once per token. Entries are keyed by a SHA-256
+digest of the full token (a tampered token never matches).
+
+The cache is per worker process, so there is no way to revoke an entry in
+every worker at once. Instead no entry outlives TOKEN_CACHE_TTL seconds
+(or the token's own 'exp' claim, if sooner): anything that stops a token
+verifying, such as a rotated JWT_SECRET, takes effect everywhere within
+that time, while tokens themselves last JWT_EXPIRATION hours.
+"""
+
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 10000))   # 0 disables the cache
+TOKEN_CACHE_TTL = float(os.getenv('TOKEN_CACHE_TTL', 300))   # seconds an entry is trusted at most
+
+
+class VerifiedTokenCache:
+    def __init__(self, max_entries=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    @staticmethod
+    def _key(token):
+        if isinstance(token, str):
+            token = token.encode()
+        return hashlib.sha256(token).digest()
+
+    def get(self, token, now=None):
+        """Return the cached payload for a verified, unexpired token, or None"""
+        if self.max_entries <= 0:
+            return None
+        key = self._key(token)
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, expires_at = entry
+            if expires_at <= now:
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def put(self, token, payload, now=None):
+        """Remember a payload that jwt.decode has just verified"""
+        if self.max_entries <= 0:
+            return
+        expires_at = (time.time() if now is None else now) + self.ttl
+        exp = payload.get('exp')
+        if exp is not None:
+            expires_at = min(expires_at, float(exp))
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "capacity": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
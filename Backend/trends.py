@@ -0,0 +1,359 @@
+"""
+Sliding-window top-K of detected diseases, shared by every worker
+Every saved detection result is observed here, in memory, so /api/trends
+can answer "which diseases are spiking in the last hour" without touching
+analysis_results.
+
+The window is a ring of TRENDS_WINDOW_SECONDS / TRENDS_BUCKET_SECONDS time
+buckets. Each bucket holds:
+
+- a count-min sketch (TRENDS_SKETCH_DEPTH rows of TRENDS_SKETCH_WIDTH
+  counters): any key's count, overestimated by at most e / width of the
+  bucket's events with probability 1 - exp(-depth)
+- a Space-Saving summary of TRENDS_TOP_K keys: which keys are heavy; any
+  key above 1 / TOP_K of the bucket's events is guaranteed to be in it
+
+A bucket is reused (zeroed) once it falls out of the window, so memory is
+fixed by the configuration whatever the traffic: about 1.3 MB per process
+with the defaults.
+
+Like metrics.py, each process keeps its ring in a memory-mapped file
+(<pid>.trends under TRENDS_DIR, METRICS_DIR by default) and updates it in
+place. Sketch columns come from blake2b, not hash(), so they agree across
+processes: a reader adds up the sketches of every file's live buckets,
+takes the union of their Space-Saving keys as candidates and ranks them by
+their merged count. Files of exited workers count until their buckets age
+out of the window, and are deleted after that.
+"""
+
+import os
+import glob
+import math
+import mmap
+import time
+import struct
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+TRENDS_ENABLED = os.getenv('TRENDS_ENABLED', '1').lower() in ('1', 'true', 'yes')
+TRENDS_WINDOW_SECONDS = int(os.getenv('TRENDS_WINDOW_SECONDS', 3600))
+TRENDS_BUCKET_SECONDS = int(os.getenv('TRENDS_BUCKET_SECONDS', 60))
+TRENDS_SKETCH_DEPTH = int(os.getenv('TRENDS_SKETCH_DEPTH', 4))
+TRENDS_SKETCH_WIDTH = int(os.getenv('TRENDS_SKETCH_WIDTH', 1024))
+TRENDS_TOP_K = int(os.getenv('TRENDS_TOP_K', 64))
+# "Recent" part of the window compared against the rest to spot spikes
+TRENDS_RECENT_SECONDS = int(os.getenv('TRENDS_RECENT_SECONDS', 300))
+
+KEY_BYTES = 64
+COLUMN_CACHE_SIZE = 4096
+_HEADER = struct.Struct('<4sIIIIII')
+_MAGIC = b'CPTR'
+_VERSION = 1
+
+
+def directory():
+    path = os.environ.get('TRENDS_DIR')
+    if not path:
+        return metrics.directory()
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def columns(key, depth, width):
+    """The sketch column of key in each row: one 128-bit blake2b, split into h1 + row * h2"""
+    h = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=16).digest(), 'little')
+    h1, h2 = h & 0xFFFFFFFFFFFFFFFF, (h >> 64) | 1
+    return [(h1 + row * h2) % width for row in range(depth)]
+
+# ============================================================================
+# RING
+# ============================================================================
+
+class Ring:
+    """
+    The bucket ring over any writable buffer (a process's mmap, or a bytearray)
+    Arrays, in order: the epoch each slot holds (time // bucket seconds, -1
+    when unused), the sketches, and the Space-Saving keys, counts and errors.
+    """
+
+    def __init__(self, buffer, slots, depth, width, capacity, offset=0):
+        self.slots, self.depth, self.width, self.capacity = slots, depth, width, capacity
+        arrays = (('epochs', np.int64, (slots,)),
+                  ('sketch', np.uint32, (slots, depth, width)),
+                  ('keys', f'S{KEY_BYTES}', (slots, capacity)),
+                  ('counts', np.int64, (slots, capacity)),
+                  ('errors', np.int64, (slots, capacity)))
+        for name, dtype, shape in arrays:
+            array = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+            setattr(self, name, array)
+            offset += array.nbytes
+
+    @staticmethod
+    def nbytes(slots, depth, width, capacity):
+        return slots * (8 + depth * width * 4 + capacity * (KEY_BYTES + 16))
+
+
+class Aggregator:
+    """
+    One process's writer
+    observe() touches depth sketch cells and one Space-Saving counter through
+    flat memoryviews of the ring (numpy indexing costs microseconds per call).
+    """
+
+    def __init__(self, buffer, slots=None, bucket_seconds=TRENDS_BUCKET_SECONDS, depth=TRENDS_SKETCH_DEPTH,
+                 width=TRENDS_SKETCH_WIDTH, capacity=TRENDS_TOP_K, offset=0):
+        self.slots = slots or max(1, TRENDS_WINDOW_SECONDS // bucket_seconds)
+        self.bucket_seconds = bucket_seconds
+        self.depth, self.width, self.capacity = depth, width, capacity
+        ring = self.ring = Ring(buffer, self.slots, depth, width, capacity, offset)
+        ring.epochs[:] = -1
+        self._sketch_cells = memoryview(ring.sketch.reshape(-1)).cast('B').cast('I')
+        self._counts = memoryview(ring.counts.reshape(-1)).cast('B').cast('q')
+        self._errors = memoryview(ring.errors.reshape(-1)).cast('B').cast('q')
+        self._keys = memoryview(ring.keys.reshape(-1)).cast('B')
+        self._cells = {}
+        # Per slot: the epoch held, key -> Space-Saving index, and index -> key
+        self._epochs = [-1] * self.slots
+        self._index = [{} for _ in range(self.slots)]
+        self._names = [[] for _ in range(self.slots)]
+        self._lock = threading.Lock()
+
+    def _slot(self, now):
+        epoch = int(now // self.bucket_seconds)
+        slot = epoch % self.slots
+        if self._epochs[slot] != epoch:
+            ring = self.ring
+            # Readers skip the slot while it is being reused
+            ring.epochs[slot] = -1
+            ring.sketch[slot] = 0
+            ring.keys[slot] = b''
+            ring.counts[slot] = 0
+            ring.errors[slot] = 0
+            self._index[slot] = {}
+            self._names[slot] = []
+            ring.epochs[slot] = self._epochs[slot] = epoch
+        return slot
+
+    def _add(self, slot, key, n):
+        cells = self._cells.get(key)
+        if cells is None:
+            if len(self._cells) >= COLUMN_CACHE_SIZE:
+                self._cells.clear()
+            width = self.width
+            cells = self._cells[key] = [row * width + col
+                                        for row, col in enumerate(columns(key, self.depth, width))]
+        sketch = self._sketch_cells
+        base = slot * self.depth * self.width
+        for cell in cells:
+            sketch[base + cell] += n
+
+        index = self._index[slot].get(key)
+        first = slot * self.capacity
+        if index is None:
+            names = self._names[slot]
+            if len(names) < self.capacity:
+                index = len(names)
+                names.append(key)
+            else:
+                # Space-Saving: the new key takes over the smallest counter, whose
+                # value becomes its possible overcount
+                index = int(self.ring.counts[slot].argmin())
+                del self._index[slot][names[index]]
+                names[index] = key
+                self._errors[first + index] = self._counts[first + index]
+            self._index[slot][key] = index
+            offset = (first + index) * KEY_BYTES
+            self._keys[offset:offset + KEY_BYTES] = key.encode()[:KEY_BYTES].ljust(KEY_BYTES, b'\0')
+        self._counts[first + index] += n
+
+    def observe(self, key, now, n=1):
+        with self._lock:
+            self._add(self._slot(now), key, n)
+
+    def observe_many(self, counts, now):
+        """counts: {key: n}, all at one time"""
+        with self._lock:
+            slot = self._slot(now)
+            for key, n in counts.items():
+                self._add(slot, key, n)
+
+# ============================================================================
+# PER-PROCESS FILES
+# ============================================================================
+
+def _config():
+    slots = max(1, TRENDS_WINDOW_SECONDS // TRENDS_BUCKET_SECONDS)
+    return slots, TRENDS_BUCKET_SECONDS, TRENDS_SKETCH_DEPTH, TRENDS_SKETCH_WIDTH, TRENDS_TOP_K
+
+
+def _open_file(path):
+    slots, bucket_seconds, depth, width, capacity = _config()
+    size = _HEADER.size + Ring.nbytes(slots, depth, width, capacity)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        buffer = mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+    aggregator = Aggregator(buffer, slots, bucket_seconds, depth, width, capacity, offset=_HEADER.size)
+    # The header goes last: a reader ignores the file until it is complete
+    _HEADER.pack_into(buffer, 0, _MAGIC, _VERSION, slots, bucket_seconds, depth, width, capacity)
+    return aggregator
+
+
+_aggregator = None
+_aggregator_pid = None
+_aggregator_lock = threading.Lock()
+
+def _process_aggregator():
+    # A forked worker must not write into its parent's file
+    global _aggregator, _aggregator_pid
+    if _aggregator_pid != os.getpid():
+        with _aggregator_lock:
+            if _aggregator_pid != os.getpid():
+                _aggregator = _open_file(os.path.join(directory(), f'{os.getpid()}.trends'))
+                _aggregator_pid = os.getpid()
+    return _aggregator
+
+
+def observe(key, n=1, now=None):
+    """Count one detection of key (a disease name)"""
+    if TRENDS_ENABLED and key:
+        _process_aggregator().observe(key, time.time() if now is None else now, n)
+
+
+def observe_many(keys, now=None):
+    """Count a batch of detections"""
+    if not TRENDS_ENABLED:
+        return
+    counts = {}
+    for key in keys:
+        if key:
+            counts[key] = counts.get(key, 0) + 1
+    if counts:
+        _process_aggregator().observe_many(counts, time.time() if now is None else now)
+
+
+def _read_ring(path):
+    """A file's Ring (a private copy), or None when it is unfinished or from another configuration"""
+    with open(path, 'rb') as f:
+        data = bytearray(f.read())
+    if len(data) < _HEADER.size:
+        return None
+    magic, version, slots, bucket_seconds, depth, width, capacity = _HEADER.unpack_from(data, 0)
+    if magic != _MAGIC or version != _VERSION:
+        return None
+    if (slots, bucket_seconds, depth, width, capacity) != _config():
+        logger.warning("Skipping %s: written with a different trends configuration", path)
+        return None
+    if len(data) < _HEADER.size + Ring.nbytes(slots, depth, width, capacity):
+        return None
+    return Ring(data, slots, depth, width, capacity, offset=_HEADER.size)
+
+# ============================================================================
+# QUERIES
+# ============================================================================
+
+class Window:
+    """Sketches and Space-Saving keys of the live buckets of any number of rings, merged"""
+
+    def __init__(self, now, window_seconds, recent_seconds, bucket_seconds=TRENDS_BUCKET_SECONDS,
+                 depth=TRENDS_SKETCH_DEPTH, width=TRENDS_SKETCH_WIDTH):
+        self.depth, self.width = depth, width
+        current = int(now // bucket_seconds)
+        self.first = current - max(1, window_seconds // bucket_seconds) + 1
+        self.recent_first = current - max(1, recent_seconds // bucket_seconds) + 1
+        self.current = current
+        self.sketch = np.zeros((depth, width), dtype=np.int64)
+        self.recent = np.zeros((depth, width), dtype=np.int64)
+        self.candidates = set()
+        self.rings = 0
+
+    def add(self, ring):
+        """Fold in one ring; False when none of its buckets is in the window"""
+        live = (ring.epochs >= self.first) & (ring.epochs <= self.current)
+        if not live.any():
+            return False
+        self.rings += 1
+        self.sketch += ring.sketch[live].sum(axis=0, dtype=np.int64)
+        recent = (ring.epochs >= self.recent_first) & (ring.epochs <= self.current)
+        if recent.any():
+            self.recent += ring.sketch[recent].sum(axis=0, dtype=np.int64)
+        for raw in np.unique(ring.keys[live][ring.counts[live] > 0]):
+            self.candidates.add(raw.decode(errors='replace'))
+        return True
+
+    @property
+    def events(self):
+        return int(self.sketch[0].sum())
+
+    def estimate(self, key, sketch=None):
+        sketch = self.sketch if sketch is None else sketch
+        return int(sketch[np.arange(self.depth), columns(key, self.depth, self.width)].min())
+
+    def top(self, k):
+        ranked = sorted(((self.estimate(key), key) for key in self.candidates), reverse=True)
+        return [(key, count) for count, key in ranked[:k]]
+
+
+def _clamp_seconds(seconds, default, maximum):
+    """A ?window= or ?recent= argument; missing, zero or negative ones take the default"""
+    if seconds is None or seconds < 1:
+        seconds = default
+    return min(seconds, maximum)
+
+
+def snapshot(k=10, window_seconds=None, recent_seconds=None, now=None):
+    """The /api/trends payload: the top k keys over the window, merged across every process"""
+    slots, bucket_seconds, depth, width, capacity = _config()
+    window_seconds = _clamp_seconds(window_seconds, TRENDS_WINDOW_SECONDS, slots * bucket_seconds)
+    recent_seconds = _clamp_seconds(recent_seconds, TRENDS_RECENT_SECONDS, window_seconds)
+    now = time.time() if now is None else now
+    merged = Window(now, window_seconds, recent_seconds, bucket_seconds, depth, width)
+
+    for path in glob.glob(os.path.join(directory(), '*.trends')):
+        try:
+            ring = _read_ring(path)
+        except OSError as e:
+            logger.warning("Skipping unreadable trends file %s: %s", path, e)
+            continue
+        if ring is None or merged.add(ring):
+            continue
+        stem = os.path.basename(path).split('.')[0]
+        if stem.isdigit() and int(stem) != os.getpid() and not metrics._pid_alive(int(stem)):
+            # An exited worker whose buckets have all aged out
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    events = merged.events
+    older_seconds = window_seconds - recent_seconds
+    top = []
+    for key, count in merged.top(max(1, min(k, capacity))):
+        recent = min(count, merged.estimate(key, merged.recent))
+        change = None
+        if older_seconds > 0 and count > recent:
+            change = round((recent / recent_seconds) / ((count - recent) / older_seconds), 2)
+        top.append({"key": key, "count": count, "recent": recent, "change": change})
+    return {
+        "window_seconds": window_seconds,
+        "recent_seconds": recent_seconds,
+        "bucket_seconds": bucket_seconds,
+        "events": events,
+        # Each count is at most this much too high, with probability 1 - exp(-depth)
+        "error_bound": math.ceil(math.e / width * events),
+        "processes": merged.rings,
+        "top": top,
+    }
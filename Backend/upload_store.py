@@ -0,0 +1,93 @@
+"""
+Content-addressed upload storage
+Uploads are hashed (SHA-256) while they are copied to disk and stored once
+under uploads/<aa>/<bb>/<sha256>.<ext>, so identical photos share one file
+and concurrent uploads can never overwrite each other.
+"""
+
+import os
+import hashlib
+import tempfile
+from collections import namedtuple
+
+CHUNK_SIZE = 64 * 1024
+
+StoredUpload = namedtuple('StoredUpload', ['digest', 'path', 'size', 'created'])
+
+
+class UploadStore:
+    def __init__(self, root, chunk_size=CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path_for(self, digest, ext):
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}.{ext}")
+
+    @staticmethod
+    def digest_from_path(path):
+        return os.path.splitext(os.path.basename(path))[0]
+
+    def writer(self):
+        """Start an upload that arrives in pieces (e.g. from a multipart parser)"""
+        return UploadWriter(self)
+
+    def save(self, stream, ext):
+        """Copy a readable stream into the store, hashing as it goes"""
+        writer = self.writer()
+        try:
+            while True:
+                chunk = stream.read(self.chunk_size)
+                if not chunk:
+                    break
+                writer.write(chunk)
+            return writer.commit(ext)
+        except BaseException:
+            writer.discard()
+            raise
+
+
+class UploadWriter:
+    """
+    One upload being written to the store's tmp dir
+    Call commit(ext) to move it to its content address, or discard().
+    tmp_path can be read (e.g. to validate the image) once close() has run.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.size = 0
+        self._sha = hashlib.sha256()
+        fd, self.tmp_path = tempfile.mkstemp(dir=store.tmp_dir, suffix='.part')
+        self._out = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        self._sha.update(chunk)
+        self._out.write(chunk)
+        self.size += len(chunk)
+
+    def close(self):
+        if not self._out.closed:
+            self._out.close()
+
+    def commit(self, ext):
+        self.close()
+        digest = self._sha.hexdigest()
+        path = self.store.path_for(digest, ext.lower())
+        try:
+            if os.path.exists(path):
+                os.unlink(self.tmp_path)
+                return StoredUpload(digest, path, self.size, False)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Atomic rename: a concurrent upload of the same bytes just replaces identical content
+            os.replace(self.tmp_path, path)
+            return StoredUpload(digest, path, self.size, True)
+        except BaseException:
+            self.discard()
+            raise
+
+    def discard(self):
+        self.close()
+        if os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
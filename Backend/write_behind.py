@@ -0,0 +1,201 @@
+"""
+Write-behind batching for analysis result inserts
+
+RESULT_WRITE_MODE controls durability:
+- 'sync' (default): every result is committed before the response is sent.
+- 'write_behind': results are queued in memory and committed by a background
+  thread in one transaction every WRITE_BEHIND_MAX_ROWS rows or
+  WRITE_BEHIND_MAX_MS milliseconds. A graceful shutdown drains the queue;
+  a hard crash (SIGKILL, OOM) can lose up to one flush interval of results,
+  and history may lag a new detection by up to that interval.
+
+When the queue is full, writers wait up to WRITE_BEHIND_PUT_TIMEOUT_MS and
+then commit their own row synchronously, so memory stays bounded and a slow
+disk pushes back on request latency instead of dropping data.
+"""
+
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+import weakref
+
+import db
+from batching import Histogram
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+RESULT_WRITE_MODE = os.getenv('RESULT_WRITE_MODE', 'sync')
+WRITE_BEHIND_MAX_ROWS = int(os.getenv('WRITE_BEHIND_MAX_ROWS', 200))
+WRITE_BEHIND_MAX_MS = float(os.getenv('WRITE_BEHIND_MAX_MS', 50))
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv('WRITE_BEHIND_QUEUE_SIZE', 10000))
+WRITE_BEHIND_PUT_TIMEOUT_MS = float(os.getenv('WRITE_BEHIND_PUT_TIMEOUT_MS', 100))
+
+FLUSH_MS_BUCKETS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+_writers = weakref.WeakSet()
+
+# ============================================================================
+# WRITER
+# ============================================================================
+
+class WriteBehindWriter:
+    """Writes rows for one INSERT statement, synchronously or through a batching queue"""
+
+    def __init__(self, database, insert_sql, mode=RESULT_WRITE_MODE, max_rows=WRITE_BEHIND_MAX_ROWS,
+                 max_ms=WRITE_BEHIND_MAX_MS, queue_size=WRITE_BEHIND_QUEUE_SIZE,
+                 put_timeout_ms=WRITE_BEHIND_PUT_TIMEOUT_MS, after_write=None):
+        if mode not in ('sync', 'write_behind'):
+            raise ValueError(f"Unknown RESULT_WRITE_MODE '{mode}' (expected 'sync' or 'write_behind')")
+        self.database = database
+        self.insert_sql = insert_sql
+        self.mode = mode
+        self.max_rows = max_rows
+        self.max_wait = max_ms / 1000.0
+        self.queue_size = queue_size
+        self.put_timeout = put_timeout_ms / 1000.0
+        # Called with the connection after each INSERT, in the same transaction
+        self.after_write = after_write
+
+        self.flush_ms = Histogram(FLUSH_MS_BUCKETS)
+        self.rows_written = 0
+        self.backpressure_events = 0
+        self.failed_rows = 0
+
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._lock = threading.Lock()
+        _writers.add(self)
+
+    def write(self, row):
+        """Persist one row according to the configured mode"""
+        if self.mode == 'write_behind':
+            self._ensure_thread()
+            if not self._stopping:
+                try:
+                    self._queue.put(row, timeout=self.put_timeout)
+                    return
+                except queue.Full:
+                    with self._lock:
+                        self.backpressure_events += 1
+        self._commit([row])
+
+    def write_many(self, rows):
+        """Persist several rows; in sync mode they share one transaction"""
+        if not rows:
+            return
+        if self.mode == 'write_behind':
+            for row in rows:
+                self.write(row)
+            return
+        self._commit(list(rows))
+
+    # ---------------------------------------------------------------- worker
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Rows queued before a fork belong to the parent; start clean
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._stopping = False
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def _commit(self, rows):
+        started = time.perf_counter()
+        with db.transaction(self.database) as conn:
+            conn.executemany(self.insert_sql, rows)
+            if self.after_write is not None:
+                self.after_write(conn)
+        self.flush_ms.observe((time.perf_counter() - started) * 1000.0)
+        with self._lock:
+            self.rows_written += len(rows)
+
+    def _flush(self, rows):
+        try:
+            self._commit(rows)
+        except Exception as e:
+            logger.exception("Write-behind flush of %d rows failed: %s", len(rows), e)
+            with self._lock:
+                self.failed_rows += len(rows)
+            return False
+        return True
+
+    def _collect(self):
+        try:
+            first = self._queue.get(timeout=0.5)
+        except queue.Empty:
+            return []
+        rows = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(rows) < self.max_rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return rows
+
+    def _run(self):
+        while not self._stopping:
+            rows = self._collect()
+            if rows and not self._flush(rows):
+                # One retry for transient errors such as a long-held write lock
+                self._flush(rows)
+
+    def drain(self):
+        """Flush everything still queued in this process (call on shutdown)"""
+        if self.mode == 'sync' or self._pid != os.getpid():
+            return 0
+        self._stopping = True
+        # Let the worker finish the batch it may be holding, then take the rest
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.max_wait + 1.0)
+        rows = []
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for start in range(0, len(rows), self.max_rows):
+            self._flush(rows[start:start + self.max_rows])
+        if rows:
+            logger.info("Drained %d queued result rows", len(rows))
+        return len(rows)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+                "queue_capacity": self.queue_size,
+                "rows_written": self.rows_written,
+                "failed_rows": self.failed_rows,
+                "backpressure_events": self.backpressure_events,
+                "flush_ms": self.flush_ms.snapshot(),
+            }
+
+
+def drain_all():
+    """Drain every writer in this process; wired to gunicorn's worker_exit and atexit"""
+    for writer in list(_writers):
+        try:
+            writer.drain()
+        except Exception as e:
+            logger.exception("Failed to drain write-behind queue: %s", e)
+
+atexit.register(drain_all)
@@ -417,7 +417,7 @@ function initPasswordToggles() {
 function initDashboardCharts() {
     const ctx = document.getElementById('diseaseChart');
     if (ctx && typeof Chart !== 'undefined') {
-        new Chart(ctx, {
+        const chart = new Chart(ctx, {
             type: 'doughnut',
             data: {
                 labels: ['Healthy', 'Early Blight', 'Common Rust', 'Mosaic Virus'],
@@ -425,6 +425,42 @@ function initDashboardCharts() {
             },
             options: { responsive: true, plugins: { legend: { position: 'bottom' } } }
         });
+        loadDashboardStats(chart);
+    }
+}
+
+// Replace the sample numbers with the user's last 30 days from /api/stats
+async function loadDashboardStats(chart) {
+    const currentUser = JSON.parse(localStorage.getItem('currentUser')) ||
+                        JSON.parse(sessionStorage.getItem('currentUser'));
+    if (!currentUser || typeof CONFIG === 'undefined') return;
+
+    try {
+        // app_v2_jwt.py reads the user from the bearer token; app.py from ?email=
+        const headers = currentUser.token ? { 'Authorization': `Bearer ${currentUser.token}` } : {};
+        const response = await fetch(`${CONFIG.API_URL}/api/stats?period=day&span=30&email=${encodeURIComponent(currentUser.email)}`,
+                                     { headers });
+        if (!response.ok) return;
+        const stats = (await response.json()).user;
+        if (!stats) return;
+
+        const healthy = stats.by_disease['Healthy'] || 0;
+        const setText = (id, value) => {
+            const el = document.getElementById(id);
+            if (el) el.textContent = value;
+        };
+        setText('statTotal', stats.total);
+        setText('statDetections', stats.total - healthy);
+        setText('statHealthy', healthy);
+
+        const labels = Object.keys(stats.by_disease);
+        if (labels.length) {
+            chart.data.labels = labels;
+            chart.data.datasets[0].data = labels.map(name => stats.by_disease[name]);
+            chart.update();
+        }
+    } catch (error) {
+        console.error('Stats unavailable, keeping sample data:', error);
     }
 }
 